@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""Benchmark of the Water Cloud Model gradient.
+
+Compares the vectorised gradient of ``sar_observation_operator`` against the
+per-pixel loop it replaced, for increasing numbers of pixels. The time per
+pixel of the vectorised version should stay roughly constant (linear
+scaling), and both gradients should agree to machine precision.
+
+    python benchmarks/sar_gradient.py
+"""
+import os
+import sys
+import time
+
+import numpy as np
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../')
+
+from multiply_forward_operators.sar_forward_model import \
+    sar_observation_operator
+
+
+def loop_gradient(x, polarisation):
+    """The original per-pixel gradient loop, kept as a reference"""
+    parameters = {'VV': [0.0846, 0.0615, -14.8465, 15.907, 0.],
+                  'VH': [0.0795, 0.1464, -14.8332, 15.907, 0.]}
+    A, B, C, D, E = parameters[polarisation]
+    mu = np.cos(np.deg2rad(23.))
+    grad = x*0
+    n_elems = x.shape[1]
+    for i in range(n_elems):
+        tau_value = np.exp(-2 * B / mu * x[0, i])
+        grad[0, i] = A * E * mu * (x[0, i] ** (E - 1)) * (1 - tau_value) + \
+            2 * A * B * (x[0, i] ** E) * tau_value - (\
+            (2 ** (1/10. * (C + D * x[1, i]) + 1)) * \
+            (5 ** (1/10. * (C + D * x[1, i])) * B * tau_value) \
+            ) / mu
+        grad[1, i] = D * np.log(10) * tau_value * \
+            10 ** (1/10. * (C + D * x[1, i]) - 1)
+    return grad
+
+
+def time_it(func, *args, **kwargs):
+    repeats = kwargs.pop('repeats', 1)
+    best = np.inf
+    for _ in range(repeats):
+        t0 = time.time()
+        result = func(*args)
+        best = min(best, time.time() - t0)
+    return best, result
+
+
+def main(sizes=(10**3, 10**4, 10**5, 10**6), loop_limit=10**5):
+    np.random.seed(42)
+    print("{:>10s} {:>14s} {:>14s} {:>14s} {:>12s}".format(
+        "n_pixels", "vector [s]", "ns/pixel", "loop [s]", "rel. error"))
+    for n_pixels in sizes:
+        x = np.vstack([np.random.uniform(0.01, 8., n_pixels),
+                       np.random.uniform(0.05, 0.5, n_pixels)])
+        t_vec, (_, grad) = time_it(sar_observation_operator, x, "VV",
+                                   repeats=3)
+        if n_pixels <= loop_limit:
+            t_loop, grad_loop = time_it(loop_gradient, x, "VV")
+            err = np.max(np.abs(grad - grad_loop)) / np.max(np.abs(grad_loop))
+            loop_str, err_str = "{:14.4f}".format(t_loop), \
+                "{:12.2e}".format(err)
+        else:
+            loop_str, err_str = "{:>14s}".format("-"), "{:>12s}".format("-")
+        print("{:10d} {:14.4f} {:14.1f} {:s} {:s}".format(
+            n_pixels, t_vec, 1e9 * t_vec / n_pixels, loop_str, err_str))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""Memory benchmark of repeated SAR operator calls.
+
+Runs sar_observation_operator repeatedly on the same number of pixels, as an
+iterative solver does, and reports the peak memory allocated by NumPy during
+each iteration (measured with tracemalloc). With a SARWorkspace and
+preallocated out arrays the peak stays flat at zero bytes per iteration,
+without them every call allocates several pixel sized temporaries.
+
+    python benchmarks/sar_memory.py
+"""
+import os
+import sys
+import tracemalloc
+
+import numpy as np
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../')
+
+from multiply_forward_operators.sar_forward_model import \
+    sar_observation_operator, SARWorkspace
+
+
+def peak_per_iteration(x, theta, n_iterations, **kwargs):
+    peaks = []
+    tracemalloc.start()
+    for _ in range(n_iterations):
+        tracemalloc.reset_peak()
+        start, _ = tracemalloc.get_traced_memory()
+        sar_observation_operator(x, ["VV", "VH"], theta=theta, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+        peaks.append(peak - start)
+    tracemalloc.stop()
+    return np.array(peaks)
+
+
+def main(n_pixels=10**6, n_iterations=20):
+    np.random.seed(42)
+    print("{:d} pixels, VV+VH, {:d} iterations".format(n_pixels,
+                                                       n_iterations))
+    print("{:>10s} {:>22s} {:>14s} {:>14s}".format(
+        "dtype", "mode", "min peak [MB]", "max peak [MB]"))
+    for dtype in [np.float64, np.float32]:
+        x = np.vstack([np.random.uniform(0.01, 8., n_pixels),
+                       np.random.uniform(0.05, 0.5, n_pixels)]).astype(dtype)
+        theta = np.random.uniform(30., 45., n_pixels).astype(dtype)
+        workspace = SARWorkspace(n_pixels, n_pol=2, dtype=dtype)
+        out = workspace.allocate_output()
+        for mode, kwargs in [
+                ("allocating", {"dtype": dtype}),
+                ("workspace + out", {"workspace": workspace, "out": out})]:
+            peaks = peak_per_iteration(x, theta, n_iterations, **kwargs)
+            print("{:>10s} {:>22s} {:14.2f} {:14.2f}".format(
+                np.dtype(dtype).name, mode, peaks.min() / 2.**20,
+                peaks.max() / 2.**20))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,110 +3,189 @@
 
 """
 import datetime
-import glob
+import hashlib
+import json
 import os
-from collections import namedtuple
-import gdal
+import threading
+import time
+from collections import OrderedDict, namedtuple
 import numpy as np
-import osr
-import scipy.sparse as sp
-from netCDF4 import Dataset
+try:
+    from osgeo import gdal
+except ImportError:
+    import gdal
 from dateutil import parser
 
+from .cache import LRUCache
+from .resampling import IndexResampler, get_target_grid
+from .resampling import iter_windows, reproject_image, source_grid_key
+from .resampling import window_grid
+from .parallel import prefetch, run_tasks
+from .pixel_index import PixelIndex
+from .s1_catalogue import POLARISATIONS, DateIndex, S1Catalogue
+from .s1_catalogue import match_record
+from .uncertainty import DiagonalPrecision, enl_uncertainty
+
 
 WRONG_VALUE = -999.0 # TODO tentative missing value
 
 SARdata = namedtuple('SARdata','observations uncertainty mask metadata emulator')
 
-def reproject_image(source_img, target_img, dstSRSs=None):
-    """Reprojects/Warps an image to fit exactly another image.
-    Additionally, you can set the destination SRS if you want
-    to or if it isn't defined in the source image."""
-    g = gdal.Open(target_img)
-    geo_t = g.GetGeoTransform()
-    x_size, y_size = g.RasterXSize, g.RasterYSize
-    xmin = min(geo_t[0], geo_t[0] + x_size * geo_t[1])
-    xmax = max(geo_t[0], geo_t[0] + x_size * geo_t[1])
-    ymin = min(geo_t[3], geo_t[3] + y_size * geo_t[5])
-    ymax = max(geo_t[3], geo_t[3] + y_size * geo_t[5])
-    xRes, yRes = abs(geo_t[1]), abs(geo_t[5])
-    if dstSRSs is None:
-        dstSRS = osr.SpatialReference()
-        raster_wkt = g.GetProjection()
-        dstSRS.ImportFromWkt(raster_wkt)
-    else:
-        dstSRS = dstSRSs
-
-    g = gdal.Warp('', source_img, format='MEM',
-                  outputBounds=[xmin, ymin, xmax, ymax], xRes=xRes, yRes=yRes,
-                  dstSRS=dstSRS)
-    if g is None:
-        raise ValueError("Something failed with GDAL!")
-    return g
+IngestResult = namedtuple('IngestResult', 'data failed stats')
+
+def _ingest_band(args):
+    """
+    warp one variable of a netCDF4 file to a target grid (in a worker
+    process) and optionally save it
+
+    Input
+    ------
+    args (tuple of file, band name, variable name, TargetGrid, index map
+    cache folder or None, output .npy file or None)
+
+    Output
+    ------
+    (band name, array or output file, error message or None)
+    """
+    this_file, band, variable_name, target_grid, cache_dir, output_file = args
+    try:
+        fname = 'NETCDF:"{:s}":{:s}'.format(this_file, variable_name)
+        handle = gdal.Open(fname)
+        if handle is None:
+            raise ValueError("Can't open {:s} with GDAL!".format(fname))
+        if cache_dir is not None:
+            data = IndexResampler(target_grid, cache_dir).resample(handle)
+        else:
+            data = reproject_image(handle, target_grid).ReadAsArray()
+        if output_file is not None:
+            np.save(output_file, data)
+            data = output_file
+        return band, data, None
+    except Exception as error:
+        return band, None, '{:s}: {:s}'.format(type(error).__name__,
+                                               str(error))
 
 class S1Observations(object):
     """
     """
 
-    def __init__(self, data_folder, state_mask, emulators={'vv':'SOmething', 'vh':'Other'}):
+    def __init__(self, data_folder, state_mask, emulators={'vv':'SOmething', 'vh':'Other'},
+                 catalogue_file=None, max_open_files=32,
+                 index_resampling=True, resampling_cache_dir=None,
+                 tile_size=None, cube_dir=None, start_date=None,
+                 end_date=None, orbitdirection=None, relativeorbit=None,
+                 satellite=None, enl_window=7, max_enl=100.):
 
         """
         File sorting ??? Are sorted observation_dates needed for KafKa?
+
+        The metadata of the files is kept in an on-disk S1Catalogue
+        (catalogue_file, by default s1_catalogue.json in data_folder), so
+        only new or changed files are opened when the class is created.
+        Variable names and attributes are then resolved from the catalogue,
+        the state_mask grid is read once, and up to max_open_files GDAL
+        datasets are kept open in a least recently used pool (see
+        pool_stats).
+
+        With index_resampling, bands are not warped with gdal.Warp one by
+        one: the source pixel of every state_mask pixel is computed once per
+        distinct source grid (one gdal.Warp, optionally cached on disk in
+        resampling_cache_dir) and the bands are gathered with NumPy. Only
+        the window of the files under the state_mask is read.
+
+        With a tile_size (pixels, an int or a (x, y) pair), iter_tiles
+        streams the observations window by window, so that memory depends
+        on the tile size rather than on the size of the state_mask.
+
+        With a cube_dir, build_cube writes all the warped bands, incidence
+        angles and masks to a memory-mapped (date, band, y, x) cube, keyed
+        on the catalogue and the state_mask grid. Once built (in this or an
+        earlier run), get_band_data and get_observation slice the cube
+        instead of reading and warping the files.
+
+        Only the scenes from start_date to end_date (both included) whose
+        orbitdirection, relativeorbit and satellite match the given values
+        (a value or a list of them) are used; the others are never opened
+        nor warped. dates_between, nearest_date and query search the
+        selected scenes with a binary search over the sorted dates.
+
+        The speckle uncertainty of every pixel comes from its Equivalent
+        Number of Looks over an enl_window x enl_window moving window
+        (bounded by max_enl). Windowed reads include a halo of
+        enl_window // 2 pixels, so tiles get the same uncertainty as the
+        full scene.
         """
 
-        # 1. Find the files
-        files = glob.glob(os.path.join(data_folder, '*.nc'))
-        files.sort()
+        # 1. Find the files, filtered by date and metadata
+        self.catalogue = S1Catalogue(data_folder, catalogue_file)
+        self.filters = {'orbitdirection': orbitdirection,
+                        'relativeorbit': relativeorbit,
+                        'satellite': satellite}
+        files = self.catalogue.select(start_date, end_date, **self.filters)
         self.state_mask = state_mask
+        self.target_grid = get_target_grid(state_mask)
+        self.tile_size = tile_size
+        self.enl_window = enl_window
+        self.max_enl = max_enl
+        self.resampling_cache_dir = resampling_cache_dir
+        self._handles = LRUCache(maxsize=max_open_files)
+        self._handles_lock = threading.Lock()
+        self.resampler = None
+        # index resamplers of the last windows (tiles) read
+        self._window_resamplers = LRUCache(maxsize=16)
+        self._resamplers_lock = threading.Lock()
+        if index_resampling:
+            self.resampler = IndexResampler(self.target_grid,
+                                            resampling_cache_dir)
+        self._metadata_lookups = 0
+        self._target_grid_lookups = 0
         self.dates = []
         self.date_data = {}
 
         for fich in files:
-            fname = os.path.basename(fich)
-            # TODO Maybe filter files by metadata
-            # (e.g. select ascending/descending passes)
-            data = Dataset(fich)
-            attrs = data.ncattrs()
-
-            # Search for date in attribute name and takes first variable that matches
-            for i, s in enumerate(attrs):
-                if 'date' in s.lower():
-                    date = getattr(data, s)
-                    break
-
-            this_date = parser.parse(date)
+            this_date = parser.parse(self.catalogue[fich]['date'])
 
             self.dates.append(this_date)
             self.date_data[this_date] = fich
-        # self.observation_dates = sorted(self.observation_dates.items())
+        self.dates.sort()
+        self.date_index = DateIndex(self.dates)
 
         # 2. Store the emulator(s)
         self.emulators = emulators
         self.bands_per_observation = {}
         for the_date in self.dates:
-            self.bands_per_observation[the_date] = 2 # 2 bands
+            record = self.catalogue[self.date_data[the_date]]
+            self.bands_per_observation[the_date] = len(record['polarisations'])
+
+        # 3. Open the cube of warped observations, if already built
+        self.cube_dir = cube_dir
+        self.cube = None
+        if cube_dir is not None:
+            self._open_cube()
 
-    def _calculate_uncertainty(self, backscatter):
+    def _calculate_uncertainty(self, backscatter, mask=None):
         """
         Calculation of the uncertainty of Sentinel-1 input data
         Radiometric uncertainty of Sentinel-1 Sensors are within 1 and 0.5 dB
         Calculate Equivalent Number of Looks (ENL) of input dataset leads to
         uncertainty of scene caused by speckle-filtering/multi-looking
+
+        The ENL (mean**2 / variance) is estimated for every pixel over an
+        enl_window x enl_window moving window of the valid pixels, in O(N)
+        with summed-area tables, and the uncertainty is backscatter /
+        sqrt(ENL).
         Input
         ------
-        backscatter (backscatter values)
+        backscatter (2D array of backscatter values)
+        mask (valid pixels, by default from _get_mask)
         Output
         ------
-        unc (uncertainty in dB)
+        unc (uncertainty in the units of backscatter)
         """
-
-        # first approximation of uncertainty (1 dB)
-        unc = backscatter*0.05
-
-
-        # need to find a good way to calculate ENL
-        # self.ENL = (backscatter.mean()**2) / (backscatter.std()**2)
-
+        if mask is None:
+            mask = self._get_mask(backscatter)
+        unc = enl_uncertainty(backscatter, mask, self.enl_window,
+                              self.max_enl)
         return unc
 
 
@@ -114,19 +193,22 @@ class S1Observations(object):
         """
         Mask for selection of pixels
 
-        Get a True/False array with the selected/unselected pixels
+        Get a True/False array with the selected/unselected pixels. Missing
+        values (WRONG_VALUE, NaN) and non-positive backscatter, which is
+        what the resampling fills outside of the scene with, are
+        unselected: their speckle uncertainty would be zero.
 
 
         Input
         ------
-        this_file ?????
+        this_file (array of linear backscatter)
 
         Output
         ------
-
+        mask (boolean array, True for selected pixels)
         """
 
-        mask = np.ones_like(this_file, dtype=np.bool)
+        mask = np.isfinite(this_file) & (this_file > 0)
         mask[this_file == WRONG_VALUE] = False
         return mask
 
@@ -147,8 +229,8 @@ class S1Observations(object):
             - relativorbit
             - orbitdirection
         """
-        dset = Dataset(this_file, 'r', format="NETCDF4")
-        freq = getattr(dset, 'frequency')
+        self._metadata_lookups += 1
+        freq = self.catalogue[this_file]['frequency']
 
         return freq
 
@@ -166,9 +248,9 @@ class S1Observations(object):
         variable_name (complete name of variable within netCDF4 file)
 
         """
-        dset = Dataset(this_file, 'r', format="NETCDF4")
+        self._metadata_lookups += 1
 
-        for i, s in enumerate(dset.variables):
+        for i, s in enumerate(self.catalogue[this_file]['variables']):
             if search_string in s.lower():
                 variable_name = s
                 break
@@ -177,9 +259,473 @@ class S1Observations(object):
 
         return variable_name
 
+    def _open_band(self, this_file, variable_name):
+        """
+        get an open GDAL dataset of one variable of a netCDF4 file from the
+        pool of open files. The least recently used dataset is dropped (and
+        so closed) when the pool is full.
+        """
+        fname = 'NETCDF:"{:s}":{:s}'.format(this_file, variable_name)
+        with self._handles_lock:
+            handle = self._handles.get(fname)
+            if handle is None:
+                handle = gdal.Open(fname)
+                if handle is None:
+                    raise ValueError("Can't open {:s} with GDAL!".format(fname))
+                self._handles.put(fname, handle)
+        return handle
+
+    def _get_resampler(self, window):
+        """
+        index resampler of the state_mask grid or of a window of it. Index
+        maps of windows are only worth computing when they are cached on
+        disk, otherwise windows are warped directly. Either way, only the
+        part of the files under the window is read
+        """
+        if window is None:
+            return self.resampler
+        if self.resampler is None or self.resampling_cache_dir is None:
+            return None
+        with self._resamplers_lock:
+            resampler = self._window_resamplers.get(window)
+            if resampler is None:
+                resampler = IndexResampler(
+                    window_grid(self.target_grid, window),
+                    self.resampling_cache_dir)
+                self._window_resamplers.put(window, resampler)
+        return resampler
+
+    def _read_warped(self, this_file, variable_name, window=None):
+        """read one variable of a netCDF4 file on the state_mask grid (or
+        on a (xoff, yoff, xsize, ysize) window of it)"""
+        handle = self._open_band(this_file, variable_name)
+        resampler = self._get_resampler(window)
+        if resampler is not None:
+            return resampler.resample(handle)
+        self._target_grid_lookups += 1
+        return reproject_image(handle, self.target_grid,
+                               window=window).ReadAsArray()
+
+    def pool_stats(self):
+        """
+        counters of the file opens avoided by the catalogue, the target grid
+        description and the pool of open datasets
+
+        Output
+        ------
+        dictionary with
+            - gdal_opens: datasets opened by the pool
+            - gdal_opens_avoided: datasets served by the pool
+            - netcdf_opens_avoided: variable name and attribute lookups
+              served by the catalogue
+            - target_opens_avoided: warps reusing the state_mask grid
+        """
+        return {'gdal_opens': self._handles.misses,
+                'gdal_opens_avoided': self._handles.hits,
+                'netcdf_opens_avoided': self._metadata_lookups,
+                'target_opens_avoided': self._target_grid_lookups}
 
+    def close(self):
+        """close all the datasets of the pool"""
+        self._handles.clear()
 
-    def get_band_data(self, timestep, band):
+    def _get_uncertainty(self, observations, mask=None, crop=None):
+        """
+        observation uncertainty (as diagonal inverse covariance matrix, with
+        zero precision for masked pixels) and mask of one band. With crop
+        (see _halo_window), observations include a halo around the window,
+        and the uncertainty and mask are those of the window only.
+        """
+        # masks of cubes built before non-positive values were masked
+        # may still select them
+        if mask is None:
+            mask = self._get_mask(observations)
+        else:
+            mask = mask & self._get_mask(observations)
+        uncertainty = self._calculate_uncertainty(observations, mask)
+        if crop is not None:
+            uncertainty, mask = uncertainty[crop], mask[crop]
+        R_mat_sp = DiagonalPrecision.from_uncertainty(uncertainty, mask)
+        return R_mat_sp, mask
+
+    def _halo_window(self, window):
+        """
+        window to read so that the ENL moving window of every pixel of
+        window is complete (within the state_mask), and the (rows, cols)
+        slices of window in it. None if there is no window.
+        """
+        halo = self.enl_window // 2
+        if window is None or halo == 0:
+            return window, None
+        xoff, yoff, xsize, ysize = window
+        x0, y0 = max(xoff - halo, 0), max(yoff - halo, 0)
+        x1 = min(xoff + xsize + halo, self.target_grid.x_size)
+        y1 = min(yoff + ysize + halo, self.target_grid.y_size)
+        crop = (slice(yoff - y0, yoff - y0 + ysize),
+                slice(xoff - x0, xoff - x0 + xsize))
+        return (x0, y0, x1 - x0, y1 - y0), crop
+
+    def _read_warped_stack(self, this_file, variable_names, window=None):
+        """
+        read several variables of a netCDF4 file on the state_mask grid (or
+        on a window of it) in one go: with the index map of each source grid
+        (variables sharing a grid share one map), or with one gdal.Warp of
+        a VRT stacking the variables as bands when they share a grid
+        """
+        handles = [self._open_band(this_file, variable_name)
+                   for variable_name in variable_names]
+        resampler = self._get_resampler(window)
+        # the incidence angle may not be on the grid of the backscatter
+        if resampler is not None:
+            return np.array([resampler.resample(handle)
+                             for handle in handles])
+        if len(set(source_grid_key(handle, self.target_grid)
+                   for handle in handles)) > 1:
+            self._target_grid_lookups += len(handles)
+            return np.array([reproject_image(handle, self.target_grid,
+                                             window=window).ReadAsArray()
+                             for handle in handles])
+        vrt = gdal.BuildVRT('', handles, separate=True)
+        if vrt is None:
+            raise ValueError("Something failed with GDAL!")
+        self._target_grid_lookups += 1
+        return reproject_image(vrt, self.target_grid,
+                               window=window).ReadAsArray()
+
+    def _cube_bands(self):
+        """bands of the cube: all the polarisations found and theta"""
+        polarisations = [polarisation for polarisation in POLARISATIONS
+                         if any(polarisation in self.catalogue[fich]['polarisations']
+                                for fich in self.files())]
+        return polarisations + ['theta']
+
+    def files(self):
+        """sorted list of the selected files"""
+        return [self.date_data[the_date] for the_date in self.dates]
+
+    def dates_between(self, t0=None, t1=None):
+        """sorted dates of the selected scenes from t0 to t1 (included)"""
+        return self.date_index.between(t0, t1)
+
+    def nearest_date(self, t):
+        """date of the selected scene closest to t"""
+        return self.date_index.nearest(t)
+
+    def query(self, t0=None, t1=None, orbitdirection=None,
+              relativeorbit=None, satellite=None):
+        """
+        sorted dates of the selected scenes from t0 to t1 (included) that
+        also match the given metadata filters (see match_record)
+        """
+        return [the_date for the_date in self.date_index.between(t0, t1)
+                if match_record(self.catalogue[self.date_data[the_date]],
+                                orbitdirection, relativeorbit, satellite)]
+
+    def _cube_folder(self):
+        """folder of the cube of the selected scenes and state_mask grid"""
+        description = {
+            'files': [[fich, self.catalogue[fich]['size'],
+                       self.catalogue[fich]['mtime']]
+                      for fich in self.files()],
+            'grid': [list(self.target_grid.geotransform),
+                     self.target_grid.x_size, self.target_grid.y_size,
+                     self.target_grid.projection],
+            'bands': self._cube_bands()}
+        key = hashlib.sha1(json.dumps(description, sort_keys=True)
+                           .encode('utf-8')).hexdigest()
+        return os.path.join(self.cube_dir, key)
+
+    def _open_cube(self):
+        """memory-map the cube if it has been completely built"""
+        folder = self._cube_folder()
+        # cube.json is written last, partially built cubes are not used
+        self.cube = None
+        if not all(os.path.exists(os.path.join(folder, fname))
+                   for fname in ['cube.json', 'data.npy', 'mask.npy']):
+            return
+        with open(os.path.join(folder, 'cube.json'), 'r') as fp:
+            description = json.load(fp)
+        self.cube = {
+            'data': np.load(os.path.join(folder, 'data.npy'), mmap_mode='r'),
+            'mask': np.load(os.path.join(folder, 'mask.npy'), mmap_mode='r'),
+            'bands': description['bands'],
+            'dates': dict((parser.parse(date), i)
+                          for i, date in enumerate(description['dates']))}
+
+    def build_cube(self):
+        """
+        write the cube of warped observations (if not already built) and
+        open it. Dates are written one by one, so only one date is held in
+        memory. Polarisations missing in a scene are set to WRONG_VALUE and
+        masked.
+        """
+        if self.cube_dir is None:
+            raise ValueError("No cube_dir given!")
+        if not self.dates:
+            raise ValueError("No scenes selected, the cube would be empty!")
+        if self.cube is not None:
+            return
+        folder = self._cube_folder()
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        bands = self._cube_bands()
+        dates = sorted(self.dates)
+        shape = (len(dates), len(bands), self.target_grid.y_size,
+                 self.target_grid.x_size)
+        data = mask = None
+        for i, timestep in enumerate(dates):
+            sardata = self.get_observation(timestep)
+            if data is None:
+                data = np.lib.format.open_memmap(
+                    os.path.join(folder, 'data.npy'), mode='w+',
+                    dtype=sardata.observations.dtype, shape=shape)
+                mask = np.lib.format.open_memmap(
+                    os.path.join(folder, 'mask.npy'), mode='w+',
+                    dtype=bool, shape=shape)
+            data[i] = WRONG_VALUE
+            mask[i] = False
+            for j, polarisation in enumerate(sardata.metadata['polarisations']):
+                data[i, bands.index(polarisation)] = sardata.observations[j]
+                mask[i, bands.index(polarisation)] = sardata.mask[j]
+            data[i, -1] = sardata.metadata['incidence_angle']
+            mask[i, -1] = True
+        data.flush()
+        mask.flush()
+        del data, mask
+        with open(os.path.join(folder, 'cube.json'), 'w') as fp:
+            json.dump({'bands': bands,
+                       'dates': [timestep.isoformat() for timestep in dates]},
+                      fp)
+        self._open_cube()
+
+    def _cube_slice(self, timestep, bands, window=None):
+        """
+        views of the cube for one timestep and a list of bands: data and
+        mask, (n_bands, ny, nx). Consecutive bands are not copied.
+        """
+        i = self.cube['dates'][timestep]
+        index = [self.cube['bands'].index(band) for band in bands]
+        if index == list(range(index[0], index[0] + len(index))):
+            index = slice(index[0], index[0] + len(index))
+        if window is None:
+            rows = cols = slice(None)
+        else:
+            xoff, yoff, xsize, ysize = window
+            rows, cols = slice(yoff, yoff + ysize), slice(xoff, xoff + xsize)
+        return self.cube['data'][i, index, rows, cols], \
+            self.cube['mask'][i, index, rows, cols]
+
+    def get_observation(self, timestep, window=None, compact=False):
+        """
+        get all polarisations and the incidence angle of one timestep,
+        reading (and warping) them together
+
+
+        Input
+        ------
+        timestep
+        window ((xoff, yoff, xsize, ysize) pixel window of the state_mask
+        to read, None for all of it)
+        compact (if True, only keep the pixels valid in all polarisations:
+        observations are (n_bands, n_valid), the incidence angle (n_valid,),
+        the uncertainties are n_valid x n_valid, and mask is the PixelIndex
+        to scatter results back to the grid)
+
+        Output
+        ------
+        sardata (namedtuple with information on observations, uncertainty, mask, metadata, emulator/used model)
+            - observations: (n_bands, ny, nx) array, bands ordered as
+              metadata['polarisations']
+            - uncertainty: list with the DiagonalPrecision of each band
+            - mask: (n_bands, ny, nx) array
+            - metadata: incidence_angle, frequency and polarisations
+            - emulator: list with the emulator of each band
+        """
+        this_file = self.date_data[timestep]
+        record = self.catalogue[this_file]
+        polarisations = [polarisation for polarisation in POLARISATIONS
+                         if polarisation in record['polarisations']]
+
+        # Read a halo around the window for the ENL of its edges
+        read_window, crop = self._halo_window(window)
+        if self.cube is not None:
+            observations, mask = self._cube_slice(timestep, polarisations,
+                                                  read_window)
+            incidence_angle = self._cube_slice(timestep, ['theta'],
+                                               read_window)[0][0]
+        else:
+            variable_names = [record['polarisations'][polarisation]
+                              for polarisation in polarisations]
+            variable_names.append(self._get_variable_name(this_file, 'theta'))
+            data = self._read_warped_stack(this_file, variable_names,
+                                           read_window)
+            observations = data[:-1]
+            incidence_angle = data[-1]
+            mask = np.empty(observations.shape, dtype=bool)
+            for i, band_data in enumerate(observations):
+                mask[i] = self._get_mask(band_data)
+        uncertainty = []
+        for i, band_data in enumerate(observations):
+            R_mat_sp, _ = self._get_uncertainty(band_data, mask[i], crop)
+            uncertainty.append(R_mat_sp)
+        if crop is not None:
+            observations = observations[(Ellipsis,) + crop]
+            mask = mask[(Ellipsis,) + crop]
+            incidence_angle = incidence_angle[crop]
+        if compact:
+            mask = PixelIndex.from_masks(mask)
+            observations = mask.compact(observations)
+            incidence_angle = mask.compact(incidence_angle)
+            uncertainty = [DiagonalPrecision(mask.compact(R.diagonal()),
+                                             np.ones(mask.n_valid, dtype=bool))
+                           for R in uncertainty]
+
+        emulator = [self.emulators.get(polarisation)
+                    for polarisation in polarisations]
+        frequency = self._get_metadata(this_file)
+        metadata = {'incidence_angle': incidence_angle, 'frequency': float(frequency),
+                    'polarisations': polarisations}
+
+        sardata = SARdata(observations, uncertainty, mask, metadata, emulator)
+        return sardata
+
+    @staticmethod
+    def _observation_nbytes(sardata):
+        """size in bytes of the arrays of a get_observation result"""
+        return sardata.observations.nbytes + sardata.mask.nbytes + \
+            sardata.metadata['incidence_angle'].nbytes + \
+            sum(R.nbytes for R in sardata.uncertainty)
+
+    def iter_observations(self, dates=None, lookahead=2, max_workers=2,
+                          max_bytes=None):
+        """
+        iterate over the observations of all (or some) timesteps in date
+        order, reading the next ones in background threads while the
+        current one is processed
+
+
+        Input
+        ------
+        dates (timesteps to read, by default all of them)
+        lookahead (maximum number of timesteps read ahead)
+        max_workers (number of reading threads)
+        max_bytes (the timesteps read ahead and the current one are limited
+        so that their estimated size stays below max_bytes. The first
+        timestep is read alone to estimate the size; at least one timestep
+        is always read)
+
+        Output
+        ------
+        yields (timestep, sardata) pairs, sardata as returned by
+        get_observation. After the loop, self.prefetch_stats holds the time
+        spent reading, the time the caller waited for data and the reading
+        time hidden behind the caller's processing
+        """
+        dates = sorted(self.dates if dates is None else dates)
+        self.prefetch_stats = {}
+        return prefetch(self.get_observation, dates, lookahead=lookahead,
+                        max_workers=max_workers, max_bytes=max_bytes,
+                        sizeof=self._observation_nbytes,
+                        stats=self.prefetch_stats)
+
+    def iter_tiles(self, timestep, band=None, tile_size=None):
+        """
+        stream the observations of one timestep window by window
+
+
+        Input
+        ------
+        timestep
+        band (band as in get_band_data, or None for all the bands as in
+        get_observation)
+        tile_size (pixels, by default the tile_size of the class)
+
+        Output
+        ------
+        yields ((xoff, yoff, xsize, ysize), sardata) for every window of
+        the state_mask. Only the window (and the halo of its ENL moving
+        windows) is warped
+        """
+        tile_size = tile_size or self.tile_size
+        if tile_size is None:
+            raise ValueError("No tile_size given!")
+        for window in iter_windows(self.target_grid, tile_size):
+            if band is None:
+                yield window, self.get_observation(timestep, window=window)
+            else:
+                yield window, self.get_band_data(timestep, band,
+                                                 window=window)
+
+    def ingest(self, dates=None, n_processes=None, output_dir=None):
+        """
+        warp and read all the (date, band) pairs of the archive on a pool
+        of processes
+
+
+        Input
+        ------
+        dates (timesteps to ingest, by default all of them)
+        n_processes (size of the process pool, by default the number of
+        CPUs)
+        output_dir (if given, every band is saved as
+        <output_dir>/<date>_<band>.npy instead of being returned)
+
+        Output
+        ------
+        IngestResult (namedtuple) with
+            - data: OrderedDict, in date order, of {band: array (or .npy
+              file)} per timestep. Bands are the polarisations and theta
+            - failed: {(timestep, band): error message} of the bands that
+              could not be read, including those whose worker process died
+              (e.g. in GDAL on a corrupt scene). They do not stop the
+              ingestion
+            - stats: number of scenes and bands, elapsed time and
+              throughput in scenes per second
+        """
+        dates = sorted(self.dates if dates is None else dates)
+        if output_dir is not None and not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        cache_dir = self.resampling_cache_dir if self.resampler is not None \
+            else None
+        tasks = []
+        for timestep in dates:
+            this_file = self.date_data[timestep]
+            record = self.catalogue[this_file]
+            bands = [(polarisation, record['polarisations'][polarisation])
+                     for polarisation in POLARISATIONS
+                     if polarisation in record['polarisations']]
+            if record['theta'] is not None:
+                bands.append(('theta', record['theta']))
+            for band, variable_name in bands:
+                output_file = None
+                if output_dir is not None:
+                    output_file = os.path.join(output_dir, '{:s}_{:s}.npy'.format(
+                        timestep.strftime('%Y%m%dT%H%M%S'), band))
+                tasks.append((timestep, (this_file, band, variable_name,
+                                         self.target_grid, cache_dir,
+                                         output_file)))
+
+        data = OrderedDict((timestep, {}) for timestep in dates)
+        failed = {}
+        t0 = time.time()
+        results, errors = run_tasks(_ingest_band, [task for _, task in tasks],
+                                    n_processes)
+        for (timestep, task), result, error in zip(tasks, results, errors):
+            band = task[1]
+            if error is None:
+                _, band_data, error = result
+            if error is None:
+                data[timestep][band] = band_data
+            else:
+                failed[(timestep, band)] = error
+        elapsed = time.time() - t0
+        stats = {'n_scenes': len(dates), 'n_bands': len(tasks),
+                 'n_failed': len(failed), 'elapsed': elapsed,
+                 'scenes_per_second': len(dates) / elapsed if elapsed > 0
+                 else float('inf')}
+        return IngestResult(data, failed, stats)
+
+    def get_band_data(self, timestep, band, window=None, compact=False):
         """
         get all relevant S1 data information for one timestep to get processing done
 
@@ -188,6 +734,12 @@ class S1Observations(object):
         ------
         timestep
         band
+        window ((xoff, yoff, xsize, ysize) pixel window of the state_mask
+        to read, None for all of it)
+        compact (if True, only keep the valid pixels: observations and
+        incidence angle are (n_valid,) arrays, the uncertainty is
+        n_valid x n_valid, and mask is the PixelIndex to scatter results
+        back to the grid)
 
         Output
         ------
@@ -204,29 +756,38 @@ class S1Observations(object):
 
         this_file = self.date_data[timestep]
 
-        variable_name = self._get_variable_name(this_file, polarisation)
-
-        fname = 'NETCDF:"{:s}":{:s}'.format(this_file, variable_name)
-        obs_ptr = reproject_image(fname, self.state_mask)
-        observations = obs_ptr.ReadAsArray()
-        uncertainty = self._calculate_uncertainty(observations)
-        mask = self._get_mask(observations)
-        R_mat = np.zeros_like(observations)
-        R_mat = uncertainty
-        R_mat[np.logical_not(mask)] = 0.
-        N = mask.ravel().shape[0]
-        R_mat_sp = sp.lil_matrix((N, N))
-        R_mat_sp.setdiag(1./(R_mat.ravel())**2)
-        R_mat_sp = R_mat_sp.tocsr()
+        # Read a halo around the window for the ENL of its edges
+        read_window, crop = self._halo_window(window)
+        if self.cube is not None:
+            observations, mask = self._cube_slice(timestep, [polarisation],
+                                                  read_window)
+            observations, mask = observations[0], mask[0]
+            incidence_angle = self._cube_slice(timestep, ['theta'],
+                                               read_window)[0][0]
+            R_mat_sp, mask = self._get_uncertainty(observations, mask, crop)
+        else:
+            variable_name = self._get_variable_name(this_file, polarisation)
+            observations = self._read_warped(this_file, variable_name,
+                                             read_window)
+            R_mat_sp, mask = self._get_uncertainty(observations, crop=crop)
+            variable_name = self._get_variable_name(this_file, 'theta')
+            incidence_angle = self._read_warped(this_file, variable_name,
+                                                read_window)
+        if crop is not None:
+            observations = observations[crop]
+            incidence_angle = incidence_angle[crop]
+        if compact:
+            mask = PixelIndex(mask)
+            observations = mask.compact(observations)
+            incidence_angle = mask.compact(incidence_angle)
+            R_mat_sp = DiagonalPrecision(R_mat_sp.values,
+                                         np.ones(mask.n_valid, dtype=bool))
 
         emulator = self.emulators[polarisation]
 
-        variable_name = self._get_variable_name(this_file, 'theta')
-        fname = 'NETCDF:"{:s}":{:s}'.format(this_file, variable_name)
-        obs_ptr = reproject_image(fname, self.state_mask)
         frequency = self._get_metadata(this_file)
 
-        metadata = {'incidence_angle': obs_ptr.ReadAsArray(), 'frequency': float(frequency)}
+        metadata = {'incidence_angle': incidence_angle, 'frequency': float(frequency)}
 
         sardata = SARdata(observations, R_mat_sp, mask, metadata, emulator)
         return sardata
@@ -1,3 +1,4 @@
 from .version import __version__
 from .optical_forward_model import optical_forward_operator
+from .optical_forward_model import optical_forward_operator_batch
 from .sar_forward_model import sar_observation_operator
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+Bounded least recently used (LRU) cache shared by the forward operators
+"""
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Dictionary-like cache holding at most maxsize items, and at most
+    maxbytes bytes of items. When full, the least recently used items are
+    evicted. Lookups are counted as hits or misses.
+
+    Input
+    ------
+    maxsize: maximum number of items (None for unbounded)
+    maxbytes: maximum total size of the items (None for unbounded)
+    sizeof: function returning the size in bytes of an item. By default, the
+            nbytes of arrays (or of tuples of arrays)
+    """
+
+    def __init__(self, maxsize=128, maxbytes=None, sizeof=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof or _nbytes
+        self._data = OrderedDict()
+        self._sizes = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        """Returns the cached item, marking it as most recently used"""
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Adds an item, evicting the least recently used ones if needed.
+        Items larger than maxbytes are not stored."""
+        size = self.sizeof(value)
+        if key in self._data:
+            self._remove(key)
+        if self.maxbytes is not None and size > self.maxbytes:
+            return
+        self._data[key] = value
+        self._sizes[key] = size
+        self.nbytes += size
+        while (self.maxsize is not None and len(self._data) > self.maxsize) \
+                or (self.maxbytes is not None and
+                    self.nbytes > self.maxbytes):
+            self._remove(next(iter(self._data)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        del self._data[key]
+        self.nbytes -= self._sizes.pop(key)
+
+    def clear(self):
+        """Empties the cache and resets the statistics"""
+        self._data.clear()
+        self._sizes.clear()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self):
+        """Dictionary with the hits, misses, evictions and size of the
+        cache"""
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / float(lookups) if lookups else 0.,
+                "evictions": self.evictions, "size": len(self._data),
+                "maxsize": self.maxsize, "nbytes": self.nbytes,
+                "maxbytes": self.maxbytes}
+
+
+def _nbytes(value):
+    """Size in bytes of an array, or of a tuple/list of arrays"""
+    if isinstance(value, (tuple, list)):
+        return sum(_nbytes(item) for item in value)
+    return getattr(value, "nbytes", 0)
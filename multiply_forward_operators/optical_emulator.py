@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+"""Fast emulators of the optical forward operator.
+A Gaussian process is trained on PROSAIL band reflectances for one
+acquisition geometry, and then predicts the band reflectances and their
+Jacobian for many pixels at once. Emulators can be saved to and loaded from
+disk.
+"""
+import json
+
+import numpy as np
+import scipy.linalg
+from scipy.optimize import minimize
+
+from .optical_forward_model import optical_forward_operator_batch
+from .spectral_response import get_band_names
+
+# Names and default sampling bounds of the state parameters, in the order of
+# optical_forward_operator
+PARAMETER_NAMES = {
+    "PROSAIL_D": ["n", "ant", "cab", "car", "cbrown", "cw", "cm", "lai",
+                  "ala", "rsoil", "psoil"],
+    "PROSAIL_5": ["n", "cab", "car", "cbrown", "cw", "cm", "lai", "ala",
+                  "rsoil", "psoil"]}
+
+PARAMETER_BOUNDS = {"n": (1., 2.5), "ant": (0., 10.), "cab": (10., 80.),
+                    "car": (0., 20.), "cbrown": (0., 1.),
+                    "cw": (0.002, 0.04), "cm": (0.002, 0.02),
+                    "lai": (0., 8.), "ala": (10., 80.), "rsoil": (0.2, 1.5),
+                    "psoil": (0., 1.)}
+
+
+def latin_hypercube(n_samples, x_min, x_max, seed=None):
+    """Latin hypercube sample of ``n_samples`` points between the bounds
+    ``x_min`` and ``x_max``"""
+    rng = np.random.RandomState(seed)
+    n_params = len(x_min)
+    strata = np.array([rng.permutation(n_samples) for _ in range(n_params)]).T
+    u = (strata + rng.uniform(size=(n_samples, n_params))) / n_samples
+    return np.asarray(x_min) + u * (np.asarray(x_max) - np.asarray(x_min))
+
+
+def create_training_set(n_samples, sza, vza, raa, version="PROSAIL_D",
+                        srf="Sentinel2", hspot=0.01, bounds=None, seed=None,
+                        n_processes=None):
+    """Samples the PROSAIL state space with a latin hypercube and runs the
+    batched forward operator on it.
+
+    Input
+    ------
+    n_samples: number of state vectors
+    sza, vza, raa: acquisition geometry [deg]
+    version, hspot: as in optical_forward_operator
+    srf: sensor spectral response of the output bands
+    bounds: dictionary of (min, max) per parameter name, updating
+            PARAMETER_BOUNDS
+    seed: random seed of the sampling
+    n_processes: size of the process pool running PROSAIL
+
+    Output
+    ------
+    x: (n_samples, n_params) state vectors
+    rho: (n_samples, n_bands) band reflectances
+    """
+    param_bounds = dict(PARAMETER_BOUNDS)
+    param_bounds.update(bounds or {})
+    names = PARAMETER_NAMES[version.upper()]
+    x_min, x_max = np.array([param_bounds[name] for name in names]).T
+    x = latin_hypercube(n_samples, x_min, x_max, seed=seed)
+    rho = optical_forward_operator_batch(x, sza, vza, raa, version=version,
+                                         hspot=hspot, srf=srf,
+                                         n_processes=n_processes)
+    return x, rho
+
+
+def _squared_distance(x1, x2):
+    """Squared euclidean distances between the rows of x1 and x2"""
+    d2 = (x1 ** 2).sum(axis=1)[:, None] + (x2 ** 2).sum(axis=1)[None, :] - \
+        2 * x1.dot(x2.T)
+    return np.maximum(d2, 0.)
+
+
+def _negative_log_likelihood(log_params, x, y):
+    """Negative log marginal likelihood of a zero mean GP with a squared
+    exponential kernel (ARD lengthscales and noise variance in log_params),
+    summed over the (standardised) columns of y"""
+    lengthscales = np.exp(log_params[:-1])
+    noise = np.exp(log_params[-1])
+    k = np.exp(-0.5 * _squared_distance(x / lengthscales, x / lengthscales))
+    k[np.diag_indices_from(k)] += noise
+    try:
+        c, lower = scipy.linalg.cho_factor(k, lower=True)
+    except np.linalg.LinAlgError:
+        return 1e10
+    alpha = scipy.linalg.cho_solve((c, lower), y)
+    return 0.5 * (y * alpha).sum() + \
+        y.shape[1] * np.log(np.diag(c)).sum()
+
+
+class OpticalEmulator(object):
+    """
+    Gaussian process emulator of the optical forward operator for one
+    acquisition geometry. All bands share the kernel hyperparameters, and
+    every band has its own GP weights, so predicting all bands of many
+    pixels is a couple of matrix products.
+
+    Use ``OpticalEmulator.train`` (or ``OpticalEmulator.from_prosail``) to
+    build one, and ``OpticalEmulator.load`` to read it back from disk.
+    """
+
+    def __init__(self, x_train, alpha, y_mean, y_std, lengthscales, x_min,
+                 x_max, metadata=None):
+        self.x_train = np.asarray(x_train)
+        self.alpha = np.asarray(alpha)
+        self.y_mean = np.asarray(y_mean)
+        self.y_std = np.asarray(y_std)
+        self.lengthscales = np.asarray(lengthscales)
+        self.x_min = np.asarray(x_min)
+        self.x_max = np.asarray(x_max)
+        self.metadata = metadata or {}
+        self._x_scaled = self.x_train / self.lengthscales
+
+    @property
+    def n_bands(self):
+        return self.alpha.shape[1]
+
+    @property
+    def n_params(self):
+        return self.x_train.shape[1]
+
+    def _normalise(self, x):
+        return (np.asarray(x, dtype=float) - self.x_min) / \
+            (self.x_max - self.x_min)
+
+    @classmethod
+    def train(cls, x, rho, validation_fraction=0.2, max_optimisation=500,
+              seed=None, metadata=None):
+        """
+        Fits the emulator to a training set
+
+        Input
+        ------
+        x: (n_samples, n_params) state vectors
+        rho: (n_samples, n_bands) band reflectances
+        validation_fraction: fraction of the samples kept aside to report the
+                             accuracy of the emulator
+        max_optimisation: at most this many training samples are used to
+                          optimise the kernel hyperparameters
+        seed: random seed of the train/validation split
+        metadata: dictionary stored with the emulator (e.g. geometry)
+
+        Output
+        ------
+        emulator, with the accuracy on the validation samples in
+        emulator.metadata['validation']
+        """
+        x = np.atleast_2d(x)
+        rho = np.asarray(rho).reshape(x.shape[0], -1)
+        rng = np.random.RandomState(seed)
+        order = rng.permutation(x.shape[0])
+        n_validation = int(round(validation_fraction * x.shape[0]))
+        validation, training = order[:n_validation], order[n_validation:]
+
+        x_min, x_max = x.min(axis=0), x.max(axis=0)
+        x_max = np.where(x_max > x_min, x_max, x_min + 1.)
+        xs = (x[training] - x_min) / (x_max - x_min)
+        y_mean = rho[training].mean(axis=0)
+        y_std = rho[training].std(axis=0)
+        y_std[y_std == 0] = 1.
+        ys = (rho[training] - y_mean) / y_std
+
+        # Kernel hyperparameters from the marginal likelihood of a subset
+        subset = slice(0, max_optimisation)
+        log_params0 = np.r_[np.zeros(x.shape[1]), np.log(1e-4)]
+        bounds = [(np.log(0.05), np.log(20.))] * x.shape[1] + \
+            [(np.log(1e-8), np.log(1e-1))]
+        result = minimize(_negative_log_likelihood, log_params0,
+                          args=(xs[subset], ys[subset]), method="L-BFGS-B",
+                          bounds=bounds)
+        lengthscales = np.exp(result.x[:-1])
+        noise = np.exp(result.x[-1])
+
+        xl = xs / lengthscales
+        k = np.exp(-0.5 * _squared_distance(xl, xl))
+        k[np.diag_indices_from(k)] += noise
+        alpha = scipy.linalg.cho_solve(scipy.linalg.cho_factor(k), ys)
+
+        emulator = cls(xs, alpha, y_mean, y_std, lengthscales, x_min, x_max,
+                       metadata=dict(metadata or {}))
+        emulator.metadata["noise"] = float(noise)
+        if n_validation > 0:
+            emulator.metadata["validation"] = emulator.validate(
+                x[validation], rho[validation])
+        return emulator
+
+    @classmethod
+    def from_prosail(cls, n_samples, sza, vza, raa, version="PROSAIL_D",
+                     srf="Sentinel2", hspot=0.01, bounds=None, seed=None,
+                     n_processes=None, **kwargs):
+        """Creates a PROSAIL training set (see create_training_set) and fits
+        an emulator to it"""
+        x, rho = create_training_set(n_samples, sza, vza, raa,
+                                     version=version, srf=srf, hspot=hspot,
+                                     bounds=bounds, seed=seed,
+                                     n_processes=n_processes)
+        metadata = {"sza": sza, "vza": vza, "raa": raa,
+                    "version": version.upper(), "hspot": hspot,
+                    "parameters": PARAMETER_NAMES[version.upper()]}
+        if isinstance(srf, str):
+            metadata["srf"] = srf
+            metadata["bands"] = get_band_names(srf)
+        return cls.train(x, rho, seed=seed, metadata=metadata, **kwargs)
+
+    def predict(self, x, return_jacobian=True, chunk_size=4096):
+        """
+        Predicts band reflectances, and optionally their Jacobian
+
+        Input
+        ------
+        x: (N, n_params) state vectors (or a single state vector)
+        return_jacobian: whether to return the Jacobian
+        chunk_size: pixels processed at once, bounding the size of the
+                    (chunk_size, n_train) kernel matrix
+
+        Output
+        ------
+        rho: (N, n_bands) predicted band reflectances
+        jacobian: (N, n_bands, n_params) derivatives of rho with respect to
+                  the state parameters
+        """
+        xs = np.atleast_2d(self._normalise(x)) / self.lengthscales
+        n_pixels = xs.shape[0]
+        rho = np.empty((n_pixels, self.n_bands))
+        if return_jacobian:
+            jacobian = np.empty((n_pixels, self.n_bands, self.n_params))
+            # alpha_jb * x_jp, to get sum_j k_nj alpha_jb x_jp in one product
+            alpha_x = (self.alpha[:, :, None] *
+                       self._x_scaled[:, None, :]).reshape(
+                           self.x_train.shape[0], -1)
+        for start in range(0, n_pixels, chunk_size):
+            chunk = slice(start, start + chunk_size)
+            k = np.exp(-0.5 * _squared_distance(xs[chunk], self._x_scaled))
+            k_alpha = k.dot(self.alpha)
+            rho[chunk] = self.y_mean + self.y_std * k_alpha
+            if return_jacobian:
+                # dk_nj/dx_np = k_nj * (x_jp - x_np) / l_p (scaled inputs)
+                k_alpha_x = k.dot(alpha_x).reshape(-1, self.n_bands,
+                                                   self.n_params)
+                jacobian[chunk] = (k_alpha_x - k_alpha[:, :, None] *
+                                   xs[chunk, None, :]) / self.lengthscales
+        if return_jacobian:
+            # chain rule from the normalised to the physical state
+            jacobian *= self.y_std[None, :, None] / (self.x_max - self.x_min)
+            return rho, jacobian
+        return rho
+
+    def __call__(self, x):
+        """Same (value, grad) contract as sar_observation_operator"""
+        return self.predict(x, return_jacobian=True)
+
+    def validate(self, x, rho):
+        """Accuracy of the emulator against forward operator runs: RMSE,
+        maximum absolute error and coefficient of determination per band"""
+        rho = np.asarray(rho).reshape(np.atleast_2d(x).shape[0], -1)
+        residuals = self.predict(x, return_jacobian=False) - rho
+        variance = rho.var(axis=0)
+        variance[variance == 0] = 1.
+        return {"rmse": np.sqrt((residuals ** 2).mean(axis=0)).tolist(),
+                "max_abs_error": np.abs(residuals).max(axis=0).tolist(),
+                "r2": (1. - (residuals ** 2).mean(axis=0) /
+                       variance).tolist(),
+                "n_samples": int(rho.shape[0])}
+
+    def save(self, fname):
+        """Saves the emulator to a .npz file"""
+        np.savez(fname, x_train=self.x_train, alpha=self.alpha,
+                 y_mean=self.y_mean, y_std=self.y_std,
+                 lengthscales=self.lengthscales, x_min=self.x_min,
+                 x_max=self.x_max, metadata=json.dumps(self.metadata))
+
+    @classmethod
+    def load(cls, fname):
+        """Loads an emulator saved with OpticalEmulator.save"""
+        f = np.load(fname)
+        return cls(f["x_train"], f["alpha"], f["y_mean"], f["y_std"],
+                   f["lengthscales"], f["x_min"], f["x_max"],
+                   metadata=json.loads(str(f["metadata"])))
@@ -1,22 +1,62 @@
 #!/usr/bin/env python
 """Optical observation operator.
-Just a thin wrapper around PROSPECT+SAIL bindings.
+Just a thin wrapper around PROSPECT+SAIL bindings. The leaf (PROSPECT) and
+canopy (SAIL) stages are run separately, so that leaf spectra can be reused
+across view geometries and canopy structures.
 """
+import multiprocessing
+
+import numpy as np
+
 try:
-    from prosail import run_prosail
+    from prosail import run_prospect, run_sail
 except ImportError:
     raise ImportError("You need the PROSAIL Python bindings from "
                       "http://github.com/jgomezdans/prosail/!")
 
+from .cache import LRUCache
+from .spectral_response import WAVELENGTHS, get_srf_matrix
+
 __author__ = "J Gomez-Dans"
 __copyright__ = "Copyright 2017 J Gomez-Dans"
 __version__ = "1.0 (09.03.2017)"
 __license__ = "GPLv3"
 __email__ = "j.gomez-dans@ucl.ac.uk"
 
+# Leaf reflectance and transmittance spectra, keyed on the PROSPECT version
+# and the leaf parameters
+leaf_spectra_cache = LRUCache(maxsize=1024)
+
+
+def leaf_optical_properties(n, cab, car, cbrown, cw, cm, ant=0.,
+                            prospect_version="D"):
+    """Leaf stage of the operator: runs PROSPECT (version "D" or "5") and
+    returns the leaf reflectance and transmittance between 400 and 2500 nm.
+    Spectra are kept in ``leaf_spectra_cache``, so PROSPECT only runs once
+    for a set of leaf parameters. The returned arrays are read-only."""
+    key = (prospect_version, n, cab, car, cbrown, cw, cm, ant)
+    spectra = leaf_spectra_cache.get(key)
+    if spectra is None:
+        _, refl, trans = run_prospect(n, cab, car, cbrown, cw, cm, ant=ant,
+                                      prospect_version=prospect_version)
+        refl.flags.writeable = False
+        trans.flags.writeable = False
+        spectra = refl, trans
+        leaf_spectra_cache.put(key, spectra)
+    return spectra
+
+
+def canopy_reflectance(refl, trans, lai, ala, hspot, sza, vza, raa, rsoil,
+                       psoil):
+    """Canopy stage of the operator: runs SAIL on leaf spectra and returns
+    the top of canopy reflectance between 400 and 2500 nm"""
+    return run_sail(refl, trans, lai, ala, hspot, sza, vza, raa,
+                    rsoil=rsoil, psoil=psoil)
+
 
 def optical_forward_operator(x, sza, vza, raa, version="PROSAIL_D",
-                             hspot=0.01):
+                             hspot=0.01, srf=None, return_jacobian=False,
+                             fd_scheme="forward", fd_step=None):
     """A generic wrapper to the PROSPECT+SAIL operators. Uses either PROSPECT D
     or PROSPECT 5. The state vector is given as a 1D vector, with parameters
     in order:
@@ -34,21 +74,258 @@ def optical_forward_operator(x, sza, vza, raa, version="PROSAIL_D",
 
     Additionally, one needs to pass the different view/illumination angles, and
     optionally the value of the hotspot parameter. The function returns the
-    top of canopy reflectance between 400 and 2500 nm every 1 nm.
+    top of canopy reflectance between 400 and 2500 nm every 1 nm. If a sensor
+    spectral response ``srf`` is given (a built-in sensor name such as
+    "Sentinel2" or "Landsat8", an (n_bands, 2101) array or a sparse matrix,
+    see ``spectral_response.get_srf_matrix``), the band reflectances are
+    returned instead.
+
+    With ``return_jacobian``, the function returns ``(rho, grad)`` like the
+    SAR operator, where ``grad`` is the (n_wavelengths or n_bands, n_params)
+    finite difference Jacobian (see ``optical_forward_operator_batch``).
     """
     if not version.upper() in ["PROSAIL_D", "PROSAIL_5"]:
         raise ValueError("Can only deal with SAIL + PROSPECT D or 5!")
 
+    if return_jacobian:
+        rho_canopy, grad = optical_forward_operator_batch(
+            np.atleast_2d(x), sza, vza, raa, version=version, hspot=hspot,
+            srf=srf, n_processes=1, return_jacobian=True,
+            fd_scheme=fd_scheme, fd_step=fd_step)
+        return rho_canopy[0], grad[0]
+
     if version.upper() == "PROSAIL_D":
         # Using prospect D
         n, ant, cab, car, cbrown, cw, cm, lai, ala, rsoil, psoil = x
-        rho_canopy = run_prosail(n, cab, car,  cbrown, cw, cm, lai, ala, hspot,
-                                 sza, vza, raa, ant=ant, prospect_version="D",
-                                 rsoil=rsoil, psoil=psoil)
+        refl, trans = leaf_optical_properties(n, cab, car, cbrown, cw, cm,
+                                              ant=ant, prospect_version="D")
 
     elif version.upper() == "PROSAIL_5":
         n, cab, car, cbrown, cw, cm, lai, ala, rsoil, psoil = x
-        rho_canopy = run_prosail(n, cab, car,  cbrown, cw, cm, lai, ala, hspot,
-                                 sza, vza, raa, prospect_version="5",
-                                 rsoil=rsoil, psoil=psoil)
+        refl, trans = leaf_optical_properties(n, cab, car, cbrown, cw, cm,
+                                              prospect_version="5")
+    rho_canopy = canopy_reflectance(refl, trans, lai, ala, hspot, sza, vza,
+                                    raa, rsoil, psoil)
+    if srf is not None:
+        rho_canopy = get_srf_matrix(srf).dot(rho_canopy)
+    return rho_canopy
+
+
+def _optical_forward_chunk(args):
+    """Runs the optical forward operator on a chunk of state vectors and
+    geometries. Defined at module level so that it can be sent to the
+    workers of a process pool."""
+    x, sza, vza, raa, version, hspot, srf = args
+    rho_canopy = np.array([optical_forward_operator(x[i], sza[i], vza[i],
+                                                    raa[i], version=version,
+                                                    hspot=hspot)
+                           for i in range(x.shape[0])])
+    if srf is not None:
+        rho_canopy = srf.dot(rho_canopy.T).T
     return rho_canopy
+
+
+def _run_batch(x, sza, vza, raa, version, hspot, srf, n_processes,
+               chunk_size, pool=None):
+    """Evaluates the rows of x in chunks on a pool of processes (the given
+    pool, or one started for this call)"""
+    n_pixels = x.shape[0]
+    if n_pixels == 0:
+        # e.g. a tile without valid pixels
+        n_out = WAVELENGTHS.size if srf is None else srf.shape[0]
+        return np.empty((0, n_out))
+    sza, vza, raa = [np.broadcast_to(angle, (n_pixels,))
+                     for angle in (sza, vza, raa)]
+    chunks = [(x[i:i + chunk_size], sza[i:i + chunk_size],
+               vza[i:i + chunk_size], raa[i:i + chunk_size], version, hspot,
+               srf)
+              for i in range(0, n_pixels, chunk_size)]
+    if pool is not None:
+        return np.concatenate(list(pool.map(_optical_forward_chunk, chunks)),
+                              axis=0)
+    if n_processes is None:
+        n_processes = multiprocessing.cpu_count()
+    n_processes = min(n_processes, len(chunks))
+    if n_processes <= 1:
+        rho_canopy = [_optical_forward_chunk(chunk) for chunk in chunks]
+    else:
+        pool = multiprocessing.Pool(n_processes)
+        try:
+            rho_canopy = pool.map(_optical_forward_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    return np.concatenate(rho_canopy, axis=0)
+
+
+def optical_forward_operator_batch(x, sza, vza, raa, version="PROSAIL_D",
+                                   hspot=0.01, srf=None, n_processes=None,
+                                   chunk_size=256, return_jacobian=False,
+                                   fd_scheme="forward", fd_step=None,
+                                   pixel_index=None, pool=None):
+    """Runs the optical forward operator on many pixels. The state is given
+    as an (N, n_params) array, with one state vector (in the order of
+    ``optical_forward_operator``) per row, and the angles can be either
+    scalars or arrays of N elements. The rows are split into chunks of
+    ``chunk_size`` pixels that are spread over a pool of ``n_processes``
+    processes (by default, as many as CPUs; with 1 process, no pool is
+    started). Starting a pool costs more than a small batch, so callers
+    running many batches (e.g. a LUT build or the iterations of a solver)
+    should pass their own ``pool``: a ``multiprocessing.Pool`` or a
+    ``concurrent.futures`` executor, which is used instead of
+    ``n_processes`` and left open. Returns an (N, n_wavelengths) array with the same values as
+    calling ``optical_forward_operator`` on every row, or an (N, n_bands)
+    array if a spectral response ``srf`` is given. The band integration is
+    done by the workers, so full spectra are never gathered.
+
+    With ``return_jacobian``, returns ``(rho, grad)`` where ``grad`` is the
+    (N, n_wavelengths or n_bands, n_params) Jacobian, approximated with
+    ``fd_scheme`` "forward" or "central" finite differences. ``fd_step`` is
+    the absolute step of every parameter (a scalar or an n_params array); by
+    default it is 1e-6 (forward) or 1e-4 (central) times max(|x|, 1e-2). All
+    perturbed states are evaluated in the same batch as the unperturbed one,
+    and the perturbations of a pixel share the chunk of that pixel, so
+    perturbations of canopy parameters reuse its cached leaf spectra.
+
+    With a ``pixel_index`` (a ``PixelIndex``), the state and per-pixel angles
+    can also be given on the full grid (e.g. as (ny, nx, n_params) and
+    (ny, nx) arrays). Only the valid pixels are run, and the outputs have
+    one row per valid pixel (none if no pixel is valid).
+    """
+    if pixel_index is not None:
+        x = pixel_index.compact(x, axis=0)
+        sza, vza, raa = [angle if np.ndim(angle) == 0 else
+                         pixel_index.compact(angle, axis=0)
+                         for angle in (sza, vza, raa)]
+    x = np.atleast_2d(x)
+    if srf is not None:
+        srf = get_srf_matrix(srf)
+    if not return_jacobian:
+        return _run_batch(x, sza, vza, raa, version, hspot, srf, n_processes,
+                          chunk_size, pool)
+
+    if fd_scheme not in ["forward", "central"]:
+        raise ValueError("fd_scheme can only be forward or central!")
+    n_pixels, n_params = x.shape
+    if fd_step is None:
+        rel_step = 1e-6 if fd_scheme == "forward" else 1e-4
+        fd_step = rel_step * np.maximum(np.abs(x), 1e-2)
+    fd_step = np.broadcast_to(np.asarray(fd_step, dtype=float), x.shape)
+    # States of every pixel: unperturbed, +step for every parameter, and for
+    # central differences -step for every parameter
+    signs = [1.] if fd_scheme == "forward" else [1., -1.]
+    perturbation = np.concatenate(
+        [np.zeros((n_pixels, 1, n_params))] +
+        [sign * fd_step[:, None, :] * np.eye(n_params)[None, :, :]
+         for sign in signs], axis=1)
+    n_states = perturbation.shape[1]
+    x_all = (x[:, None, :] + perturbation).reshape(-1, n_params)
+    sza, vza, raa = [np.repeat(np.broadcast_to(angle, (n_pixels,)), n_states)
+                     for angle in (sza, vza, raa)]
+    rho_all = _run_batch(x_all, sza, vza, raa, version, hspot, srf,
+                         n_processes, chunk_size * n_states, pool)
+    rho_all = rho_all.reshape(n_pixels, n_states, rho_all.shape[1])
+    rho_canopy = rho_all[:, 0, :]
+    if fd_scheme == "forward":
+        delta = rho_all[:, 1:, :] - rho_canopy[:, None, :]
+        grad = delta / fd_step[:, :, None]
+    else:
+        delta = rho_all[:, 1:n_params + 1, :] - rho_all[:, n_params + 1:, :]
+        grad = delta / (2 * fd_step[:, :, None])
+    return rho_canopy, grad.transpose(0, 2, 1)
+
+
+class CachedOpticalOperator(object):
+    """Optical forward operator with a bounded memoisation cache. Spectra
+    are cached on the state vector, the angles, the PROSAIL version and the
+    hotspot parameter, so repeated evaluations (homogeneous fields, line
+    search re-evaluations...) only run PROSAIL once.
+
+    Inputs can be quantised before they are looked up: with a
+    ``state_quantum`` (a scalar or an n_params array) and an
+    ``angle_quantum`` (in degrees), all the inputs rounding to the same grid
+    point share one cache entry, and the operator is evaluated on that grid
+    point. By default inputs are used as they are. The cache holds at most
+    ``maxsize`` spectra and ``maxbytes`` bytes (64 MB by default), evicting
+    the least recently used ones, and ``stats()`` reports hits and misses.
+    """
+
+    def __init__(self, version="PROSAIL_D", hspot=0.01, state_quantum=None,
+                 angle_quantum=None, maxsize=None, maxbytes=64 * 2 ** 20):
+        if not version.upper() in ["PROSAIL_D", "PROSAIL_5"]:
+            raise ValueError("Can only deal with SAIL + PROSPECT D or 5!")
+        self.version = version.upper()
+        self.hspot = hspot
+        self.state_quantum = state_quantum
+        self.angle_quantum = angle_quantum
+        self.cache = LRUCache(maxsize=maxsize, maxbytes=maxbytes)
+
+    @staticmethod
+    def _quantise(values, quantum):
+        values = np.asarray(values, dtype=float)
+        if quantum is None:
+            return values
+        return np.round(values / quantum) * quantum
+
+    def _keys(self, x, sza, vza, raa):
+        """Quantised states, angles and the cache keys of every row"""
+        x = self._quantise(np.atleast_2d(x), self.state_quantum)
+        angles = self._quantise(
+            np.array([np.broadcast_to(angle, (x.shape[0],))
+                      for angle in (sza, vza, raa)]).T, self.angle_quantum)
+        keys = [(self.version, self.hspot) + tuple(state) + tuple(angle)
+                for state, angle in zip(x.tolist(), angles.tolist())]
+        return x, angles, keys
+
+    def __call__(self, x, sza, vza, raa, srf=None):
+        """Cached ``optical_forward_operator`` for one state vector"""
+        x_q, angles, keys = self._keys(x, sza, vza, raa)
+        rho_canopy = self.cache.get(keys[0])
+        if rho_canopy is None:
+            rho_canopy = optical_forward_operator(
+                x_q[0], angles[0, 0], angles[0, 1], angles[0, 2],
+                version=self.version, hspot=self.hspot)
+            rho_canopy.flags.writeable = False
+            self.cache.put(keys[0], rho_canopy)
+        if srf is not None:
+            return get_srf_matrix(srf).dot(rho_canopy)
+        return rho_canopy.copy()
+
+    def batch(self, x, sza, vza, raa, srf=None, n_processes=None,
+              chunk_size=256, pool=None):
+        """Cached ``optical_forward_operator_batch``: only the distinct
+        states that are not in the cache are sent to the process pool (an
+        existing ``pool``, or one of ``n_processes``)"""
+        x_q, angles, keys = self._keys(x, sza, vza, raa)
+        rho_canopy = [self.cache.get(key) for key in keys]
+        missing = {}
+        for i, key in enumerate(keys):
+            if rho_canopy[i] is None:
+                missing.setdefault(key, []).append(i)
+        if missing:
+            rows = [index[0] for index in missing.values()]
+            rho_missing = optical_forward_operator_batch(
+                x_q[rows], angles[rows, 0], angles[rows, 1], angles[rows, 2],
+                version=self.version, hspot=self.hspot,
+                n_processes=n_processes, chunk_size=chunk_size, pool=pool)
+            for (key, index), rho in zip(missing.items(), rho_missing):
+                # A row of rho_missing would keep the whole batch alive
+                rho = rho.copy()
+                rho.flags.writeable = False
+                self.cache.put(key, rho)
+                for i in index:
+                    rho_canopy[i] = rho
+                # Repeated states of the batch did not run PROSAIL either
+                self.cache.misses -= len(index) - 1
+                self.cache.hits += len(index) - 1
+        rho_canopy = np.array(rho_canopy)
+        if srf is not None:
+            return get_srf_matrix(srf).dot(rho_canopy.T).T
+        return rho_canopy
+
+    def stats(self):
+        """Hits, misses, hit rate, evictions and memory use of the cache"""
+        return self.cache.stats()
+
+    def clear(self):
+        self.cache.clear()
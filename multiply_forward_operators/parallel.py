@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+"""
+Background reading of observations with a bounded read-ahead, and process
+pools that survive workers dying in native code
+"""
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+WORKER_DIED = 'BrokenProcessPool: the worker process died'
+
+
+def _timed_call(function, item):
+    """result of function(item) and the time it took"""
+    t0 = time.time()
+    value = function(item)
+    return value, time.time() - t0
+
+
+def prefetch(function, items, lookahead=2, max_workers=2, max_bytes=None,
+             sizeof=None, stats=None):
+    """
+    Calls function on every item in background threads, reading the next
+    items while the caller processes the current one.
+
+    With max_bytes, the results read ahead and the one held by the caller
+    are limited so that their estimated size (that of the largest result so
+    far) stays below max_bytes. Until the first result is known, only one
+    item is read. At least one item is always read, so that the loop
+    progresses when a single result is larger than max_bytes. The caller
+    must drop its reference to a result before asking for the next one
+    for the limit to hold.
+
+    Input
+    ------
+    function: called with every item
+    items: sequence of items
+    lookahead: maximum number of items read ahead
+    max_workers: number of reading threads
+    max_bytes: maximum size in bytes of the results in memory, None for no
+               limit
+    sizeof: function returning the size in bytes of a result, by default
+            its nbytes
+    stats: dictionary updated with the number of items, the time spent
+           reading, the time the caller waited for data and the reading time
+           hidden behind the caller's processing
+
+    Output
+    ------
+    yields (item, result) pairs in the order of items
+    """
+    items = list(items)
+    if sizeof is None:
+        sizeof = lambda value: value.nbytes
+    if stats is None:
+        stats = {}
+    stats.update({'n_items': 0, 'read_time': 0., 'wait_time': 0.,
+                  'hidden_time': 0.})
+    pending = deque()
+    state = {'next': 0, 'size': None}
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def fill(held):
+        """submit items while the results in memory (held by the caller,
+        read or being read) fit in max_bytes"""
+        while state['next'] < len(items) and len(pending) < lookahead:
+            if max_bytes is not None and (pending or held):
+                in_memory = len(pending) + held + 1
+                if state['size'] is None or \
+                        state['size'] * in_memory > max_bytes:
+                    break
+            item = items[state['next']]
+            pending.append((item, executor.submit(_timed_call, function,
+                                                  item)))
+            state['next'] += 1
+
+    try:
+        while state['next'] < len(items) or pending:
+            fill(held=0)
+            item, future = pending.popleft()
+            t0 = time.time()
+            value, read_time = future.result()
+            # the future would keep the result alive after the caller
+            # drops it
+            del future
+            stats['wait_time'] += time.time() - t0
+            stats['read_time'] += read_time
+            stats['n_items'] += 1
+            stats['hidden_time'] = max(0., stats['read_time'] -
+                                       stats['wait_time'])
+            state['size'] = max(state['size'] or 0, sizeof(value))
+            fill(held=1)
+            yield item, value
+            # only the caller may hold the result now
+            del value
+    finally:
+        for _, future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def _error_message(error):
+    return '{:s}: {:s}'.format(type(error).__name__, str(error))
+
+
+def _run_pool(function, tasks, index, n_processes, results, errors):
+    """
+    run function on tasks[i], for i in index, on one pool of processes,
+    filling results and errors. When a worker dies, all the unfinished
+    tasks of the pool are lost: they are returned as (tasks that had
+    started, tasks that had not)
+    """
+    executor = ProcessPoolExecutor(n_processes)
+    futures = {}
+    lost, started = set(), set()
+    try:
+        for i in index:
+            try:
+                futures[executor.submit(function, tasks[i])] = i
+            except BrokenProcessPool:
+                lost.add(i)
+        pending = set(futures)
+        while pending:
+            started.update(futures[future] for future in pending
+                           if future.running())
+            done, pending = wait(pending, timeout=0.1,
+                                 return_when=FIRST_COMPLETED)
+            for future in done:
+                i = futures[future]
+                try:
+                    results[i] = future.result()
+                except BrokenProcessPool:
+                    lost.add(i)
+                except Exception as error:
+                    errors[i] = _error_message(error)
+    finally:
+        executor.shutdown(wait=True)
+    return sorted(lost & started), sorted(lost - started)
+
+
+def run_tasks(function, tasks, n_processes=None, max_retries=2):
+    """
+    Runs function on every task on a pool of processes. Exceptions and
+    workers that die (e.g. a segmentation fault in GDAL) are recorded as
+    failures of their task, and the other tasks complete.
+
+    A dead worker breaks the pool, and all its unfinished tasks are lost.
+    The lost tasks that had started are run again one by one, each on its
+    own process, so that the task that killed its worker is found. The
+    others are run again on a new pool (at most max_retries times, then one
+    by one too).
+
+    Input
+    ------
+    function: picklable function called with every task
+    tasks: sequence of picklable tasks
+    n_processes: size of the pool, by default the number of CPUs
+    max_retries: number of pools a task that never started may be lost in
+
+    Output
+    ------
+    results: list of the results in task order, None for failed tasks
+    errors: list of the error messages in task order, None for successful
+            tasks
+    """
+    tasks = list(tasks)
+    results = [None] * len(tasks)
+    errors = [None] * len(tasks)
+    n_lost = [0] * len(tasks)
+    todo = list(range(len(tasks)))
+    while todo:
+        started, not_started = _run_pool(function, tasks, todo, n_processes,
+                                         results, errors)
+        for i in not_started:
+            n_lost[i] += 1
+        todo = [i for i in not_started if n_lost[i] <= max_retries]
+        for i in started + [i for i in not_started if n_lost[i] > max_retries]:
+            if any(_run_pool(function, tasks, [i], 1, results, errors)):
+                errors[i] = WORKER_DIED
+    return results, errors
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""
+Index of the valid pixels of a raster, to evaluate observations and
+operators on the valid pixels only
+"""
+
+import numpy as np
+
+
+class PixelIndex(object):
+    """
+    Valid pixels of a raster grid
+
+    compact() takes the valid pixels of full grid arrays (a 1D array of the
+    valid pixels in row-major order), and scatter() puts compact arrays back
+    on the grid. Compute and memory of everything in between scale with the
+    number of valid pixels rather than with the size of the raster.
+
+    The pixels can be either the trailing axes of an array (axis=-1, e.g.
+    (n_bands, ny, nx) observations or the (n_state, ny, nx) SAR state) or
+    its leading axes (axis=0, e.g. the (ny, nx, n_params) optical state).
+    Arrays that are already compact are returned as they are. An array is
+    taken to be on the grid whenever its pixel axes have the grid shape.
+
+    Input
+    ------
+    mask (boolean array with the grid shape, True for valid pixels)
+    """
+
+    def __init__(self, mask):
+        mask = np.asarray(mask, dtype=bool)
+        self.shape = mask.shape
+        self.size = mask.size
+        self.mask = mask.ravel()
+        self.index = np.flatnonzero(self.mask)
+
+    @classmethod
+    def from_masks(cls, masks):
+        """index of the pixels valid in all masks (e.g. all bands)"""
+        masks = np.asarray(masks, dtype=bool)
+        return cls(np.logical_and.reduce(masks, axis=0))
+
+    @property
+    def n_valid(self):
+        return self.index.size
+
+    def __len__(self):
+        return self.n_valid
+
+    def _flatten(self, data, axis):
+        """reshape the grid axes of data into a single pixel axis"""
+        ndim = len(self.shape)
+        if axis == 0:
+            if data.shape[:ndim] == self.shape:
+                data = data.reshape((self.size,) + data.shape[ndim:])
+            return data, data.shape[0] if data.ndim else 0
+        elif axis == -1:
+            if data.ndim >= ndim and data.shape[data.ndim - ndim:] == \
+                    self.shape:
+                data = data.reshape(data.shape[:data.ndim - ndim] +
+                                    (self.size,))
+            return data, data.shape[-1] if data.ndim else 0
+        raise ValueError('The pixel axis can only be 0 or -1!')
+
+    def compact(self, data, axis=-1):
+        """
+        valid pixels of data, given on the grid (or flattened)
+
+        Input
+        ------
+        data (array with the pixels as trailing (axis=-1) or leading
+        (axis=0) axes)
+
+        Output
+        ------
+        array with a single pixel axis of n_valid elements
+        """
+        data, n = self._flatten(np.asarray(data), axis)
+        if n == self.size:
+            return np.take(data, self.index, axis=axis)
+        elif n == self.n_valid:
+            return data
+        raise ValueError('Data of {} pixels does not match the grid of {} '
+                         'pixels with {} valid ones!'.format(
+                             n, self.size, self.n_valid))
+
+    def scatter(self, values, fill_value=0., axis=-1):
+        """
+        put compact values back on the grid
+
+        Input
+        ------
+        values (array with a pixel axis of n_valid elements)
+        fill_value (value of the invalid pixels)
+
+        Output
+        ------
+        array with the grid axes in place of the pixel axis
+        """
+        values = np.asarray(values)
+        if axis == 0:
+            out = np.full((self.size,) + values.shape[1:], fill_value,
+                          dtype=values.dtype)
+            out[self.index] = values
+            return out.reshape(self.shape + values.shape[1:])
+        elif axis == -1:
+            out = np.full(values.shape[:-1] + (self.size,), fill_value,
+                          dtype=values.dtype)
+            out[..., self.index] = values
+            return out.reshape(values.shape[:-1] + self.shape)
+        raise ValueError('The pixel axis can only be 0 or -1!')
+
+    def __repr__(self):
+        return '<PixelIndex of {} valid pixels on a {} grid>'.format(
+            self.n_valid, self.shape)
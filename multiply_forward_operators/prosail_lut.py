@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+"""Look-up tables (LUTs) of the optical forward operator.
+Reflectances are precomputed over a grid of state parameters and
+acquisition geometries, stored as a memory-mapped .npy array, and queried
+with multilinear interpolation. Processes that open the same LUT share its
+pages through the OS page cache instead of holding private copies.
+"""
+import itertools
+import json
+import multiprocessing
+import os
+
+import numpy as np
+
+from .optical_forward_model import optical_forward_operator_batch
+from .optical_emulator import PARAMETER_NAMES
+
+GEOMETRY_NAMES = ["sza", "vza", "raa"]
+
+
+def _metadata_fname(fname):
+    return os.path.splitext(fname)[0] + ".json"
+
+
+def build_lut(fname, grid, fixed=None, version="PROSAIL_D", hspot=0.01,
+              srf=None, n_processes=None, chunk_size=4096, pool=None):
+    """
+    Builds a LUT of the optical forward operator
+
+    Input
+    ------
+    fname: output .npy file. The grid description is written next to it,
+           with a .json extension
+    grid: list of (name, nodes) pairs, or an OrderedDict, with the
+          increasing nodes of every gridded variable. Names are the state
+          parameter names of optical_emulator.PARAMETER_NAMES or sza, vza
+          and raa
+    fixed: dictionary with the values of the variables that are not
+           gridded. The values it has for gridded variables are ignored, so
+           a full dictionary of defaults may be given
+    version, hspot, srf: as in optical_forward_operator
+    n_processes: size of the process pool running PROSAIL. One pool is
+                 started for the whole table
+    chunk_size: number of grid points computed (and held in memory) at once
+    pool: existing process pool (or executor) to use instead
+
+    Output
+    ------
+    ProsailLUT reading the new table
+    """
+    grid = [(name, np.asarray(nodes, dtype=float))
+            for name, nodes in (grid.items() if hasattr(grid, "items")
+                                else grid)]
+    names = PARAMETER_NAMES[version.upper()] + GEOMETRY_NAMES
+    grid_names = [name for name, _ in grid]
+    fixed = dict((name, value) for name, value in (fixed or {}).items()
+                 if name not in grid_names)
+    for name in grid_names:
+        if name not in names:
+            raise ValueError("Unknown LUT variable {:s}!".format(name))
+    missing = [name for name in names
+               if name not in grid_names and name not in fixed]
+    if missing:
+        raise ValueError("No grid nodes or fixed values for " +
+                         ", ".join(missing))
+
+    shape = tuple(nodes.size for _, nodes in grid)
+    n_points = int(np.prod(shape))
+    own_pool = None
+    if pool is None and n_processes != 1 and n_points > chunk_size:
+        own_pool = pool = multiprocessing.Pool(n_processes)
+    try:
+        lut = _fill_lut(fname, grid, fixed, names, grid_names, shape,
+                        n_points, version, hspot, srf, n_processes,
+                        chunk_size, pool)
+    finally:
+        if own_pool is not None:
+            own_pool.close()
+            own_pool.join()
+    lut.flush()
+    del lut
+
+    metadata = {"grid": [(name, nodes.tolist()) for name, nodes in grid],
+                "fixed": fixed, "version": version.upper(), "hspot": hspot,
+                "srf": srf if isinstance(srf, str) else None}
+    with open(_metadata_fname(fname), "w") as fp:
+        json.dump(metadata, fp)
+    return ProsailLUT(fname)
+
+
+def _fill_lut(fname, grid, fixed, names, grid_names, shape, n_points,
+              version, hspot, srf, n_processes, chunk_size, pool):
+    """computes the LUT chunk by chunk into a new .npy file"""
+    lut = None
+    for start in range(0, n_points, chunk_size):
+        flat_index = np.arange(start, min(start + chunk_size, n_points))
+        grid_index = np.unravel_index(flat_index, shape)
+        values = dict((name, np.full(flat_index.size, fixed[name], float))
+                      for name in names if name not in grid_names)
+        for (name, nodes), index in zip(grid, grid_index):
+            values[name] = nodes[index]
+        x = np.array([values[name]
+                      for name in PARAMETER_NAMES[version.upper()]]).T
+        rho = optical_forward_operator_batch(
+            x, values["sza"], values["vza"], values["raa"], version=version,
+            hspot=hspot, srf=srf, n_processes=n_processes, pool=pool)
+        if lut is None:
+            lut = np.lib.format.open_memmap(fname, mode="w+",
+                                            dtype=np.float64,
+                                            shape=(n_points, rho.shape[1]))
+        lut[flat_index] = rho
+    return lut
+
+
+class ProsailLUT(object):
+    """
+    Memory-mapped LUT written by build_lut. Pickling a ProsailLUT (e.g. to
+    send it to the workers of a process pool) only pickles its file name,
+    every process then maps the same file.
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        with open(_metadata_fname(fname), "r") as fp:
+            self.metadata = json.load(fp)
+        self.names = [name for name, _ in self.metadata["grid"]]
+        self.nodes = [np.array(nodes) for _, nodes in self.metadata["grid"]]
+        self.shape = tuple(nodes.size for nodes in self.nodes)
+        self.table = np.load(fname, mmap_mode="r")
+
+    def __getstate__(self):
+        return {"fname": self.fname}
+
+    def __setstate__(self, state):
+        self.__init__(state["fname"])
+
+    @property
+    def n_outputs(self):
+        return self.table.shape[1]
+
+    def interpolate(self, points):
+        """
+        Multilinear interpolation in the LUT
+
+        Input
+        ------
+        points: (N, n_grid) array of values of the gridded variables, in
+                the order of self.names. Values outside the grid are clamped
+                to its edges
+
+        Output
+        ------
+        (N, n_outputs) interpolated reflectances
+        """
+        points = np.atleast_2d(np.asarray(points, dtype=float))
+        lower, weights = [], []
+        for i, nodes in enumerate(self.nodes):
+            if nodes.size == 1:
+                lower.append(np.zeros(points.shape[0], dtype=int))
+                weights.append(np.zeros(points.shape[0]))
+                continue
+            idx = np.clip(np.searchsorted(nodes, points[:, i]) - 1, 0,
+                          nodes.size - 2)
+            w = (points[:, i] - nodes[idx]) / (nodes[idx + 1] - nodes[idx])
+            lower.append(idx)
+            weights.append(np.clip(w, 0., 1.))
+
+        result = np.zeros((points.shape[0], self.n_outputs))
+        # Only dimensions with more than one node have an upper corner
+        active = [i for i, nodes in enumerate(self.nodes) if nodes.size > 1]
+        for corner in itertools.product((0, 1), repeat=len(active)):
+            index = list(lower)
+            weight = np.ones(points.shape[0])
+            for i, upper in zip(active, corner):
+                if upper:
+                    index[i] = lower[i] + 1
+                    weight = weight * weights[i]
+                else:
+                    weight = weight * (1. - weights[i])
+            flat_index = np.ravel_multi_index(index, self.shape)
+            result += weight[:, None] * self.table[flat_index]
+        return result
+
+    def __call__(self, x, sza, vza, raa, rtol=1e-6):
+        """Interpolates the LUT for (N, n_params) state vectors, in the order
+        of optical_forward_operator, and scalar or per-row angles. Variables
+        that are not gridded must have the fixed values of the LUT (within
+        rtol), otherwise a ValueError is raised"""
+        x = np.atleast_2d(x)
+        values = dict(zip(PARAMETER_NAMES[self.metadata["version"]], x.T))
+        values.update(sza=sza, vza=vza, raa=raa)
+        for name, fixed in self.metadata["fixed"].items():
+            if name in values and \
+                    not np.allclose(values[name], fixed, rtol=rtol, atol=0):
+                raise ValueError("The LUT was built for {:s} = {:g}, it "
+                                 "can't be used for other values!".format(
+                                     name, fixed))
+        points = np.array([np.broadcast_to(values[name], (x.shape[0],))
+                           for name in self.names]).T
+        return self.interpolate(points)
@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+"""
+Resampling of images to a target grid with precomputed index maps.
+
+gdal.Warp (with its default nearest neighbour resampling) takes every target
+pixel from one source pixel. When many images share the same source grid,
+the source pixel of every target pixel is found once, by warping an image of
+pixel indices, and every image is then resampled by NumPy fancy indexing.
+"""
+import hashlib
+import json
+import os
+from collections import namedtuple
+
+import numpy as np
+try:
+    from osgeo import gdal, osr
+except ImportError:
+    import gdal
+    import osr
+
+NO_INDEX = -1
+
+TargetGrid = namedtuple('TargetGrid', 'geotransform x_size y_size projection')
+
+def get_target_grid(target_img):
+    """Reads the geotransform, size and projection (WKT) of an image, so
+    that it can be used as target of reproject_image without opening the
+    image again."""
+    g = gdal.Open(target_img)
+    if g is None:
+        raise ValueError("Can't open {:s} with GDAL!".format(target_img))
+    return TargetGrid(g.GetGeoTransform(), g.RasterXSize, g.RasterYSize,
+                      g.GetProjection())
+
+def window_grid(target_grid, window):
+    """TargetGrid of a (xoff, yoff, xsize, ysize) pixel window of a grid"""
+    xoff, yoff, xsize, ysize = window
+    geo_t = target_grid.geotransform
+    geo_t = (geo_t[0] + xoff * geo_t[1] + yoff * geo_t[2], geo_t[1],
+             geo_t[2], geo_t[3] + xoff * geo_t[4] + yoff * geo_t[5],
+             geo_t[4], geo_t[5])
+    return TargetGrid(geo_t, xsize, ysize, target_grid.projection)
+
+def iter_windows(target_grid, tile_size):
+    """(xoff, yoff, xsize, ysize) windows of at most tile_size pixels (an
+    int or a (x, y) pair) covering a grid, row by row"""
+    try:
+        tile_x, tile_y = tile_size
+    except TypeError:
+        tile_x = tile_y = tile_size
+    for yoff in range(0, target_grid.y_size, tile_y):
+        for xoff in range(0, target_grid.x_size, tile_x):
+            yield (xoff, yoff, min(tile_x, target_grid.x_size - xoff),
+                   min(tile_y, target_grid.y_size - yoff))
+
+def reproject_image(source_img, target_img, dstSRSs=None, window=None):
+    """Reprojects/Warps an image to fit exactly another image.
+    Additionally, you can set the destination SRS if you want
+    to or if it isn't defined in the source image.
+    source_img can be a file name or an open GDAL dataset, and target_img
+    a file name or a TargetGrid. With a (xoff, yoff, xsize, ysize) pixel
+    window of the target image, only that window is warped."""
+    if not isinstance(target_img, TargetGrid):
+        target_img = get_target_grid(target_img)
+    if window is not None:
+        target_img = window_grid(target_img, window)
+    geo_t = target_img.geotransform
+    x_size, y_size = target_img.x_size, target_img.y_size
+    xmin = min(geo_t[0], geo_t[0] + x_size * geo_t[1])
+    xmax = max(geo_t[0], geo_t[0] + x_size * geo_t[1])
+    ymin = min(geo_t[3], geo_t[3] + y_size * geo_t[5])
+    ymax = max(geo_t[3], geo_t[3] + y_size * geo_t[5])
+    xRes, yRes = abs(geo_t[1]), abs(geo_t[5])
+    if dstSRSs is None:
+        dstSRS = osr.SpatialReference()
+        raster_wkt = target_img.projection
+        dstSRS.ImportFromWkt(raster_wkt)
+    else:
+        dstSRS = dstSRSs
+
+    g = gdal.Warp('', source_img, format='MEM',
+                  outputBounds=[xmin, ymin, xmax, ymax], xRes=xRes, yRes=yRes,
+                  dstSRS=dstSRS)
+    if g is None:
+        raise ValueError("Something failed with GDAL!")
+    return g
+
+
+def source_grid_key(src_ds, target_grid):
+    """
+    hash identifying the mapping between the grid of a GDAL dataset and a
+    target grid
+
+    Input
+    ------
+    src_ds (GDAL dataset)
+    target_grid (TargetGrid)
+
+    Output
+    ------
+    key (hexadecimal string)
+    """
+    description = {
+        'geotransform': list(src_ds.GetGeoTransform()),
+        'size': [src_ds.RasterXSize, src_ds.RasterYSize],
+        'projection': src_ds.GetProjection(),
+        'gcps': [[g.GCPPixel, g.GCPLine, g.GCPX, g.GCPY, g.GCPZ]
+                 for g in src_ds.GetGCPs()],
+        'target': [list(target_grid.geotransform), target_grid.x_size,
+                   target_grid.y_size, target_grid.projection]}
+    return hashlib.sha1(json.dumps(description, sort_keys=True)
+                        .encode('utf-8')).hexdigest()
+
+
+def pixel_window(cols, rows, x_size, y_size, margin=2):
+    """
+    (xoff, yoff, xsize, ysize) window of an x_size by y_size image covering
+    pixel/line positions, with a margin of pixels and clipped to the image
+
+    Input
+    ------
+    cols, rows (pixel and line positions in the image)
+    x_size, y_size (size of the image)
+    margin (pixels added on every side)
+
+    Output
+    ------
+    window, or None if the positions do not overlap the image
+    """
+    cols = np.asarray(cols, dtype=float)
+    rows = np.asarray(rows, dtype=float)
+    valid = np.isfinite(cols) & np.isfinite(rows)
+    if not valid.any():
+        return None
+    cols, rows = cols[valid], rows[valid]
+    x0 = max(int(np.floor(cols.min())) - margin, 0)
+    x1 = min(int(np.ceil(cols.max())) + margin, x_size)
+    y0 = max(int(np.floor(rows.min())) - margin, 0)
+    y1 = min(int(np.ceil(rows.max())) + margin, y_size)
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return (x0, y0, x1 - x0, y1 - y0)
+
+
+class IndexResampler(object):
+    """
+    Nearest neighbour resampler to a fixed target grid.
+
+    The index map of every distinct source grid (geotransform, size,
+    projection/GCPs) is computed with a single gdal.Warp, kept in memory and,
+    if cache_dir is given, saved there as <key>.npz for later runs. Pixels
+    of the target grid outside the source get the nodata value of the source
+    band (or 0 without one), as gdal.Warp does.
+
+    Index maps only cover the window of the source that the target grid
+    falls in (found by transforming the edges of the target grid to source
+    pixels), and only that window of the source is read, so memory and I/O
+    depend on the target grid rather than on the size of the source.
+
+    Input
+    ------
+    target_grid (TargetGrid of the target image)
+    cache_dir (folder of the on-disk index maps, None to keep them in
+    memory only)
+    """
+
+    def __init__(self, target_grid, cache_dir=None):
+        self.target_grid = target_grid
+        self.cache_dir = cache_dir
+        if cache_dir is not None and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self._index_maps = {}
+        self.n_warps = 0
+        self.n_disk_loads = 0
+
+    def _footprint_window(self, src_ds):
+        """window of the source covering the target grid, from the source
+        pixel/line of the edges of the target pixels along its border"""
+        grid = self.target_grid
+        x_size, y_size = src_ds.RasterXSize, src_ds.RasterYSize
+        target_ds = gdal.GetDriverByName('MEM').Create('', grid.x_size,
+                                                       grid.y_size, 0)
+        target_ds.SetGeoTransform(grid.geotransform)
+        target_ds.SetProjection(grid.projection)
+        try:
+            transformer = gdal.Transformer(src_ds, target_ds, [])
+        except RuntimeError:
+            transformer = None
+        if transformer is None:
+            return (0, 0, x_size, y_size)
+        cols = np.arange(grid.x_size + 1, dtype=float)
+        rows = np.arange(grid.y_size + 1, dtype=float)
+        points = [(col, 0.) for col in cols] + \
+            [(col, float(grid.y_size)) for col in cols] + \
+            [(0., row) for row in rows] + \
+            [(float(grid.x_size), row) for row in rows]
+        points, success = transformer.TransformPoints(1, points)
+        points = np.array(points, dtype=float)[np.asarray(success, dtype=bool)]
+        if points.size == 0:
+            return None
+        return pixel_window(points[:, 0], points[:, 1], x_size, y_size)
+
+    def _compute_index_map(self, src_ds):
+        window = self._footprint_window(src_ds)
+        if window is None:
+            index_map = np.full((self.target_grid.y_size,
+                                 self.target_grid.x_size), NO_INDEX,
+                                dtype=np.int32)
+            return index_map, (0, 0, 0, 0)
+        xoff, yoff, x_size, y_size = window
+        index_ds = gdal.GetDriverByName('MEM').Create(
+            '', x_size, y_size, 1, gdal.GDT_Float64)
+        index_ds.SetProjection(src_ds.GetProjection())
+        if src_ds.GetGCPCount() > 0:
+            gcps = [gdal.GCP(g.GCPX, g.GCPY, g.GCPZ, g.GCPPixel - xoff,
+                             g.GCPLine - yoff) for g in src_ds.GetGCPs()]
+            index_ds.SetGCPs(gcps, src_ds.GetGCPProjection())
+        else:
+            src_grid = TargetGrid(src_ds.GetGeoTransform(), src_ds.RasterXSize,
+                                  src_ds.RasterYSize, src_ds.GetProjection())
+            index_ds.SetGeoTransform(window_grid(src_grid, window).geotransform)
+        band = index_ds.GetRasterBand(1)
+        band.SetNoDataValue(NO_INDEX)
+        band.WriteArray(np.arange(x_size * y_size, dtype=np.float64)
+                        .reshape(y_size, x_size))
+        warped = reproject_image(index_ds, self.target_grid)
+        self.n_warps += 1
+        index_map = warped.ReadAsArray()
+        index_dtype = np.int32 if x_size * y_size < np.iinfo(np.int32).max \
+            else np.int64
+        return np.rint(index_map).astype(index_dtype), window
+
+    def _lookup(self, src_ds):
+        """index map and source window of the grid of src_ds"""
+        key = source_grid_key(src_ds, self.target_grid)
+        entry = self._index_maps.get(key)
+        if entry is not None:
+            return entry
+        fname = None
+        if self.cache_dir is not None:
+            fname = os.path.join(self.cache_dir, key + '.npz')
+        if fname is not None and os.path.exists(fname):
+            with np.load(fname) as cached:
+                entry = (cached['index_map'],
+                         tuple(int(v) for v in cached['window']))
+            self.n_disk_loads += 1
+        else:
+            entry = self._compute_index_map(src_ds)
+            if fname is not None:
+                # several processes may write the same map: write to a
+                # temporary file and rename it
+                tmp_fname = '{:s}.{:d}.tmp.npz'.format(fname[:-4],
+                                                      os.getpid())
+                np.savez(tmp_fname, index_map=entry[0],
+                         window=np.array(entry[1]))
+                os.replace(tmp_fname, fname)
+        self._index_maps[key] = entry
+        return entry
+
+    def index_map(self, src_ds):
+        """
+        (y_size, x_size) array with the flat index, in the source window
+        (see source_window), of the source pixel of every target pixel, or
+        NO_INDEX outside of the source
+        """
+        return self._lookup(src_ds)[0]
+
+    def source_window(self, src_ds):
+        """
+        (xoff, yoff, xsize, ysize) window of the source read by resample,
+        None if the target grid does not overlap the source
+        """
+        window = self._lookup(src_ds)[1]
+        return window if window[2] > 0 else None
+
+    def resample(self, src_ds, data=None):
+        """
+        resample a GDAL dataset (or its already read data) to the target
+        grid
+
+        Input
+        ------
+        src_ds (GDAL dataset)
+        data (array read from src_ds, either all of it or its source_window,
+        read from it if None). A 3D array of several bands is resampled band
+        by band
+
+        Output
+        ------
+        resampled array, (y_size, x_size) or (n_bands, y_size, x_size)
+        """
+        index_map, window = self._lookup(src_ds)
+        xoff, yoff, x_size, y_size = window
+        if data is None:
+            if x_size > 0:
+                data = src_ds.ReadAsArray(xoff, yoff, x_size, y_size)
+            else:
+                # every target pixel is outside: one pixel gives the type
+                data = src_ds.ReadAsArray(0, 0, 1, 1)
+        else:
+            data = np.asarray(data)
+            if data.shape[-2:] == (src_ds.RasterYSize, src_ds.RasterXSize):
+                data = data[..., yoff:yoff + y_size, xoff:xoff + x_size]
+            elif data.shape[-2:] != (y_size, x_size):
+                raise ValueError('Data of shape {} is neither the source nor '
+                                 'its window {}!'.format(data.shape, window))
+        outside = index_map == NO_INDEX
+        flat = data.reshape(data.shape[:-2] + (-1,))
+        if flat.shape[-1] > 0:
+            resampled = flat[..., np.where(outside, 0, index_map)]
+        else:
+            resampled = np.empty(flat.shape[:-1] + index_map.shape,
+                                 dtype=data.dtype)
+        if outside.any():
+            nodata = src_ds.GetRasterBand(1).GetNoDataValue()
+            resampled[..., outside] = 0 if nodata is None else nodata
+        return resampled
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+"""
+Persistent catalogue of the Sentinel-1 NetCDF files of a folder
+"""
+
+import bisect
+import glob
+import json
+import os
+
+from dateutil import parser
+from netCDF4 import Dataset
+
+POLARISATIONS = ['vv', 'vh', 'hh', 'hv']
+
+# global attributes recorded for every scene (matched ignoring case and
+# underscores)
+SCENE_ATTRIBUTES = ['orbitdirection', 'relativeorbit', 'satellite']
+
+
+def read_scene_record(this_file):
+    """
+    read the metadata of one Sentinel-1 NetCDF file
+
+    Input
+    ------
+    this_file (path and name of netCDF4 file)
+
+    Output
+    ------
+    record (dictionary with date, orbitdirection, relativeorbit, satellite,
+    frequency, the names of the polarisation and incidence angle variables
+    and the list of all variables)
+    """
+    data = Dataset(this_file, 'r')
+    try:
+        attrs = data.ncattrs()
+        record = {'date': None, 'frequency': None}
+        for name in SCENE_ATTRIBUTES:
+            record[name] = None
+
+        # Search for date in attribute name and takes first variable that
+        # matches
+        for s in attrs:
+            if 'date' in s.lower():
+                record['date'] = str(getattr(data, s))
+                break
+        for s in attrs:
+            key = s.lower().replace('_', '')
+            if key in SCENE_ATTRIBUTES:
+                value = getattr(data, s)
+                record[key] = value.item() if hasattr(value, 'item') \
+                    else value
+        if 'frequency' in attrs:
+            record['frequency'] = float(getattr(data, 'frequency'))
+
+        variables = list(data.variables)
+        record['variables'] = variables
+        record['polarisations'] = {}
+        for polarisation in POLARISATIONS:
+            for s in variables:
+                if polarisation in s.lower():
+                    record['polarisations'][polarisation] = s
+                    break
+        record['theta'] = None
+        for s in variables:
+            if 'theta' in s.lower():
+                record['theta'] = s
+                break
+    finally:
+        data.close()
+    return record
+
+
+def as_date(value):
+    """datetime of a datetime or of a date string"""
+    if isinstance(value, str):
+        return parser.parse(value)
+    return value
+
+
+def match_record(record, orbitdirection=None, relativeorbit=None,
+                 satellite=None):
+    """
+    whether the metadata of a scene matches all the given filters
+
+    Input
+    ------
+    record (scene record, see read_scene_record)
+    orbitdirection, relativeorbit, satellite (a value or a list of accepted
+    values, None to accept all scenes; strings are compared ignoring case)
+    """
+    filters = {'orbitdirection': orbitdirection,
+               'relativeorbit': relativeorbit, 'satellite': satellite}
+    for name, accepted in filters.items():
+        if accepted is None:
+            continue
+        if isinstance(accepted, (str, int)):
+            accepted = [accepted]
+        accepted = [str(value).lower() for value in accepted]
+        if record.get(name) is None or \
+                str(record[name]).lower() not in accepted:
+            return False
+    return True
+
+
+class DateIndex(object):
+    """
+    Sorted index of dates, answering range and nearest date queries with a
+    binary search
+
+    Input
+    ------
+    dates (iterable of datetimes)
+    """
+
+    def __init__(self, dates):
+        self.dates = sorted(dates)
+
+    def between(self, t0=None, t1=None):
+        """sorted dates from t0 to t1 (both included, None for no limit)"""
+        i0 = 0 if t0 is None else bisect.bisect_left(self.dates, as_date(t0))
+        i1 = len(self.dates) if t1 is None else \
+            bisect.bisect_right(self.dates, as_date(t1))
+        return self.dates[i0:i1]
+
+    def nearest(self, t):
+        """date closest to t (the earlier one on ties)"""
+        if not self.dates:
+            raise ValueError('No dates in the index!')
+        t = as_date(t)
+        i = bisect.bisect_left(self.dates, t)
+        candidates = self.dates[max(i - 1, 0):i + 1]
+        return min(candidates, key=lambda date: abs(date - t))
+
+    def __len__(self):
+        return len(self.dates)
+
+    def __iter__(self):
+        return iter(self.dates)
+
+
+class S1Catalogue(object):
+    """
+    On-disk catalogue (JSON) of the NetCDF files of a folder.
+
+    Every file is recorded with its metadata (see read_scene_record), keyed
+    on its path, size and modification time. Updating the catalogue only
+    opens new or changed files, and forgets removed ones.
+
+    Input
+    ------
+    data_folder (folder with the *.nc files)
+    catalogue_file (JSON file of the catalogue, by default
+    s1_catalogue.json in data_folder)
+    """
+
+    def __init__(self, data_folder, catalogue_file=None):
+        self.data_folder = data_folder
+        if catalogue_file is None:
+            catalogue_file = os.path.join(data_folder, 's1_catalogue.json')
+        self.catalogue_file = catalogue_file
+        self.records = {}
+        self.n_scanned = 0
+        self.n_reused = 0
+        if os.path.exists(catalogue_file):
+            with open(catalogue_file, 'r') as fp:
+                self.records = json.load(fp)
+        self.update()
+
+    def update(self):
+        """
+        rescan the folder, reading only new or changed files, and save the
+        catalogue if anything changed
+        """
+        files = glob.glob(os.path.join(self.data_folder, '*.nc'))
+        records = {}
+        self.n_scanned = 0
+        self.n_reused = 0
+        for fich in files:
+            path = os.path.abspath(fich)
+            stat = os.stat(path)
+            record = self.records.get(path)
+            if record is None or record['size'] != stat.st_size or \
+                    record['mtime'] != stat.st_mtime:
+                record = read_scene_record(path)
+                record['size'] = stat.st_size
+                record['mtime'] = stat.st_mtime
+                self.n_scanned += 1
+            else:
+                self.n_reused += 1
+            records[path] = record
+        changed = records != self.records
+        self.records = records
+        if changed:
+            self.save()
+
+    def save(self):
+        """write the catalogue to its JSON file"""
+        tmp_file = self.catalogue_file + '.tmp'
+        try:
+            with open(tmp_file, 'w') as fp:
+                json.dump(self.records, fp, indent=1, sort_keys=True)
+            os.replace(tmp_file, self.catalogue_file)
+        except (IOError, OSError):
+            # read-only folder: the catalogue is only kept in memory
+            pass
+
+    def files(self):
+        """sorted list of the catalogued files"""
+        return sorted(self.records)
+
+    def select(self, start_date=None, end_date=None, orbitdirection=None,
+               relativeorbit=None, satellite=None):
+        """
+        sorted list of the catalogued files within the date window (both
+        ends included, None for no limit) whose metadata match the filters
+        (see match_record). No file is opened.
+        """
+        start_date, end_date = as_date(start_date), as_date(end_date)
+        files = []
+        for fich in self.files():
+            record = self.records[fich]
+            if not match_record(record, orbitdirection, relativeorbit,
+                                satellite):
+                continue
+            date = parser.parse(record['date'])
+            if (start_date is not None and date < start_date) or \
+                    (end_date is not None and date > end_date):
+                continue
+            files.append(fich)
+        return files
+
+    def __getitem__(self, this_file):
+        return self.records[os.path.abspath(this_file)]
+
+    def __len__(self):
+        return len(self.records)
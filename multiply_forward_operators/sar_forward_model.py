@@ -3,10 +3,167 @@
 
 """
 
+import json
+from collections import OrderedDict
+
 import numpy as np
+import scipy.sparse as sp
 import pdb
 
-def sar_observation_operator(x, polarisation):
+from .cache import LRUCache
+
+# the model parameters (A, B, C, D, E) for different polarisations
+WCM_PARAMETERS = OrderedDict([
+    ('VV', [0.0846, 0.0615, -14.8465, 15.907, 0.]),
+    ('VH', [0.0795, 0.1464, -14.8332, 15.907, 0.])])
+
+# named tables of model parameters (e.g. per crop, land cover class or
+# frequency), each mapping polarisations to (A, B, C, D, E)
+PARAMETER_TABLES = {'default': WCM_PARAMETERS}
+
+
+def register_parameters(name, table):
+    """
+    Register a table of model parameters under a name, so that
+    sar_observation_operator can use it with parameters=name
+
+    Input
+    -----
+    name: name of the table
+    table: dictionary of polarisation: [A, B, C, D, E]
+    """
+    PARAMETER_TABLES[name] = OrderedDict(
+        (pol.upper(), [float(p) for p in table[pol]]) for pol in table)
+
+
+def get_parameters(parameters=None):
+    """
+    Table of model parameters from a registered name (None for 'default') or
+    a dictionary of polarisation: [A, B, C, D, E]
+    """
+    if parameters is None:
+        parameters = 'default'
+    if isinstance(parameters, str):
+        try:
+            return PARAMETER_TABLES[parameters]
+        except KeyError:
+            raise ValueError('No parameter table named {}! Available: '
+                             '{}'.format(parameters,
+                                         ', '.join(sorted(PARAMETER_TABLES))))
+    return OrderedDict((pol.upper(), parameters[pol]) for pol in parameters)
+
+
+def save_parameters(fname, tables):
+    """
+    Save named tables of model parameters to a JSON file
+
+    Input
+    -----
+    fname: JSON file
+    tables: dictionary of name: {polarisation: [A, B, C, D, E]}
+    """
+    tables = dict((name, OrderedDict((pol.upper(), [float(p) for p in
+                                                   table[pol]])
+                                     for pol in table))
+                  for name, table in tables.items())
+    with open(fname, 'w') as fp:
+        json.dump(tables, fp, indent=1, sort_keys=True)
+
+
+def load_parameters(fname):
+    """
+    Load named tables of model parameters from a JSON file (see
+    save_parameters) and register them
+
+    Output
+    ------
+    names of the loaded tables
+    """
+    with open(fname, 'r') as fp:
+        tables = json.load(fp, object_pairs_hook=OrderedDict)
+    for name, table in tables.items():
+        register_parameters(name, table)
+    return list(tables.keys())
+
+# CSR index arrays of the Jacobian of the most recent sizes, keyed on
+# (n_pixels, n_state, n_pol). Kept small, as the number of (valid) pixels
+# changes from date to date and from tile to tile
+_jacobian_index_cache = LRUCache(maxsize=8)
+
+
+def _jacobian_index(n_pixels, n_state, n_pol=1):
+    """
+    Get the (cached) CSR index arrays of a block diagonal Jacobian with one
+    row per pixel and a block of n_state columns per pixel, of which only
+    the first two (V and SM) are stored: the derivatives with respect to the
+    other state parameters are always zero. For several polarisations the
+    blocks of every polarisation are stacked vertically
+
+    Input
+    -----
+    n_pixels: number of pixels
+    n_state: number of state parameters per pixel
+    n_pol: number of polarisations
+
+    Output
+    ------
+    indices: column indices of the non-zero elements (read-only)
+    indptr: row pointers into indices (read-only)
+    """
+    key = (n_pixels, n_state, n_pol)
+    index = _jacobian_index_cache.get(key)
+    if index is not None:
+        return index
+    nnz = n_pol * n_pixels * 2
+    index_dtype = np.int32 if max(nnz, n_pixels * n_state) < \
+        np.iinfo(np.int32).max else np.int64
+    columns = (np.arange(n_pixels, dtype=index_dtype)[:, None] * n_state +
+               np.arange(2, dtype=index_dtype)).ravel()
+    indices = np.tile(columns, n_pol)
+    indptr = np.arange(0, nnz + 1, 2, dtype=index_dtype)
+    indices.flags.writeable = False
+    indptr.flags.writeable = False
+    _jacobian_index_cache.put(key, (indices, indptr))
+    return indices, indptr
+
+
+class SARWorkspace(object):
+    """
+    Scratch arrays for sar_observation_operator, so that repeated calls on
+    the same number of pixels do not allocate temporaries
+
+    Input
+    -----
+    n_pixels: number of pixels
+    n_pol: number of polarisations evaluated per call
+    dtype: floating point type of the arrays (np.float32 or np.float64)
+    """
+
+    def __init__(self, n_pixels, n_pol=1, dtype=np.float64):
+        self.n_pixels = n_pixels
+        self.n_pol = n_pol
+        self.dtype = np.dtype(dtype)
+        self.mu = np.empty(n_pixels, dtype=self.dtype)
+        self.V_mu = np.empty(n_pixels, dtype=self.dtype)
+        self.tau = np.empty((n_pol, n_pixels), dtype=self.dtype)
+        self.sigma_veg = np.empty((n_pol, n_pixels), dtype=self.dtype)
+        self.sigma_surf = np.empty((n_pol, n_pixels), dtype=self.dtype)
+        self.V_E = np.empty((n_pol, n_pixels), dtype=self.dtype)
+
+    def allocate_output(self, n_state=2):
+        """
+        Allocate (sigma_0, grad) arrays to be passed as out to
+        sar_observation_operator
+        """
+        sigma_0 = np.empty((self.n_pol, self.n_pixels), dtype=self.dtype)
+        grad = np.empty((self.n_pol, n_state, self.n_pixels),
+                        dtype=self.dtype)
+        return sigma_0, grad
+
+
+def sar_observation_operator(x, polarisation, theta=23., sparse_jacobian=False,
+                             out=None, workspace=None, dtype=None,
+                             pixel_index=None, parameters=None):
 
     """
     For the sar_observation_operator a simple Water Cloud Model (WCM) is used
@@ -29,8 +186,41 @@ def sar_observation_operator(x, polarisation):
 
     Input
     -----
-    polarisation: considered polarisation as string
-    x: 2D array where every row is the set of parameters for one pixel
+    polarisation: considered polarisation as string, or a list of
+        polarisations to evaluate jointly. None evaluates all polarisations
+        of the parameter table (in table order)
+    x: 2D array where the first row holds the vegetation descriptor V and the
+        second row the soil moisture SM of every pixel
+    theta: incidence angle [deg], either a scalar or one value per pixel
+        (e.g. the 'incidence_angle' raster in the metadata returned by
+        S1Observations.get_band_data, which is flattened in the same pixel
+        order as the observations)
+    sparse_jacobian: if True, return grad as a block diagonal
+        scipy.sparse.csr_matrix of shape (n_pixels, n_state*n_pixels). Rows
+        follow the pixel order of the uncertainty matrix built by
+        S1Observations.get_band_data, and the state is ordered pixel by pixel
+        (column i*n_state + j is parameter j of pixel i). Only the V and SM
+        columns are stored. The index arrays are read-only and shared with
+        other calls of the same size, so copy the matrix (grad.copy())
+        before changing its structure in place (e.g. eliminate_zeros)
+    out: optional tuple of (sigma_0, grad) arrays the results are written
+        into. They must have the output shapes of the polarisation mode
+        below, or the stacked shapes (n_pol, n_pixels) and
+        (n_pol, n_state, n_pixels), e.g. from SARWorkspace.allocate_output
+    workspace: optional SARWorkspace with the scratch arrays. Together with
+        out (and x already of the requested dtype), a call does not allocate
+        any pixel sized array
+    dtype: floating point type of the computation (np.float32 or
+        np.float64). Defaults to the dtype of workspace or out, or float64
+    pixel_index: optional PixelIndex (e.g. the mask of compact observations
+        returned by S1Observations.get_observation). x and a per-pixel theta
+        can then be given either on the full grid or already compact, only
+        the valid pixels are evaluated, and all outputs are compact (use
+        pixel_index.scatter to put them back on the grid)
+    parameters: table of model parameters, either the name of a registered
+        table (see register_parameters and load_parameters, e.g. tables
+        fitted with wcm_calibration) or a dictionary of polarisation:
+        [A, B, C, D, E]. Defaults to WCM_PARAMETERS
 
     Output
     ------
@@ -39,46 +229,141 @@ def sar_observation_operator(x, polarisation):
     sigma_veg: predicted volume component of sigma_0
     sigma_surf: predicted surface component of sigma_0
     tau: predicted two-way attenuation through the canopy
-    """
 
-    # x 2D array where every row is the set of parameters for one pixel
-    x = np.atleast_2d(x)
+    For several polarisations, sigma_0 is stacked to shape
+    (n_pol, n_pixels) and grad to shape (n_pol, n_state, n_pixels), or to a
+    (n_pol*n_pixels, n_state*n_pixels) sparse matrix with the rows of each
+    polarisation following each other.
+    """
 
-    # conversion of incidence angle to radiant
-    # the incidence angle itself should probably implemented in x)
-    theta = np.deg2rad(23.)
+    # Floating point type of the computation
+    if dtype is None:
+        if workspace is not None:
+            dtype = workspace.dtype
+        elif out is not None:
+            dtype = out[0].dtype
+        else:
+            dtype = np.float64
+    dtype = np.dtype(dtype)
 
-    # Simpler definition of cosine of theta
-    mu = np.cos(theta)
+    # Only evaluate the valid pixels
+    if pixel_index is not None:
+        x = pixel_index.compact(x)
+        if np.ndim(theta) > 0:
+            theta = pixel_index.compact(theta)
 
-    # the model parameters (A, B, C, D, E) for different polarisations
-    parameters = {'VV': [0.0846, 0.0615, -14.8465, 15.907, 0.], 'VH': [0.0795, 0.1464, -14.8332, 15.907, 0.]}
+    # x 2D array where every row is the set of parameters for one pixel
+    x = np.atleast_2d(np.asarray(x, dtype=dtype))
+    n_state, n_pixels = x.shape
 
-    # Select model parameters
+    # Select model parameters, one row per polarisation so that all
+    # polarisations are evaluated in the same pass
+    table = get_parameters(parameters)
+    single_polarisation = isinstance(polarisation, str)
+    if single_polarisation:
+        polarisations = [polarisation]
+    elif polarisation is None:
+        polarisations = list(table.keys())
+    else:
+        polarisations = list(polarisation)
     try:
-        A, B, C, D, E = parameters[polarisation]
+        parameters = np.array([table[pol.upper()]
+                               for pol in polarisations], dtype=dtype)
     except KeyError:
-        raise ValueError('Only VV and VH polarisations available!')
+        raise ValueError('Only {} polarisations available!'.format(
+            ' and '.join(table.keys())))
+    A, B, C, D, E = [p[:, None] for p in parameters.T]
+    n_pol = len(polarisations)
+
+    if workspace is None:
+        workspace = SARWorkspace(n_pixels, n_pol, dtype)
+    elif (workspace.n_pixels, workspace.n_pol, workspace.dtype) != \
+            (n_pixels, n_pol, dtype):
+        raise ValueError('Workspace does not match the number of pixels, '
+                         'polarisations or dtype of this call!')
+    if out is None:
+        sigma_0, grad = workspace.allocate_output(n_state)
+    else:
+        if sparse_jacobian:
+            raise ValueError('out can only be used with a dense Jacobian!')
+        sigma_0 = out[0].reshape(n_pol, n_pixels)
+        grad = out[1].reshape(n_pol, n_state, n_pixels)
+        if not (np.may_share_memory(sigma_0, out[0]) and
+                np.may_share_memory(grad, out[1])):
+            raise ValueError('out arrays must be contiguous!')
+
+    # conversion of incidence angle to radiant and simpler definition of
+    # cosine of theta. A per-pixel angle raster is flattened so that it
+    # broadcasts against the pixels of x
+    theta = np.asarray(theta)
+    if theta.ndim == 0:
+        mu = dtype.type(np.cos(np.deg2rad(theta)))
+    else:
+        mu = workspace.mu
+        np.deg2rad(theta.ravel(), out=mu)
+        np.cos(mu, out=mu)
 
-    # Calculate Model
-    tau = np.exp(-2 * B / mu * x[0, :])
-    sigma_veg = A * (x[0, :] ** E) * mu * (1 - tau)
-    sigma_surf = 10 ** ((C + D * x[1, :]) / 10.)
+    # Quantities shared by all polarisations
+    V = x[0, :]
+    SM = x[1, :]
+    V_mu = np.divide(V, mu, out=workspace.V_mu)
 
-    sigma_0 = sigma_veg + tau * sigma_surf
+    # Calculate Model, all in place in the workspace arrays
+    # tau = exp(-2*B*V/mu)
+    tau = np.multiply(-2 * B, V_mu, out=workspace.tau)
+    np.exp(tau, out=tau)
+    # sigma_surf = 10**((C+D*SM)/10)
+    sigma_surf = np.multiply(D, SM, out=workspace.sigma_surf)
+    sigma_surf += C
+    sigma_surf /= 10.
+    np.power(10., sigma_surf, out=sigma_surf)
+    # sigma_veg = A*V**E*mu*(1-tau)
+    V_E = np.power(V, E, out=workspace.V_E)
+    sigma_veg = np.subtract(1., tau, out=workspace.sigma_veg)
+    sigma_veg *= V_E
+    sigma_veg *= A
+    sigma_veg *= mu
 
     # Calculate Gradient (grad has same dimension as x)
-    grad = x*0
-    n_elems = x.shape[1]
-    for i in range(n_elems):
-        tau_value = np.exp(-2 * B / mu * x[0, i])
-        grad[0, i] = A * E * mu * (x[0, i] ** (E - 1)) * (1 - tau_value) + \
-            2 * A * B * (x[0, i] ** E) * tau_value - (\
-            (2 ** (1/10. * (C + D * x[1, i]) + 1)) * \
-            (5 ** (1/10. * (C + D * x[1, i])) * B * tau_value) \
-            ) / mu
-        grad[1, i] = D * np.log(10) * tau_value * 10 ** (1/10. * (C + D * x[1, i]) - 1)
+    # d(sigma_surf)/dSM = D*ln(10)/10*sigma_surf, so the surface term reuses
+    # the tau and sigma_surf arrays of the forward pass
+    grad_V = grad[:, 0, :]
+    grad_SM = grad[:, 1, :]
+    np.multiply(tau, sigma_surf, out=grad_SM)
+    np.add(sigma_veg, grad_SM, out=sigma_0)
+    # d(sigma_0)/dV = A*E*mu*V**(E-1)*(1-tau) +
+    #                 2*B*(A*V**E*tau - tau*sigma_surf/mu)
+    np.divide(grad_SM, mu, out=grad_V)
+    np.negative(grad_V, out=grad_V)
+    V_E *= tau
+    V_E *= A
+    grad_V += V_E
+    grad_V *= 2 * B
+    if np.any(E != 0):
+        # Not E*sigma_veg/V, which is 0/0 for bare soil (V = 0). There,
+        # 1 - tau = 0 and the term vanishes for E > 0
+        np.subtract(1., tau, out=tau)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            d_veg = np.power(V, E - 1, out=workspace.sigma_veg)
+            d_veg *= tau
+        d_veg *= A * E
+        d_veg *= mu
+        bare_soil = V == 0
+        if bare_soil.any():
+            d_veg[:, bare_soil] = 0.
+        grad_V += d_veg
+    grad_SM *= D * dtype.type(np.log(10) / 10.)
+    grad[:, 2:, :] = 0.
 
+    if sparse_jacobian:
+        indices, indptr = _jacobian_index(n_pixels, n_state, n_pol)
+        grad = sp.csr_matrix((grad[:, :2, :].transpose(0, 2, 1).ravel(),
+                              indices, indptr),
+                             shape=(n_pol * n_pixels, n_state * n_pixels))
+    elif single_polarisation:
+        grad = grad[0]
+    if single_polarisation:
+        sigma_0 = sigma_0[0]
 
     # returned values are linear scaled not dB!!!
     # return sigma_0, grad, sigma_veg, sigma_surf, tau
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""Sensor spectral response functions (SRFs).
+Convert the 400-2500 nm spectra of the optical forward operator into sensor
+band reflectances with a sparse (n_bands, n_wavelengths) matrix.
+"""
+from collections import OrderedDict
+
+import numpy as np
+import scipy.sparse as sp
+
+# Wavelengths [nm] of the spectra returned by PROSAIL
+WAVELENGTHS = np.arange(400, 2501)
+
+# Nominal band passes (lower, upper edge in nm) of the built-in sensors. The
+# SRFs are approximated by top hat functions over these band passes.
+SENSOR_BANDS = {
+    "SENTINEL2": OrderedDict(
+        (band, (centre - width / 2., centre + width / 2.))
+        for band, centre, width in [
+            ("B1", 442.7, 21.), ("B2", 492.4, 66.), ("B3", 559.8, 36.),
+            ("B4", 664.6, 31.), ("B5", 704.1, 15.), ("B6", 740.5, 15.),
+            ("B7", 782.8, 20.), ("B8", 832.8, 106.), ("B8A", 864.7, 21.),
+            ("B9", 945.1, 20.), ("B10", 1373.5, 31.), ("B11", 1613.7, 91.),
+            ("B12", 2202.4, 175.)]),
+    "LANDSAT8": OrderedDict([
+        ("B1", (433., 453.)), ("B2", (450., 515.)), ("B3", (525., 600.)),
+        ("B4", (630., 680.)), ("B5", (845., 885.)), ("B6", (1560., 1660.)),
+        ("B7", (2100., 2300.)), ("B8", (500., 680.)), ("B9", (1360., 1390.))])
+}
+
+SENSOR_ALIASES = {"S2": "SENTINEL2", "MSI": "SENTINEL2",
+                  "SENTINEL-2": "SENTINEL2", "L8": "LANDSAT8",
+                  "OLI": "LANDSAT8", "LANDSAT-8": "LANDSAT8"}
+
+# SRF matrices of the built-in sensors, built on first use
+_srf_cache = {}
+
+
+def _sensor_name(sensor):
+    name = sensor.upper()
+    name = SENSOR_ALIASES.get(name, name)
+    if name not in SENSOR_BANDS:
+        raise ValueError("Unknown sensor {:s}! Available sensors are "
+                         "{:s}".format(sensor, ", ".join(SENSOR_BANDS)))
+    return name
+
+
+def get_band_names(srf):
+    """Returns the band names of a built-in sensor"""
+    return list(SENSOR_BANDS[_sensor_name(srf)].keys())
+
+
+def get_srf_matrix(srf):
+    """Returns the SRF as a sparse (n_bands, 2101) CSR matrix that maps a
+    400-2500 nm spectrum to band reflectances. ``srf`` can be the name of a
+    built-in sensor ("Sentinel2"/"S2"/"MSI" or "Landsat8"/"L8"/"OLI"), an
+    (n_bands, 2101) array with the spectral response of each band, or an
+    already built sparse matrix. The response of every band is normalised to
+    integrate to 1. Matrices of the built-in sensors are only built once.
+    """
+    if sp.issparse(srf):
+        return srf.tocsr()
+    if isinstance(srf, str):
+        name = _sensor_name(srf)
+        try:
+            return _srf_cache[name]
+        except KeyError:
+            pass
+        # Fraction of every 1 nm bin (wl-0.5, wl+0.5) within the band pass
+        edges = np.array(list(SENSOR_BANDS[name].values()))
+        srf_array = np.clip(
+            np.minimum(WAVELENGTHS + 0.5, edges[:, 1:]) -
+            np.maximum(WAVELENGTHS - 0.5, edges[:, :1]), 0., 1.)
+        _srf_cache[name] = get_srf_matrix(srf_array)
+        return _srf_cache[name]
+    srf_array = np.atleast_2d(np.asarray(srf, dtype=float))
+    if srf_array.shape[1] != WAVELENGTHS.size:
+        raise ValueError("The SRF must be defined between 400 and 2500 nm "
+                         "every 1 nm!")
+    srf_array = srf_array / srf_array.sum(axis=1)[:, None]
+    return sp.csr_matrix(srf_array)
+
+
+def apply_srf(rho, srf):
+    """Integrates spectra over the sensor bands. ``rho`` is either a single
+    spectrum (2101 elements) or an (N, 2101) array with one spectrum per row,
+    and the output has the same layout with n_bands instead of 2101."""
+    srf_matrix = get_srf_matrix(srf)
+    return srf_matrix.dot(np.asarray(rho).T).T
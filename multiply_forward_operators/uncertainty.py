@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+"""
+Observation uncertainty representations
+"""
+
+import numpy as np
+import scipy.sparse as sp
+
+
+def _box_sum_axis(data, size, axis):
+    """moving sum of size elements along one axis, cut at the edges"""
+    half = size // 2
+    n = data.shape[axis]
+    shape = list(data.shape)
+    shape[axis] = n + 2 * half + 1
+    table = np.empty(shape)
+    table = np.moveaxis(table, axis, 0)
+    # table[k] is the sum of the first clip(k - half - 1, 0, n) elements,
+    # so that every window sum is the difference of two slices
+    table[:half + 1] = 0.
+    np.cumsum(np.moveaxis(data, axis, 0), axis=0, out=table[half + 1:n + half + 1])
+    table[n + half + 1:] = table[n + half]
+    return np.moveaxis(table[size:size + n] - table[:n], 0, axis)
+
+
+def box_sum(data, size):
+    """
+    sum of data over a size x size window centred on every pixel (windows
+    are cut at the edges), from cumulative sums along both axes (separable
+    box filter) in O(N)
+
+    Input
+    ------
+    data (2D array)
+    size (odd window width in pixels)
+
+    Output
+    ------
+    2D float64 array of the window sums
+    """
+    return _box_sum_axis(_box_sum_axis(data, size, 0), size, 1)
+
+
+def local_enl(backscatter, mask, size=7, max_enl=100.):
+    """
+    Equivalent Number of Looks (mean**2 / variance) of the valid pixels of a
+    size x size moving window around every pixel. Masked pixels do not
+    contribute to the windows. Windows with less than two valid pixels get
+    ENL 1 (single look). ENL is kept within [1, max_enl], and homogeneous
+    windows (zero variance, or slightly negative from rounding) get
+    max_enl, so that they do not get zero uncertainty.
+
+    Input
+    ------
+    backscatter (2D array of linear intensities)
+    mask (boolean array, True for valid pixels)
+    size (odd window width in pixels)
+    max_enl (upper bound of the ENL)
+
+    Output
+    ------
+    2D array of ENL
+    """
+    mask = np.asarray(mask, dtype=bool)
+    # Shift by the mean of the scene so that the variance from the sums of
+    # squares does not suffer from cancellation
+    offset = backscatter[mask].mean() if mask.any() else 0.
+    values = np.where(mask, backscatter - offset, 0.)
+    count = box_sum(mask.astype(np.float64), size)
+    n = np.maximum(count, 1.)
+    mean = box_sum(values, size) / n
+    variance = box_sum(values * values, size) / n - mean * mean
+    mean += offset
+    homogeneous = variance <= 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        enl = mean * mean / np.where(homogeneous, 1., variance)
+    enl[homogeneous] = max_enl
+    enl[~np.isfinite(enl) | (count < 2)] = 1.
+    return np.clip(enl, 1., max_enl)
+
+
+def enl_uncertainty(backscatter, mask, size=7, max_enl=100.):
+    """
+    speckle uncertainty (standard deviation, in the units of backscatter)
+    backscatter / sqrt(ENL), with the local ENL of local_enl
+    """
+    enl = local_enl(backscatter, mask, size, max_enl)
+    return np.abs(backscatter) / np.sqrt(enl)
+
+
+class DiagonalPrecision(object):
+    """
+    Diagonal precision (inverse covariance) matrix of N observations, of
+    which only the unmasked ones carry information.
+
+    Only the mask and the precision of the unmasked observations (a 1D
+    array) are stored. Masked observations have zero precision. The matrix
+    can be multiplied with @ (or dot), and converted with diagonal() and
+    tocsr() when a full representation is needed.
+
+    Input
+    ------
+    values (precision of the unmasked observations)
+    mask (boolean array of the N observations, True if unmasked)
+    """
+    # Let numpy arrays defer to __rmatmul__
+    __array_ufunc__ = None
+
+    def __init__(self, values, mask):
+        self.mask = np.asarray(mask, dtype=bool).ravel()
+        self.values = np.asarray(values).ravel()
+        if self.values.size != np.count_nonzero(self.mask):
+            raise ValueError('There must be one value per unmasked '
+                             'observation!')
+
+    @classmethod
+    def from_uncertainty(cls, uncertainty, mask):
+        """
+        precision 1/uncertainty**2 of the unmasked observations
+
+        Input
+        ------
+        uncertainty (array of standard deviations, any shape). Unmasked
+        observations must have a finite, positive uncertainty
+        mask (boolean array of the same shape, True if unmasked)
+        """
+        mask = np.asarray(mask, dtype=bool).ravel()
+        uncertainty = np.asarray(uncertainty).ravel()[mask]
+        if not np.all(np.isfinite(uncertainty) & (uncertainty > 0)):
+            raise ValueError('Unmasked observations must have a finite, '
+                             'positive uncertainty!')
+        return cls(1. / uncertainty ** 2, mask)
+
+    @property
+    def shape(self):
+        return (self.mask.size, self.mask.size)
+
+    @property
+    def nnz(self):
+        return self.values.size
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + self.mask.nbytes
+
+    @property
+    def T(self):
+        return self
+
+    def diagonal(self):
+        """full diagonal, zero for masked observations"""
+        diagonal = np.zeros(self.mask.size, dtype=self.values.dtype)
+        diagonal[self.mask] = self.values
+        return diagonal
+
+    def tocsr(self):
+        """scipy.sparse.csr_matrix with the same diagonal"""
+        N = self.mask.size
+        indptr = np.zeros(N + 1, dtype=np.int64)
+        np.cumsum(self.mask, out=indptr[1:])
+        indices = np.flatnonzero(self.mask)
+        return sp.csr_matrix((self.values, indices, indptr), shape=self.shape)
+
+    def dot(self, other):
+        """product with a vector, a dense (N, k) array or a sparse matrix"""
+        if sp.issparse(other):
+            return sp.diags(self.diagonal()).dot(other)
+        other = np.asarray(other)
+        if other.shape[0] != self.mask.size:
+            raise ValueError('Dimension mismatch!')
+        diagonal = self.diagonal()
+        if other.ndim == 1:
+            return diagonal * other
+        return diagonal.reshape((-1,) + (1,) * (other.ndim - 1)) * other
+
+    def rdot(self, other):
+        """product other @ self"""
+        if sp.issparse(other):
+            return other.dot(sp.diags(self.diagonal()))
+        return np.asarray(other) * self.diagonal()
+
+    def __matmul__(self, other):
+        return self.dot(other)
+
+    def __rmatmul__(self, other):
+        return self.rdot(other)
+
+    def __repr__(self):
+        return '<{:d}x{:d} DiagonalPrecision with {:d} unmasked ' \
+            'observations>'.format(self.shape[0], self.shape[1], self.nnz)
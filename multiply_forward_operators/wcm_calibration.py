@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+"""Calibration of the Water Cloud Model parameters.
+The parameters (A, B, C, D, E) of sar_observation_operator are fitted to
+co-located backscatter, vegetation descriptor and soil moisture
+observations, for many fields (or land cover classes) at once. All the
+fields are solved together by a vectorised Levenberg-Marquardt with the
+analytic Jacobian of the model, and the fitted tables can be saved and then
+used by name in the operator.
+"""
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+from .sar_forward_model import WCM_PARAMETERS, register_parameters
+
+PARAMETER_NAMES = ["A", "B", "C", "D", "E"]
+
+# Bounds of the parameters during the fit: the attenuation (B) and the
+# vegetation backscatter (A) can not be negative
+PARAMETER_BOUNDS = {"A": (0., np.inf), "B": (0., np.inf),
+                    "C": (-np.inf, np.inf), "D": (-np.inf, np.inf),
+                    "E": (-np.inf, np.inf)}
+
+CalibrationResult = namedtuple("CalibrationResult",
+                               "parameters cost n_iter converged stalled")
+
+
+def wcm_backscatter(parameters, V, SM, theta):
+    """Water Cloud Model backscatter and its Jacobian with respect to the
+    model parameters, for many fields at once.
+
+    Input
+    ------
+    parameters: (n_fields, 5) array of A, B, C, D, E
+    V, SM: (n_fields, n_obs) vegetation descriptor and soil moisture
+    theta: incidence angle [deg], broadcastable to (n_fields, n_obs)
+
+    Output
+    ------
+    sigma_0: (n_fields, n_obs) linear backscatter
+    jac: (n_fields, n_obs, 5) derivatives of sigma_0 with respect to A, B,
+         C, D and E
+    """
+    A, B, C, D, E = [p[:, None] for p in np.asarray(parameters).T]
+    mu = np.cos(np.deg2rad(theta))
+    V_mu = V / mu
+    tau = np.exp(-2 * B * V_mu)
+    sigma_surf = 10 ** ((C + D * SM) / 10.)
+    V_E = V ** E
+    sigma_veg = A * V_E * mu * (1 - tau)
+    sigma_0 = sigma_veg + tau * sigma_surf
+
+    jac = np.empty(sigma_0.shape + (5,))
+    jac[..., 0] = V_E * mu * (1 - tau)
+    jac[..., 1] = 2 * V_mu * tau * (A * V_E * mu - sigma_surf)
+    jac[..., 2] = np.log(10) / 10. * tau * sigma_surf
+    jac[..., 3] = jac[..., 2] * SM
+    # V**E is constant for V == 0
+    log_V = np.log(np.where(V > 0, V, 1.))
+    jac[..., 4] = sigma_veg * log_V
+    return sigma_0, jac
+
+
+def _residuals(parameters, backscatter, V, SM, theta, weights, in_db):
+    """weighted residuals and Jacobian of the residuals of every field"""
+    sigma_0, jac = wcm_backscatter(parameters, V, SM, theta)
+    if in_db:
+        sigma_0 = np.maximum(sigma_0, 1e-10)
+        residual = backscatter - 10 * np.log10(sigma_0)
+        jac *= (10. / np.log(10) / sigma_0)[..., None]
+    else:
+        residual = backscatter - sigma_0
+    return residual, jac, np.sum(weights * residual ** 2, axis=1)
+
+
+def calibrate_wcm(backscatter, V, SM, theta, weights=None, initial=None,
+                  fixed=None, bounds=None, in_db=True, max_iter=100,
+                  tol=1e-8, damping=1e-3):
+    """Fits the Water Cloud Model parameters of many fields at once.
+
+    Fields with fewer observations are padded: padded (or missing)
+    observations are NaN or have zero weight. Every field has its own
+    Levenberg-Marquardt damping, and the 5x5 normal equations of all the
+    fields are solved together with a batched np.linalg.solve.
+
+    Input
+    ------
+    backscatter: (n_fields, n_obs) observed backscatter, in dB if in_db
+                 (residuals are then computed in dB), linear otherwise
+    V, SM: (n_fields, n_obs) vegetation descriptor (e.g. LAI) and soil
+           moisture [m^3/m^3]
+    theta: incidence angle [deg], broadcastable to (n_fields, n_obs)
+    weights: (n_fields, n_obs) weights of the observations (e.g.
+             1/variance), by default 1 for every finite observation
+    initial: initial parameters, an (n_fields, 5) array or 5 values, by
+             default the VV parameters of WCM_PARAMETERS
+    fixed: boolean mask of parameters that are not fitted, 5 values or an
+           (n_fields, 5) array
+    bounds: dictionary of (min, max) per parameter name, updating
+            PARAMETER_BOUNDS
+    max_iter, tol: maximum number of iterations, and relative decrease of
+                   the cost below which a field has converged
+    damping: initial Levenberg-Marquardt damping
+
+    Output
+    ------
+    CalibrationResult (namedtuple) with the (n_fields, 5) parameters, the
+    weighted sum of squared residuals, the number of iterations, whether
+    each field converged, and whether it stalled: no damping lowered its
+    cost any more before it converged, so its fit may be poor. Stalled
+    fields are not converged
+    """
+    backscatter = np.atleast_2d(np.asarray(backscatter, dtype=float))
+    n_fields, n_obs = backscatter.shape
+    V, SM = [np.broadcast_to(np.asarray(a, dtype=float), backscatter.shape)
+             for a in (V, SM)]
+    theta = np.broadcast_to(np.asarray(theta, dtype=float),
+                            backscatter.shape)
+    valid = np.isfinite(backscatter) & np.isfinite(V) & np.isfinite(SM) & \
+        np.isfinite(theta)
+    if weights is None:
+        weights = valid.astype(float)
+    else:
+        weights = np.where(valid, weights, 0.)
+    # Padded observations get harmless values and zero weight
+    backscatter = np.where(valid, backscatter, 0.)
+    V, SM = np.where(valid, V, 0.), np.where(valid, SM, 0.)
+    theta = np.where(valid, theta, 0.)
+
+    if initial is None:
+        initial = WCM_PARAMETERS["VV"]
+    parameters = np.array(np.broadcast_to(np.asarray(initial, dtype=float),
+                                          (n_fields, 5)))
+    if fixed is None:
+        fixed = np.zeros(5, dtype=bool)
+    free = ~np.broadcast_to(np.asarray(fixed, dtype=bool), (n_fields, 5))
+    limits = dict(PARAMETER_BOUNDS)
+    if bounds is not None:
+        limits.update(bounds)
+    lower = np.array([limits[name][0] for name in PARAMETER_NAMES])
+    upper = np.array([limits[name][1] for name in PARAMETER_NAMES])
+    parameters = np.clip(parameters, lower, upper)
+
+    residual, jac, cost = _residuals(parameters, backscatter, V, SM, theta,
+                                     weights, in_db)
+    lam = np.full(n_fields, damping)
+    converged = np.zeros(n_fields, dtype=bool)
+    stalled = np.zeros(n_fields, dtype=bool)
+    n_iter = np.zeros(n_fields, dtype=int)
+    eye = np.eye(5)
+    for _ in range(max_iter):
+        # Only the fields that have not converged yet are updated
+        active = np.flatnonzero(~(converged | stalled))
+        if active.size == 0:
+            break
+        n_iter[active] += 1
+        w, free_a, lam_a = weights[active], free[active], lam[active]
+        # Normal equations of every field, with fixed parameters reduced to
+        # identity rows so that their step is zero
+        jac_free = jac[active] * free_a[:, None, :]
+        wjac = w[..., None] * jac_free
+        hessian = np.einsum("foi,foj->fij", wjac, jac_free)
+        gradient = np.einsum("foi,fo->fi", wjac, residual[active])
+        diagonal = np.diagonal(hessian, axis1=1, axis2=2)
+        scale = np.where(free_a, np.maximum(diagonal, 1e-12), 1.)
+        system = hessian + (lam_a[:, None] * scale)[:, :, None] * eye
+        system[~free_a] = eye[np.nonzero(~free_a)[1]]
+        step = np.linalg.solve(system, gradient[..., None])[..., 0]
+        step[~free_a] = 0.
+
+        candidate = np.clip(parameters[active] + step, lower, upper)
+        new_residual, new_jac, new_cost = _residuals(
+            candidate, backscatter[active], V[active], SM[active],
+            theta[active], w, in_db)
+        old_cost = cost[active]
+        better = new_cost <= old_cost
+        decrease = (old_cost - new_cost) / np.where(old_cost > 0, old_cost,
+                                                    1.)
+        improved = active[better]
+        parameters[improved] = candidate[better]
+        residual[improved] = new_residual[better]
+        jac[improved] = new_jac[better]
+        cost[improved] = new_cost[better]
+        lam[active] = np.where(better, lam_a / 10., lam_a * 10.)
+        # Converged when the cost hardly decreases, stalled when no damping
+        # gives a decrease any more
+        converged[active] = better & (decrease < tol)
+        stalled[active] = ~converged[active] & (lam[active] > 1e12)
+    return CalibrationResult(parameters, cost, n_iter, converged, stalled)
+
+
+def group_observations(labels, *arrays):
+    """Pads flat observations of many groups (fields or land cover classes)
+    to (n_groups, max_obs) arrays, missing observations being NaN.
+
+    Input
+    ------
+    labels: (n,) group of every observation
+    arrays: (n,) arrays of the observations (e.g. backscatter, V, SM, theta)
+
+    Output
+    ------
+    groups: sorted unique labels
+    padded: list of (n_groups, max_obs) arrays, in the order of arrays
+    """
+    labels = np.asarray(labels)
+    groups, inverse, counts = np.unique(labels, return_inverse=True,
+                                        return_counts=True)
+    order = np.argsort(inverse, kind="mergesort")
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    rows = inverse[order]
+    cols = np.arange(labels.size) - starts[rows]
+    padded = []
+    for array in arrays:
+        out = np.full((groups.size, counts.max()), np.nan)
+        out[rows, cols] = np.asarray(array, dtype=float)[order]
+        padded.append(out)
+    return groups, padded
+
+
+def calibrate_groups(labels, backscatter, V, SM, theta, **kwargs):
+    """Fits the Water Cloud Model parameters of every group (e.g. field or
+    land cover class) of flat observations, see calibrate_wcm for the
+    options.
+
+    Output
+    ------
+    groups: sorted unique labels
+    CalibrationResult, with one row per group
+    """
+    theta = np.broadcast_to(theta, np.shape(labels))
+    groups, (backscatter, V, SM, theta) = group_observations(
+        labels, backscatter, V, SM, theta)
+    return groups, calibrate_wcm(backscatter, V, SM, theta, **kwargs)
+
+
+def parameter_tables(groups, parameters, polarisation, tables=None,
+                     register=False):
+    """Tables of model parameters for sar_observation_operator, one per
+    group, e.g. to be saved with save_parameters.
+
+    Input
+    ------
+    groups: names of the groups (e.g. crop types)
+    parameters: (n_groups, 5) fitted parameters
+    polarisation: polarisation the parameters were fitted for
+    tables: existing tables to update (e.g. with another polarisation)
+    register: whether to register every table under its group name
+
+    Output
+    ------
+    dictionary of group name: {polarisation: [A, B, C, D, E]}
+    """
+    if tables is None:
+        tables = OrderedDict()
+    for group, values in zip(groups, parameters):
+        table = tables.setdefault(str(group), OrderedDict())
+        table[polarisation.upper()] = [float(p) for p in values]
+        if register:
+            register_parameters(str(group), table)
+    return tables
@@ -11,5 +11,6 @@ setup(name='multiply-forward-operators',
       version=version,
       description='MULTIPLY Forward Operators',
       author='MULTIPLY Team',
-      packages=['multiply_forward_operators']
+      packages=['multiply_forward_operators'],
+      python_requires='>=3.5'
       )
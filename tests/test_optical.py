@@ -1,17 +1,27 @@
 #!/usr/bin/env python
+import multiprocessing
 import os
+import pickle
 import sys
 
 from distutils import dir_util
 
 import numpy as np
 
+import pytest
 from pytest import fixture
 
 myPath = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, myPath + '/../')
 
 from multiply_forward_operators import optical_forward_operator
+from multiply_forward_operators import optical_forward_operator_batch
+from multiply_forward_operators.optical_forward_model import leaf_spectra_cache
+from multiply_forward_operators.optical_forward_model import \
+    CachedOpticalOperator
+from multiply_forward_operators.optical_emulator import OpticalEmulator
+from multiply_forward_operators.pixel_index import PixelIndex
+from multiply_forward_operators.prosail_lut import build_lut
 
 
 @fixture
@@ -85,3 +95,239 @@ def test_prosail5(datadir):
     fname = datadir("prosail5.txt")
     r_save = np.loadtxt(fname)
     assert np.allclose(r_fwd, r_save)
+
+
+def test_prosaild_batch():
+    x = np.array([[2.1, 12., 40., 10., 0.1, 0.001, 0.001, 4., 45., 0.1, 0.1],
+                  [1.5, 5., 20., 5., 0.2, 0.01, 0.005, 1., 60., 0.5, 0.9],
+                  [1.8, 0., 60., 12., 0., 0.02, 0.01, 6., 30., 1., 0.5]])
+    vza = np.array([0., 15., 30.])
+    raa = np.array([0., 90., 180.])
+    r_batch = optical_forward_operator_batch(x, 30., vza, raa,
+                                             version="PROSAIL_D", hspot=0.1,
+                                             n_processes=2, chunk_size=2)
+    assert r_batch.shape == (3, 2101)
+    for i in range(3):
+        r = optical_forward_operator(x[i], 30., vza[i], raa[i],
+                                     version="PROSAIL_D", hspot=0.1)
+        assert np.allclose(r_batch[i], r, rtol=0, atol=0)
+
+
+def test_prosaild_batch_shared_pool():
+    x = np.array([[2.1, 12., 40., 10., 0.1, 0.001, 0.001, 4., 45., 0.1, 0.1],
+                  [1.5, 5., 20., 5., 0.2, 0.01, 0.005, 1., 60., 0.5, 0.9],
+                  [1.8, 0., 60., 12., 0., 0.02, 0.01, 6., 30., 1., 0.5]])
+    r_serial = optical_forward_operator_batch(x, 30., 10., 0., n_processes=1)
+    pool = multiprocessing.Pool(2)
+    try:
+        # The same pool serves several calls, and is left open
+        for _ in range(2):
+            r = optical_forward_operator_batch(x, 30., 10., 0., chunk_size=1,
+                                               pool=pool)
+            assert np.allclose(r, r_serial, rtol=0, atol=0)
+        r, grad = optical_forward_operator_batch(x, 30., 10., 0.,
+                                                 chunk_size=1, pool=pool,
+                                                 return_jacobian=True)
+        assert grad.shape == (3, 2101, 11)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def test_prosaild_batch_pixel_index():
+    x = np.array([[2.1, 12., 40., 10., 0.1, 0.001, 0.001, 4., 45., 0.1, 0.1],
+                  [1.5, 5., 20., 5., 0.2, 0.01, 0.005, 1., 60., 0.5, 0.9],
+                  [1.8, 0., 60., 12., 0., 0.02, 0.01, 6., 30., 1., 0.5],
+                  [1.5, 5., 20., 5., 0.2, 0.01, 0.005, 2., 60., 0.5, 0.9]])
+    vza = np.array([0., 15., 30., 45.])
+    pixel_index = PixelIndex(np.array([[True, False], [False, True]]))
+    r = optical_forward_operator_batch(x.reshape(2, 2, -1), 30.,
+                                       vza.reshape(2, 2), 0.,
+                                       n_processes=1,
+                                       pixel_index=pixel_index)
+    r_full = optical_forward_operator_batch(x, 30., vza, 0., n_processes=1)
+    assert r.shape == (2, 2101)
+    assert np.allclose(r, r_full[[0, 3]], rtol=0, atol=0)
+    r_grid = pixel_index.scatter(r, np.nan, axis=0)
+    assert r_grid.shape == (2, 2, 2101)
+    assert np.all(np.isnan(r_grid[0, 1])) and np.all(r_grid[1, 1] == r[1])
+
+
+def test_prosaild_batch_empty_pixel_index():
+    pixel_index = PixelIndex(np.zeros((2, 2), dtype=bool))
+    r = optical_forward_operator_batch(np.ones((2, 2, 11)), 30., 0., 0.,
+                                       pixel_index=pixel_index)
+    assert r.shape == (0, 2101)
+    r, grad = optical_forward_operator_batch(np.ones((2, 2, 11)), 30., 0.,
+                                             0., srf="Sentinel2",
+                                             return_jacobian=True,
+                                             pixel_index=pixel_index)
+    assert r.shape == (0, 13)
+    assert grad.shape == (0, 13, 11)
+    assert pixel_index.scatter(r, np.nan, axis=0).shape == (2, 2, 13)
+
+
+def test_prosaild_srf():
+    x = 2.1, 12., 40., 10., 0.1, 0.001, 0.001, 4., 45., 0.1, 0.1
+    r = optical_forward_operator(x, 30., 10., 45., version="PROSAIL_D")
+    r_s2 = optical_forward_operator(x, 30., 10., 45., version="PROSAIL_D",
+                                    srf="Sentinel2")
+    assert r_s2.shape == (13,)
+    # B4 (red) is the mean reflectance over its band pass
+    assert np.allclose(r_s2[3], r[250:281].mean(), rtol=1e-2)
+    r_l8 = optical_forward_operator_batch(np.array([x, x]), 30., 10., 45.,
+                                          version="PROSAIL_D", srf="OLI",
+                                          n_processes=1)
+    assert r_l8.shape == (2, 9)
+    # A band defined by the user
+    srf = np.zeros(2101)
+    srf[465] = 1.
+    r_user = optical_forward_operator(x, 30., 10., 45., version="PROSAIL_D",
+                                      srf=srf)
+    assert np.allclose(r_user, r[465])
+
+
+def test_prosaild_emulator(tmpdir):
+    emulator = OpticalEmulator.from_prosail(200, 30., 10., 45.,
+                                            version="PROSAIL_D",
+                                            srf="Sentinel2", seed=1,
+                                            n_processes=1)
+    validation = emulator.metadata["validation"]
+    assert validation["n_samples"] == 40
+    assert np.all(np.array(validation["rmse"]) < 0.05)
+    x = np.array([[2.1, 12., 40., 10., 0.1, 0.01, 0.01, 4., 45., 0.5, 0.5],
+                  [1.5, 5., 20., 5., 0.2, 0.02, 0.005, 1., 60., 1., 0.9]])
+    rho, jacobian = emulator(x)
+    assert rho.shape == (2, 13)
+    assert jacobian.shape == (2, 13, 11)
+    # Analytic Jacobian against finite differences of the emulator
+    for p in range(11):
+        dx = np.zeros(11)
+        dx[p] = 1e-5 * (emulator.x_max[p] - emulator.x_min[p])
+        fd = (emulator.predict(x + dx, return_jacobian=False) -
+              emulator.predict(x - dx, return_jacobian=False)) / (2 * dx[p])
+        assert np.allclose(jacobian[:, :, p], fd, rtol=1e-4, atol=1e-6)
+    fname = str(tmpdir.join("emulator.npz"))
+    emulator.save(fname)
+    loaded = OpticalEmulator.load(fname)
+    assert loaded.metadata["bands"] == emulator.metadata["bands"]
+    assert np.allclose(loaded.predict(x, return_jacobian=False), rho)
+
+
+def test_prosaild_lut(tmpdir):
+    fixed = dict(n=2.1, ant=12., cab=40., car=10., cbrown=0.1, cw=0.001,
+                 cm=0.001, ala=45., rsoil=0.1, psoil=0.1, sza=30., raa=0.)
+    fname = str(tmpdir.join("lut.npy"))
+    lut = build_lut(fname, [("lai", [1., 2., 4.]), ("vza", [0., 10., 20.])],
+                    fixed=fixed, version="PROSAIL_D", hspot=0.1,
+                    srf="Sentinel2", n_processes=1)
+    assert isinstance(lut.table, np.memmap)
+    assert lut.table.shape == (9, 13)
+    x = np.array([[2.1, 12., 40., 10., 0.1, 0.001, 0.001, 2., 45., 0.1, 0.1],
+                  [2.1, 12., 40., 10., 0.1, 0.001, 0.001, 3., 45., 0.1, 0.1]])
+    r_true = optical_forward_operator_batch(x, 30., 10., 0.,
+                                            version="PROSAIL_D", hspot=0.1,
+                                            srf="Sentinel2", n_processes=1)
+    r_lut = lut(x, 30., 10., 0.)
+    # On the grid nodes the LUT is exact, in between it interpolates
+    assert np.allclose(r_lut[0], r_true[0])
+    assert np.allclose(r_lut[1], r_true[1], atol=0.03)
+    assert np.allclose(r_lut[1], 0.5 * (lut(x[0], 30., 10., 0.) +
+                                        lut(x[0] + np.eye(11)[7] * 2, 30.,
+                                            10., 0.)))
+    # Non-gridded variables must match the fixed values of the LUT
+    with pytest.raises(ValueError):
+        lut(x + np.eye(11)[2], 30., 10., 0.)
+    with pytest.raises(ValueError):
+        lut(x, 35., 10., 0.)
+    lut_copy = pickle.loads(pickle.dumps(lut))
+    assert isinstance(lut_copy.table, np.memmap)
+    assert np.allclose(lut_copy(x, 30., 10., 0.), r_lut)
+    # Fixed values of gridded variables (e.g. from a dictionary of
+    # defaults) do not pin the LUT to them
+    fixed.update(lai=3., vza=5.)
+    lut = build_lut(fname, [("lai", [1., 2., 4.]), ("vza", [0., 10., 20.])],
+                    fixed=fixed, version="PROSAIL_D", hspot=0.1,
+                    srf="Sentinel2", n_processes=1)
+    assert "lai" not in lut.metadata["fixed"]
+    assert "vza" not in lut.metadata["fixed"]
+    assert np.allclose(lut(x, 30., 10., 0.), r_lut)
+
+
+def test_prosaild_leaf_spectra_reuse():
+    leaf_spectra_cache.clear()
+    x = 2.1, 12., 40., 10., 0.1, 0.001, 0.001, 4., 45., 0.1, 0.1
+    for vza in [0., 10., 20.]:
+        for lai in [1., 2.]:
+            x = x[:7] + (lai,) + x[8:]
+            optical_forward_operator(x, 30., vza, 0., version="PROSAIL_D")
+    # PROSPECT only ran for the first evaluation
+    assert leaf_spectra_cache.misses == 1
+    assert leaf_spectra_cache.hits == 5
+
+
+def test_prosaild_jacobian():
+    x = np.array([[2.1, 12., 40., 10., 0.1, 0.01, 0.005, 4., 45., 0.5, 0.5],
+                  [1.5, 5., 20., 5., 0.2, 0.02, 0.005, 1., 60., 1., 0.9]])
+    rho, grad = optical_forward_operator_batch(
+        x, 30., np.array([0., 20.]), 45., srf="Sentinel2", n_processes=2,
+        chunk_size=1, return_jacobian=True, fd_scheme="central")
+    assert rho.shape == (2, 13)
+    assert grad.shape == (2, 13, 11)
+    assert np.allclose(rho, optical_forward_operator_batch(
+        x, 30., np.array([0., 20.]), 45., srf="Sentinel2", n_processes=1))
+    # Against one parameter at a time finite differences
+    step = 1e-4 * np.maximum(np.abs(x[1]), 1e-2)
+    for p in [2, 7, 10]:
+        dx = np.zeros(11)
+        dx[p] = step[p]
+        fd = (optical_forward_operator(x[1] + dx, 30., 20., 45.,
+                                       srf="Sentinel2") -
+              optical_forward_operator(x[1] - dx, 30., 20., 45.,
+                                       srf="Sentinel2")) / (2 * step[p])
+        assert np.allclose(grad[1, :, p], fd)
+    rho_1, grad_1 = optical_forward_operator(x[1], 30., 20., 45.,
+                                             srf="Sentinel2",
+                                             return_jacobian=True)
+    assert np.allclose(rho_1, rho[1])
+    assert np.allclose(grad_1, grad[1], rtol=1e-3, atol=1e-6)
+
+
+def test_prosaild_cached_operator():
+    x = np.array([2.1, 12., 40., 10., 0.1, 0.001, 0.001, 4., 45., 0.1, 0.1])
+    operator = CachedOpticalOperator(version="PROSAIL_D", hspot=0.1)
+    r = operator(x, 30., 10., 45.)
+    assert np.allclose(r, optical_forward_operator(x, 30., 10., 45.,
+                                                   version="PROSAIL_D",
+                                                   hspot=0.1))
+    operator(x, 30., 10., 45.)
+    assert operator.stats()["hits"] == 1
+    assert operator.stats()["misses"] == 1
+    # Homogeneous field: one PROSAIL run for the (quantised) batch
+    operator = CachedOpticalOperator(version="PROSAIL_D", hspot=0.1,
+                                     state_quantum=1e-3, angle_quantum=1.)
+    x_field = x + np.random.uniform(-1e-4, 1e-4, size=(10, 11))
+    r_field = operator.batch(x_field, 30., 10.2, 45., n_processes=1)
+    assert np.allclose(r_field, r[None, :], atol=1e-3)
+    assert operator.stats()["misses"] == 1
+    assert operator.stats()["hits"] == 9
+    # Memory cap
+    operator = CachedOpticalOperator(version="PROSAIL_D", hspot=0.1,
+                                     maxbytes=2 * r.nbytes)
+    for vza in [0., 10., 20.]:
+        operator(x, 30., vza, 45.)
+    assert operator.stats()["size"] == 2
+    assert operator.stats()["evictions"] == 1
+    assert operator.stats()["nbytes"] <= 2 * r.nbytes
+    # and through the batch path, where the cached spectra must not be
+    # views of the whole batch
+    operator = CachedOpticalOperator(version="PROSAIL_D", hspot=0.1,
+                                     maxbytes=2 * r.nbytes)
+    x_field = np.tile(x, (6, 1))
+    x_field[:, 7] = np.linspace(0.5, 3., 6)
+    r_field = operator.batch(x_field, 30., 10., 45., n_processes=1)
+    assert r_field.shape == (6, r.size)
+    assert operator.stats()["size"] == 2
+    assert operator.stats()["nbytes"] <= 2 * r.nbytes
+    for rho in operator.cache._data.values():
+        assert rho.base is None
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+import os
+import sys
+import threading
+import time
+import weakref
+
+import numpy as np
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../')
+
+from multiply_forward_operators.parallel import WORKER_DIED, prefetch
+from multiply_forward_operators.parallel import run_tasks
+
+
+class Reader(object):
+    """reads 1000 float64 (8000 bytes) per item, the first one slowly, and
+    records the items started"""
+
+    def __init__(self):
+        self.started = []
+        self.lock = threading.Lock()
+
+    def __call__(self, item):
+        with self.lock:
+            self.started.append(item)
+        if item == 0:
+            time.sleep(0.2)
+        return np.full(1000, item, dtype=np.float64)
+
+
+def read_ahead(max_bytes, lookahead=4):
+    """number of items started beyond the current one at every step"""
+    reader = Reader()
+    stats = {}
+    ahead = []
+    for i, (item, value) in enumerate(prefetch(
+            reader, range(6), lookahead=lookahead, max_workers=4,
+            max_bytes=max_bytes, stats=stats)):
+        assert item == i and np.all(value == i)
+        ahead.append(len(reader.started) - i - 1)
+    assert stats["n_items"] == 6
+    assert stats["read_time"] >= 0.2
+    return ahead
+
+
+def test_prefetch_lookahead():
+    ahead = read_ahead(None)
+    # the reading threads had the whole sleep of the first item to start
+    # the items read ahead
+    assert ahead[0] >= 3
+    assert max(ahead) <= 4
+
+
+def test_prefetch_max_bytes():
+    # Only the first item is read until its size is known, then the current
+    # item and one read ahead fit in 20000 bytes
+    ahead = read_ahead(20000)
+    assert max(ahead) <= 1
+    # Results larger than max_bytes are read one at a time
+    assert max(read_ahead(100)) == 0
+
+
+def test_prefetch_early_exit():
+    reader = Reader()
+    for item, value in prefetch(reader, range(100), lookahead=2):
+        break
+    assert len(reader.started) <= 3
+
+
+def square(task):
+    if task == 3:
+        # a worker dying in native code
+        os._exit(1)
+    if task == 5:
+        raise ValueError("unreadable")
+    return task * task
+
+
+def test_run_tasks_worker_crash():
+    results, errors = run_tasks(square, range(10), n_processes=2)
+    assert errors[3] == WORKER_DIED
+    assert errors[5] == "ValueError: unreadable"
+    for task in [0, 1, 2, 4, 6, 7, 8, 9]:
+        assert results[task] == task * task
+        assert errors[task] is None
+    assert results[3] is None and results[5] is None
+
+
+class CountingReader(object):
+    """reads 100 bytes per item after an uneven delay, and records the
+    largest number of results alive"""
+
+    def __init__(self):
+        self.alive = 0
+        self.max_alive = 0
+        self.lock = threading.Lock()
+        self.delays = np.random.RandomState(0).uniform(0., 0.02, 100)
+
+    def _release(self):
+        with self.lock:
+            self.alive -= 1
+
+    def __call__(self, item):
+        time.sleep(self.delays[item])
+        value = np.zeros(100, dtype=np.uint8)
+        with self.lock:
+            self.alive += 1
+            self.max_alive = max(self.max_alive, self.alive)
+        weakref.finalize(value, self._release)
+        return value
+
+
+def test_prefetch_max_bytes_alive():
+    reader = CountingReader()
+    for item, value in prefetch(reader, range(30), lookahead=4,
+                                max_workers=4, max_bytes=200):
+        time.sleep(reader.delays[-1 - item])
+        del value
+    # the current result and one read ahead, including while the next
+    # results are read
+    assert reader.max_alive <= 2
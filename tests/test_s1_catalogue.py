@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+import datetime
+import os
+import sys
+
+import numpy as np
+
+import pytest
+
+netCDF4 = pytest.importorskip("netCDF4")
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../')
+
+from multiply_forward_operators.s1_catalogue import DateIndex, S1Catalogue
+
+
+def write_scene(fname, date, orbitdirection="ASCENDING"):
+    data = netCDF4.Dataset(fname, "w")
+    data.createDimension("y", 2)
+    data.createDimension("x", 3)
+    for name in ["sigma0_vv_multi", "sigma0_vh_multi", "theta"]:
+        var = data.createVariable(name, "f4", ("y", "x"))
+        var[:] = np.ones((2, 3))
+    data.setncattr("date", date)
+    data.setncattr("frequency", 5.405)
+    data.setncattr("orbitdirection", orbitdirection)
+    data.setncattr("relativeorbit", 117)
+    data.close()
+
+
+def test_catalogue_incremental(tmpdir):
+    write_scene(str(tmpdir.join("a.nc")), "2017-01-01T16:58:53")
+    write_scene(str(tmpdir.join("b.nc")), "2017-01-07T16:58:53",
+                "DESCENDING")
+    catalogue = S1Catalogue(str(tmpdir))
+    assert len(catalogue) == 2
+    assert catalogue.n_scanned == 2
+    record = catalogue[str(tmpdir.join("b.nc"))]
+    assert record["date"] == "2017-01-07T16:58:53"
+    assert record["orbitdirection"] == "DESCENDING"
+    assert record["relativeorbit"] == 117
+    assert record["frequency"] == pytest.approx(5.405)
+    assert record["polarisations"] == {"vv": "sigma0_vv_multi",
+                                       "vh": "sigma0_vh_multi"}
+    assert record["theta"] == "theta"
+    assert os.path.exists(catalogue.catalogue_file)
+
+    # A new construction only reads new files
+    write_scene(str(tmpdir.join("c.nc")), "2017-01-13T16:58:53")
+    catalogue = S1Catalogue(str(tmpdir))
+    assert len(catalogue) == 3
+    assert catalogue.n_scanned == 1
+    assert catalogue.n_reused == 2
+
+    # and changed or removed files
+    os.remove(str(tmpdir.join("a.nc")))
+    write_scene(str(tmpdir.join("b.nc")), "2017-01-08T16:58:53")
+    os.utime(str(tmpdir.join("b.nc")), (0, 0))
+    catalogue = S1Catalogue(str(tmpdir))
+    assert len(catalogue) == 2
+    assert catalogue.n_scanned == 1
+    assert catalogue[str(tmpdir.join("b.nc"))]["date"] == \
+        "2017-01-08T16:58:53"
+
+
+def test_catalogue_select(tmpdir):
+    write_scene(str(tmpdir.join("a.nc")), "2017-01-01T16:58:53")
+    write_scene(str(tmpdir.join("b.nc")), "2017-01-07T16:58:53",
+                "DESCENDING")
+    write_scene(str(tmpdir.join("c.nc")), "2017-01-13T16:58:53")
+    catalogue = S1Catalogue(str(tmpdir))
+    names = lambda files: [os.path.basename(fich) for fich in files]
+    assert names(catalogue.select()) == ["a.nc", "b.nc", "c.nc"]
+    assert names(catalogue.select(orbitdirection="ascending")) == \
+        ["a.nc", "c.nc"]
+    assert names(catalogue.select("2017-01-02", "2017-01-13T16:58:53")) == \
+        ["b.nc", "c.nc"]
+    assert names(catalogue.select(end_date="2017-01-10",
+                                  orbitdirection=["DESCENDING"])) == ["b.nc"]
+    assert catalogue.select(relativeorbit=44) == []
+    assert names(catalogue.select(relativeorbit=117)) == \
+        ["a.nc", "b.nc", "c.nc"]
+
+
+def test_date_index():
+    dates = [datetime.datetime(2017, 1, day) for day in [13, 1, 7, 19]]
+    index = DateIndex(dates)
+    assert list(index) == sorted(dates)
+    assert index.between("2017-01-07", "2017-01-13") == sorted(dates)[1:3]
+    assert index.between(t1=datetime.datetime(2017, 1, 6)) == [dates[1]]
+    assert index.between("2017-02-01") == []
+    assert index.nearest("2017-01-09") == datetime.datetime(2017, 1, 7)
+    assert index.nearest("2017-01-11") == datetime.datetime(2017, 1, 13)
+    assert index.nearest("2016-12-01") == datetime.datetime(2017, 1, 1)
+    assert index.nearest("2017-03-01") == datetime.datetime(2017, 1, 19)
+    with pytest.raises(ValueError):
+        DateIndex([]).nearest("2017-01-01")
@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+import gc
+import os
+import sys
+import weakref
+
+import numpy as np
+
+import pytest
+
+gdal = pytest.importorskip("osgeo.gdal")
+netCDF4 = pytest.importorskip("netCDF4")
+from osgeo import osr
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../')
+
+from multiply_forward_operators.S1Observations import S1Observations
+from multiply_forward_operators.pixel_index import PixelIndex
+from multiply_forward_operators.resampling import NO_INDEX, IndexResampler
+from multiply_forward_operators.resampling import TargetGrid, reproject_image
+from multiply_forward_operators.uncertainty import DiagonalPrecision
+
+# Scenes are a 20 x 30 grid of 0.01 degrees from 10E, 50N
+LON0, LAT0, RES, SHAPE = 10., 50., 0.01, (20, 30)
+
+
+def write_scene(fname, date, seed=0, theta_res=None):
+    """Sentinel-1 like NetCDF file on a lat/lon grid, with the incidence
+    angle on its own grid of theta_res degrees if given"""
+    rng = np.random.RandomState(seed)
+    data = netCDF4.Dataset(fname, "w")
+
+    def add_grid(lat_name, lon_name, res):
+        ny, nx = int(round(SHAPE[0] * RES / res)), \
+            int(round(SHAPE[1] * RES / res))
+        data.createDimension(lat_name, ny)
+        data.createDimension(lon_name, nx)
+        lat = data.createVariable(lat_name, "f8", (lat_name,))
+        lat.units = "degrees_north"
+        lat.standard_name = "latitude"
+        lat[:] = LAT0 - res * (np.arange(ny) + 0.5)
+        lon = data.createVariable(lon_name, "f8", (lon_name,))
+        lon.units = "degrees_east"
+        lon.standard_name = "longitude"
+        lon[:] = LON0 + res * (np.arange(nx) + 0.5)
+        return (lat_name, lon_name), (ny, nx)
+
+    dims, shape = add_grid("lat", "lon", RES)
+    for name in ["sigma0_vv_multi", "sigma0_vh_multi"]:
+        var = data.createVariable(name, "f4", dims)
+        var[:] = rng.gamma(4., 0.025, shape)
+    if theta_res is not None:
+        dims, shape = add_grid("latc", "lonc", theta_res)
+    var = data.createVariable("theta", "f4", dims)
+    var[:] = np.linspace(30., 45., shape[1])[None, :] * np.ones((shape[0], 1))
+    data.setncattr("date", date)
+    data.setncattr("frequency", 5.405)
+    data.setncattr("orbitdirection", "ASCENDING")
+    data.setncattr("relativeorbit", 117)
+    data.close()
+
+
+def write_state_mask(fname, lon0=LON0 + 0.05, lat0=LAT0 + 0.03, res=0.005,
+                     shape=(30, 40)):
+    """GeoTIFF state mask, by default partly north of the scenes"""
+    ds = gdal.GetDriverByName("GTiff").Create(fname, shape[1], shape[0], 1,
+                                              gdal.GDT_Byte)
+    ds.SetGeoTransform((lon0, res, 0., lat0, 0., -res))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    ds.SetProjection(srs.ExportToWkt())
+    ds.GetRasterBand(1).WriteArray(np.ones(shape, dtype=np.uint8))
+    ds = None
+    return fname
+
+
+def make_archive(tmpdir, n_scenes=3, theta_res=None):
+    folder = tmpdir.mkdir("s1")
+    files = []
+    for i in range(n_scenes):
+        fname = str(folder.join("scene_{:d}.nc".format(i)))
+        write_scene(fname, "2017-01-{:02d}T16:58:53".format(1 + 6 * i),
+                    seed=i, theta_res=theta_res)
+        files.append(fname)
+    state_mask = write_state_mask(str(tmpdir.join("state_mask.tif")))
+    return str(folder), state_mask, files
+
+
+def test_open_band_pool(tmpdir):
+    folder, state_mask, files = make_archive(tmpdir, 2)
+    s1 = S1Observations(folder, state_mask, max_open_files=2)
+    handle = weakref.ref(s1._open_band(files[0], "sigma0_vv_multi"))
+    assert s1._open_band(files[0], "sigma0_vv_multi") is handle()
+    assert s1.pool_stats()["gdal_opens"] == 1
+    assert s1.pool_stats()["gdal_opens_avoided"] == 1
+
+    # The least recently used dataset is dropped, and so closed
+    s1._open_band(files[0], "sigma0_vh_multi")
+    s1._open_band(files[1], "sigma0_vv_multi")
+    gc.collect()
+    assert len(s1._handles) == 2
+    assert handle() is None
+    assert s1.pool_stats()["gdal_opens"] == 3
+
+    s1._open_band(files[1], "sigma0_vv_multi")
+    s1._open_band(files[0], "sigma0_vv_multi")
+    stats = s1.pool_stats()
+    assert stats["gdal_opens"] == 4
+    assert stats["gdal_opens_avoided"] == 2
+
+    s1.close()
+    assert len(s1._handles) == 0
+
+
+def test_pool_stats_get_band_data(tmpdir):
+    folder, state_mask, files = make_archive(tmpdir, 2)
+    s1 = S1Observations(folder, state_mask, index_resampling=False)
+    for timestep in s1.dates:
+        s1.get_band_data(timestep, 0)
+        s1.get_band_data(timestep, 0)
+    stats = s1.pool_stats()
+    # vv and theta of every scene are opened once
+    assert stats["gdal_opens"] == 4
+    assert stats["gdal_opens_avoided"] == 4
+    assert stats["target_opens_avoided"] == 8
+    assert stats["netcdf_opens_avoided"] >= 8
+
+
+def mem_dataset(data, geotransform, epsg, nodata=None):
+    ds = gdal.GetDriverByName("MEM").Create("", data.shape[1], data.shape[0],
+                                            1, gdal.GDT_Float32)
+    ds.SetGeoTransform(geotransform)
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(epsg)
+    ds.SetProjection(srs.ExportToWkt())
+    band = ds.GetRasterBand(1)
+    if nodata is not None:
+        band.SetNoDataValue(nodata)
+    band.WriteArray(data)
+    return ds
+
+
+def target_grid(geotransform, x_size, y_size, epsg):
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(epsg)
+    return TargetGrid(geotransform, x_size, y_size, srs.ExportToWkt())
+
+
+@pytest.mark.parametrize("nodata", [None, -999.])
+@pytest.mark.parametrize("grid", [
+    # same projection, finer, and partly north of the source
+    ((10.0413, 0.0037, 0., 50.0271, 0., -0.0043), 41, 33, 4326),
+    # UTM 32N, partly north of the source
+    ((575123., 487., 0., 5541234., 0., -491.), 21, 19, 32632)])
+def test_index_resampler_matches_warp(tmpdir, nodata, grid):
+    data = np.random.RandomState(1).gamma(4., 0.025, SHAPE)
+    src = mem_dataset(data, (LON0, RES, 0., LAT0, 0., -RES), 4326, nodata)
+    grid = target_grid(*grid)
+    expected = reproject_image(src, grid).ReadAsArray()
+
+    resampler = IndexResampler(grid, str(tmpdir))
+    resampled = resampler.resample(src)
+    np.testing.assert_array_equal(resampled, expected)
+    assert resampled.dtype == expected.dtype
+    # Pixels outside of the source get the nodata value (or 0)
+    outside = resampler.index_map(src) == NO_INDEX
+    assert outside.any() and not outside.all()
+    assert np.all(resampled[outside] == (0 if nodata is None else nodata))
+    # and only the window of the source under the grid is used
+    xoff, yoff, xsize, ysize = resampler.source_window(src)
+    assert xsize * ysize < SHAPE[0] * SHAPE[1]
+    np.testing.assert_array_equal(
+        resampler.resample(src, data=src.ReadAsArray()), expected)
+    np.testing.assert_array_equal(
+        resampler.resample(src, data=src.ReadAsArray(xoff, yoff, xsize,
+                                                     ysize)), expected)
+    assert resampler.n_warps == 1
+
+    # The index map is read back from the cache
+    cached = IndexResampler(grid, str(tmpdir))
+    np.testing.assert_array_equal(cached.resample(src), expected)
+    assert cached.n_warps == 0 and cached.n_disk_loads == 1
+
+
+def test_index_resampler_outside():
+    src = mem_dataset(np.ones(SHAPE), (LON0, RES, 0., LAT0, 0., -RES), 4326,
+                      -999.)
+    grid = target_grid((20., 0.01, 0., 40., 0., -0.01), 5, 4, 4326)
+    resampler = IndexResampler(grid)
+    assert resampler.source_window(src) is None
+    np.testing.assert_array_equal(resampler.resample(src),
+                                  np.full((4, 5), -999.))
+    np.testing.assert_array_equal(reproject_image(src, grid).ReadAsArray(),
+                                  np.full((4, 5), -999.))
+
+
+@pytest.mark.parametrize("index_resampling", [True, False])
+@pytest.mark.parametrize("theta_res", [None, 0.02])
+def test_get_observation(tmpdir, index_resampling, theta_res):
+    folder, state_mask, files = make_archive(tmpdir, 2, theta_res)
+    s1 = S1Observations(folder, state_mask,
+                        index_resampling=index_resampling)
+    assert s1.bands_per_observation == dict((timestep, 2)
+                                            for timestep in s1.dates)
+    for timestep, fname in zip(s1.dates, files):
+        expected = [reproject_image(gdal.Open('NETCDF:"{:s}":{:s}'.format(
+            fname, name)), s1.target_grid).ReadAsArray()
+            for name in ["sigma0_vv_multi", "sigma0_vh_multi", "theta"]]
+        sardata = s1.get_observation(timestep)
+        assert sardata.metadata["polarisations"] == ["vv", "vh"]
+        assert sardata.observations.shape == (2,) + expected[0].shape
+        np.testing.assert_array_equal(sardata.observations[0], expected[0])
+        np.testing.assert_array_equal(sardata.observations[1], expected[1])
+        np.testing.assert_array_equal(sardata.metadata["incidence_angle"],
+                                      expected[2])
+        band_data = s1.get_band_data(timestep, 1)
+        np.testing.assert_array_equal(band_data.observations, expected[1])
+        np.testing.assert_array_equal(band_data.metadata["incidence_angle"],
+                                      expected[2])
+
+
+@pytest.mark.parametrize("window", [None, (5, 0, 20, 15)])
+def test_compact_observations(tmpdir, window):
+    # The state mask is partly outside of the scenes, so that some of its
+    # pixels are invalid
+    folder, state_mask, files = make_archive(tmpdir, 1)
+    s1 = S1Observations(folder, state_mask)
+    timestep = s1.dates[0]
+
+    full = s1.get_observation(timestep, window=window)
+    sardata = s1.get_observation(timestep, window=window, compact=True)
+    index = sardata.mask
+    assert isinstance(index, PixelIndex)
+    valid = np.logical_and.reduce(full.mask, axis=0)
+    np.testing.assert_array_equal(index.mask, valid.ravel())
+    assert 0 < index.n_valid < valid.size
+    assert sardata.observations.shape == (2, index.n_valid)
+    np.testing.assert_array_equal(index.scatter(sardata.observations, 0.),
+                                  np.where(valid, full.observations, 0.))
+    np.testing.assert_array_equal(
+        index.scatter(sardata.metadata["incidence_angle"], 0.),
+        np.where(valid, full.metadata["incidence_angle"], 0.))
+    for R_compact, R_full in zip(sardata.uncertainty, full.uncertainty):
+        assert isinstance(R_compact, DiagonalPrecision)
+        assert R_compact.shape == (index.n_valid, index.n_valid)
+        np.testing.assert_array_equal(R_compact.values,
+                                      R_full.diagonal()[index.index])
+
+    full = s1.get_band_data(timestep, 0, window=window)
+    band_data = s1.get_band_data(timestep, 0, window=window, compact=True)
+    index = band_data.mask
+    assert isinstance(index, PixelIndex)
+    np.testing.assert_array_equal(index.mask, full.mask.ravel())
+    assert 0 < index.n_valid < full.mask.size
+    np.testing.assert_array_equal(index.scatter(band_data.observations, 0.),
+                                  np.where(full.mask, full.observations, 0.))
+    np.testing.assert_array_equal(
+        index.scatter(band_data.metadata["incidence_angle"], 0.),
+        np.where(full.mask, full.metadata["incidence_angle"], 0.))
+    assert isinstance(band_data.uncertainty, DiagonalPrecision)
+    assert band_data.uncertainty.shape == (index.n_valid, index.n_valid)
+    np.testing.assert_array_equal(band_data.uncertainty.values,
+                                  full.uncertainty.diagonal()[index.index])
+
+
+def test_iter_tiles(tmpdir):
+    folder, state_mask, files = make_archive(tmpdir, 1)
+    s1 = S1Observations(folder, state_mask,
+                        resampling_cache_dir=str(tmpdir.join("maps")),
+                        tile_size=(16, 12))
+    timestep = s1.dates[0]
+    full = s1.get_observation(timestep)
+    n_tiles = 0
+    for (xoff, yoff, xsize, ysize), tile in s1.iter_tiles(timestep):
+        rows, cols = slice(yoff, yoff + ysize), slice(xoff, xoff + xsize)
+        np.testing.assert_array_equal(tile.observations,
+                                      full.observations[:, rows, cols])
+        np.testing.assert_array_equal(tile.metadata["incidence_angle"],
+                                      full.metadata["incidence_angle"][rows,
+                                                                       cols])
+        for R_tile, R_full in zip(tile.uncertainty, full.uncertainty):
+            np.testing.assert_allclose(R_tile.diagonal(),
+                                       R_full.diagonal().reshape(
+                                           full.mask.shape[1:])[rows, cols]
+                                       .ravel())
+        n_tiles += 1
+    assert n_tiles == 9
+
+    # Every tile only reads the part of the scene under it (and its halo)
+    handle = s1._open_band(files[0], "sigma0_vv_multi")
+    for window in list(s1._window_resamplers._data):
+        source_window = s1._get_resampler(window).source_window(handle)
+        if source_window is not None:
+            assert source_window[2] * source_window[3] < \
+                SHAPE[0] * SHAPE[1] / 2
+
+
+def test_cube(tmpdir):
+    folder, state_mask, files = make_archive(tmpdir, 3)
+    cube_dir = str(tmpdir.join("cube"))
+    s1 = S1Observations(folder, state_mask, cube_dir=cube_dir)
+    assert s1.cube is None
+    s1.build_cube()
+    assert s1.cube is not None
+    folder_key = s1._cube_folder()
+
+    # A new construction opens the cube built earlier, and slices it
+    cached = S1Observations(folder, state_mask, cube_dir=cube_dir)
+    assert cached._cube_folder() == folder_key
+    assert cached.cube is not None
+    warped = S1Observations(folder, state_mask)
+    window = (5, 10, 20, 15)
+    for timestep in warped.dates:
+        expected = warped.get_observation(timestep)
+        sardata = cached.get_observation(timestep)
+        np.testing.assert_array_equal(sardata.observations,
+                                      expected.observations)
+        np.testing.assert_array_equal(sardata.mask, expected.mask)
+        np.testing.assert_array_equal(sardata.metadata["incidence_angle"],
+                                      expected.metadata["incidence_angle"])
+        expected = warped.get_band_data(timestep, 0, window=window)
+        band_data = cached.get_band_data(timestep, 0, window=window)
+        np.testing.assert_array_equal(band_data.observations,
+                                      expected.observations)
+        np.testing.assert_allclose(band_data.uncertainty.diagonal(),
+                                   expected.uncertainty.diagonal())
+    assert cached.pool_stats()["gdal_opens"] == 0
+
+    # The cube is keyed on the selected scenes
+    selected = S1Observations(folder, state_mask, cube_dir=cube_dir,
+                              start_date="2017-01-05")
+    assert selected._cube_folder() != folder_key
+    assert selected.cube is None
+
+
+def test_empty_cube(tmpdir):
+    folder, state_mask, files = make_archive(tmpdir, 1)
+    cube_dir = str(tmpdir.join("cube"))
+    s1 = S1Observations(folder, state_mask, cube_dir=cube_dir,
+                        start_date="2018-01-01")
+    with pytest.raises(ValueError):
+        s1.build_cube()
+    # A cube.json without data is not used
+    os.makedirs(s1._cube_folder())
+    with open(os.path.join(s1._cube_folder(), "cube.json"), "w") as fp:
+        fp.write('{"bands": ["theta"], "dates": []}')
+    s1 = S1Observations(folder, state_mask, cube_dir=cube_dir,
+                        start_date="2018-01-01")
+    assert s1.cube is None
+
+
+def test_ingest_unreadable_scene(tmpdir):
+    folder, state_mask, files = make_archive(tmpdir, 3)
+    s1 = S1Observations(folder, state_mask)
+    # The scene gets corrupted after it was catalogued
+    with open(files[1], "wb") as fp:
+        fp.write(b"not a NetCDF file" * 100)
+    result = s1.ingest(n_processes=2)
+    bad = s1.dates[1]
+    assert sorted(band for timestep, band in result.failed) == \
+        ["theta", "vh", "vv"]
+    assert all(timestep == bad for timestep, band in result.failed)
+    assert result.data[bad] == {}
+    assert result.stats["n_failed"] == 3
+    for timestep in [s1.dates[0], s1.dates[2]]:
+        assert sorted(result.data[timestep]) == ["theta", "vh", "vv"]
+        np.testing.assert_array_equal(
+            result.data[timestep]["vv"],
+            s1.get_band_data(timestep, 0).observations)
+
+
+def test_outside_scene_masked(tmpdir):
+    # The north of the state mask is outside of the scenes, where the
+    # resampling fills the observations with 0
+    folder, state_mask, files = make_archive(tmpdir, 1)
+    s1 = S1Observations(folder, state_mask)
+    sardata = s1.get_observation(s1.dates[0])
+    assert np.all(sardata.observations[:, 0] == 0)
+    assert not sardata.mask[:, 0].any()
+    assert sardata.mask[:, -1].all()
+    for R in sardata.uncertainty:
+        assert np.all(np.isfinite(R.diagonal()))
+    band_data = s1.get_band_data(s1.dates[0], 0)
+    assert not band_data.mask[0].any()
+    assert np.all(np.isfinite(band_data.uncertainty.diagonal()))
@@ -12,6 +12,10 @@ myPath = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, myPath + '/../')
 
 from multiply_forward_operators import sar_observation_operator
+from multiply_forward_operators.sar_forward_model import SARWorkspace
+from multiply_forward_operators.sar_forward_model import \
+    _jacobian_index_cache
+from multiply_forward_operators.pixel_index import PixelIndex
 
 
 def test_water_cloud_bs_vv():
@@ -77,3 +81,165 @@ def test_water_cloud_bs_vh_array():
     polarisation = "VH"
     sigma, dsigma = sar_observation_operator(x, polarisation)
     assert(np.allclose(sigma, np.array([1.087, 1.087, 1.087]), atol=1.e-3))
+
+
+def test_water_cloud_gradient_matches_loop():
+    np.random.seed(1)
+    x = np.vstack([np.random.uniform(0.01, 8., 500),
+                   np.random.uniform(0.05, 0.5, 500)])
+    mu = np.cos(np.deg2rad(23.))
+    for polarisation, (A, B, C, D, E) in [
+            ("VV", [0.0846, 0.0615, -14.8465, 15.907, 0.]),
+            ("VH", [0.0795, 0.1464, -14.8332, 15.907, 0.])]:
+        sigma, dsigma = sar_observation_operator(x, polarisation)
+        grad = x * 0
+        for i in range(x.shape[1]):
+            tau = np.exp(-2 * B / mu * x[0, i])
+            sigma_surf = 2 ** (1/10. * (C + D * x[1, i]) + 1) * \
+                5 ** (1/10. * (C + D * x[1, i]))
+            grad[0, i] = A * E * mu * (x[0, i] ** (E - 1)) * (1 - tau) + \
+                2 * A * B * (x[0, i] ** E) * tau - sigma_surf * B * tau / mu
+            grad[1, i] = D * np.log(10) * tau * \
+                10 ** (1/10. * (C + D * x[1, i]) - 1)
+        assert(np.allclose(dsigma, grad, rtol=0,
+                           atol=1e-14 * np.abs(grad).max()))
+
+
+def test_water_cloud_gradient_bare_soil():
+    # Bare soil (V = 0) with a vegetation exponent E != 0
+    parameters = {"VV": [0.0846, 0.0615, -14.8465, 15.907, 1.5],
+                  "VH": [0.0795, 0.1464, -14.8332, 15.907, 0.5]}
+    x = np.array([[0., 0.5, 2.], [0.1, 0.2, 0.3]])
+    mu = np.cos(np.deg2rad(23.))
+    sigma, dsigma = sar_observation_operator(x, ["VV", "VH"],
+                                             parameters=parameters)
+    assert np.all(np.isfinite(dsigma))
+    for i, (A, B, C, D, E) in enumerate(parameters.values()):
+        V, SM = x
+        tau = np.exp(-2 * B / mu * V)
+        sigma_surf = 10 ** ((C + D * SM) / 10.)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            d_veg = A * E * mu * V ** (E - 1) * (1 - tau)
+        d_veg[V == 0] = 0.
+        grad_V = d_veg + 2 * A * B * V ** E * tau - \
+            2 * B * tau * sigma_surf / mu
+        assert np.allclose(dsigma[i, 0], grad_V, rtol=1e-12, atol=0)
+    # Against finite differences from the right at V = 0
+    step = 1e-7
+    sigma_step, _ = sar_observation_operator(x + [[step], [0.]], "VV",
+                                             parameters=parameters)
+    assert np.allclose((sigma_step[0] - sigma[0, 0]) / step,
+                       dsigma[0, 0, 0], rtol=1e-4)
+
+
+def test_water_cloud_per_pixel_theta():
+    x = np.array([[0.5, 1., 2., 4.], [0.1, 0.2, 0.3, 0.4]])
+    theta = np.array([[30., 35.], [40., 45.]])
+    sigma, dsigma = sar_observation_operator(x, "VV", theta=theta)
+    for i, angle in enumerate(theta.ravel()):
+        sigma_i, dsigma_i = sar_observation_operator(x[:, i:i+1], "VV",
+                                                     theta=angle)
+        assert(np.allclose(sigma[i], sigma_i))
+        assert(np.allclose(dsigma[:, i], dsigma_i[:, 0]))
+
+
+def test_water_cloud_sparse_jacobian():
+    x = np.array([[0.5, 1., 2.], [0.1, 0.2, 0.3]])
+    sigma, dsigma = sar_observation_operator(x, "VH")
+    sigma_sp, dsigma_sp = sar_observation_operator(x, "VH",
+                                                   sparse_jacobian=True)
+    assert(np.allclose(sigma, sigma_sp))
+    assert(dsigma_sp.format == "csr")
+    assert(dsigma_sp.shape == (3, 6))
+    jac = dsigma_sp.toarray()
+    for i in range(3):
+        assert(np.allclose(jac[i, 2*i:2*i+2], dsigma[:, i]))
+        assert(np.count_nonzero(jac[i]) == 2)
+    # Index arrays are reused for calls of the same size
+    dsigma_sp2 = sar_observation_operator(x, "VV", sparse_jacobian=True)[1]
+    assert(np.shares_memory(dsigma_sp.indices, dsigma_sp2.indices))
+    # and copies can change their structure
+    jac_copy = dsigma_sp2.copy()
+    jac_copy.eliminate_zeros()
+    assert(np.allclose(jac_copy.toarray(), dsigma_sp2.toarray()))
+    # Derivatives of additional state parameters are not stored
+    x3 = np.vstack([x, np.ones(3)])
+    dsigma_sp3 = sar_observation_operator(x3, "VH", sparse_jacobian=True)[1]
+    assert(dsigma_sp3.shape == (3, 9))
+    assert(dsigma_sp3.nnz == 6)
+    assert(np.allclose(dsigma_sp3.toarray()[:, [0, 1, 3, 4, 6, 7]],
+                       dsigma_sp.toarray()))
+    # Only the index arrays of the most recent sizes are kept
+    for n_pixels in range(1, 51):
+        sar_observation_operator(np.ones((2, n_pixels)), "VV",
+                                 sparse_jacobian=True)
+    assert(len(_jacobian_index_cache) <= _jacobian_index_cache.maxsize)
+
+
+def test_water_cloud_joint_polarisations():
+    x = np.array([[0.5, 1., 2.], [0.1, 0.2, 0.3]])
+    theta = np.array([30., 35., 40.])
+    sigma, dsigma = sar_observation_operator(x, ["VV", "VH"], theta=theta)
+    assert(sigma.shape == (2, 3))
+    assert(dsigma.shape == (2, 2, 3))
+    for i, polarisation in enumerate(["VV", "VH"]):
+        sigma_i, dsigma_i = sar_observation_operator(x, polarisation,
+                                                     theta=theta)
+        assert(np.allclose(sigma[i], sigma_i))
+        assert(np.allclose(dsigma[i], dsigma_i))
+    sigma_all, dsigma_sp = sar_observation_operator(x, None, theta=theta,
+                                                    sparse_jacobian=True)
+    assert(np.allclose(sigma_all, sigma))
+    assert(dsigma_sp.shape == (6, 6))
+    assert(np.allclose(dsigma_sp.toarray()[3:, :],
+                       sar_observation_operator(x, "VH", theta=theta,
+                                                sparse_jacobian=True)[1]
+                       .toarray()))
+
+
+def test_water_cloud_workspace_and_out():
+    x = np.array([[0.5, 1., 2.], [0.1, 0.2, 0.3]])
+    theta = np.array([30., 35., 40.])
+    sigma, dsigma = sar_observation_operator(x, ["VV", "VH"], theta=theta)
+    workspace = SARWorkspace(3, n_pol=2)
+    out = workspace.allocate_output()
+    for _ in range(2):
+        sigma_ws, dsigma_ws = sar_observation_operator(
+            x, ["VV", "VH"], theta=theta, workspace=workspace, out=out)
+        assert(np.shares_memory(sigma_ws, out[0]))
+        assert(np.shares_memory(dsigma_ws, out[1]))
+        assert(np.allclose(sigma_ws, sigma))
+        assert(np.allclose(dsigma_ws, dsigma))
+    sigma_vv, dsigma_vv = sar_observation_operator(
+        x, "VV", theta=theta, out=(np.empty(3), np.empty((2, 3))))
+    assert(np.allclose(sigma_vv, sigma[0]))
+    assert(np.allclose(dsigma_vv, dsigma[0]))
+    with pytest.raises(ValueError):
+        sar_observation_operator(x, "VV", workspace=workspace)
+
+
+def test_water_cloud_float32():
+    x = np.array([[0.5, 1., 2.], [0.1, 0.2, 0.3]])
+    sigma, dsigma = sar_observation_operator(x, "VH")
+    sigma32, dsigma32 = sar_observation_operator(x, "VH", dtype=np.float32)
+    assert(sigma32.dtype == np.float32 and dsigma32.dtype == np.float32)
+    assert(np.allclose(sigma32, sigma, rtol=1e-5))
+    assert(np.allclose(dsigma32, dsigma, rtol=1e-4))
+
+
+def test_water_cloud_pixel_index():
+    x = np.array([[0.5, 1., 2., 4.], [0.1, 0.2, 0.3, 0.4]])
+    theta = np.array([[30., 35.], [40., 45.]])
+    pixel_index = PixelIndex(np.array([[False, True], [True, True]]))
+    sigma, dsigma = sar_observation_operator(x, "VV", theta=theta)
+    # State and angle on the grid, or already compact
+    for x_i, theta_i in [(x.reshape(2, 2, 2), theta),
+                         (x[:, 1:], theta.ravel()[1:])]:
+        sigma_c, dsigma_c = sar_observation_operator(
+            x_i, "VV", theta=theta_i, pixel_index=pixel_index)
+        assert(sigma_c.shape == (3,) and dsigma_c.shape == (2, 3))
+        assert(np.allclose(sigma_c, sigma[1:]))
+        assert(np.allclose(dsigma_c, dsigma[:, 1:]))
+    sigma_grid = pixel_index.scatter(sigma_c, np.nan)
+    assert(sigma_grid.shape == (2, 2))
+    assert(np.isnan(sigma_grid[0, 0]) and sigma_grid[1, 1] == sigma_c[2])
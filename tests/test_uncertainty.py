@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+import os
+import sys
+
+import numpy as np
+import scipy.sparse as sp
+
+import pytest
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../')
+
+from multiply_forward_operators.uncertainty import DiagonalPrecision
+from multiply_forward_operators.uncertainty import box_sum, enl_uncertainty
+from multiply_forward_operators.uncertainty import local_enl
+
+
+def test_diagonal_precision():
+    uncertainty = np.array([[0.5, 1.], [2., 0.]])
+    mask = np.array([[True, True], [False, False]])
+    precision = DiagonalPrecision.from_uncertainty(uncertainty, mask)
+    assert precision.shape == (4, 4)
+    assert precision.nnz == 2
+    # Masked observations carry no information (no 1/0 = inf)
+    assert np.allclose(precision.diagonal(), [4., 1., 0., 0.])
+    dense = np.diag([4., 1., 0., 0.])
+    csr = precision.tocsr()
+    assert sp.isspmatrix_csr(csr)
+    assert np.allclose(csr.toarray(), dense)
+    x = np.arange(4.)
+    assert np.allclose(precision @ x, dense @ x)
+    assert np.allclose(x @ precision, x @ dense)
+    X = np.arange(8.).reshape(4, 2)
+    assert np.allclose(precision @ X, dense @ X)
+    J = sp.random(4, 6, density=0.5, format="csr", random_state=1)
+    assert np.allclose((precision @ J).toarray(), dense @ J.toarray())
+    assert np.allclose((J.T @ precision).toarray(), J.T.toarray() @ dense)
+
+
+def test_diagonal_precision_zero_uncertainty():
+    # Zero backscatter (e.g. outside of the scene) has zero ENL uncertainty
+    backscatter = np.full((5, 5), 0.1)
+    backscatter[0] = 0.
+    mask = np.ones(backscatter.shape, dtype=bool)
+    uncertainty = enl_uncertainty(backscatter, mask, 3)
+    with pytest.raises(ValueError):
+        DiagonalPrecision.from_uncertainty(uncertainty, mask)
+    mask[0] = False
+    precision = DiagonalPrecision.from_uncertainty(
+        enl_uncertainty(backscatter, mask, 3), mask)
+    assert np.all(np.isfinite(precision.diagonal()))
+    assert np.all(precision.diagonal()[:5] == 0.)
+
+
+def test_box_sum():
+    data = np.random.RandomState(0).rand(9, 12)
+    sums = box_sum(data, 5)
+    for i, j in [(0, 0), (4, 6), (8, 11), (1, 10)]:
+        assert np.isclose(sums[i, j],
+                          data[max(i - 2, 0):i + 3, max(j - 2, 0):j + 3].sum())
+
+
+def test_local_enl():
+    # 4-look speckle: gamma distributed intensity with shape 4
+    rng = np.random.RandomState(1)
+    backscatter = 0.1 * rng.gamma(4., 1. / 4., size=(200, 200))
+    mask = np.ones(backscatter.shape, dtype=bool)
+    enl = local_enl(backscatter, mask, size=15)
+    assert abs(np.median(enl) - 4.) < 0.4
+    unc = enl_uncertainty(backscatter, mask, size=15)
+    assert np.allclose(unc, backscatter / np.sqrt(enl))
+    # Masked (wrong) values do not contribute to their neighbours
+    masked = backscatter.copy()
+    masked[::7, ::5] = -999.
+    mask = masked != -999.
+    enl_masked = local_enl(masked, mask, size=15)
+    assert np.all(enl_masked >= 1.) and np.all(np.isfinite(enl_masked))
+    assert abs(np.median(enl_masked[mask]) - 4.) < 0.4
+    # A window with a halo gives the same ENL as the full scene
+    enl_tile = local_enl(masked[43:107, 93:157], mask[43:107, 93:157],
+                         size=15)
+    assert np.allclose(enl_tile[7:-7, 7:-7], enl_masked[50:100, 100:150])
+    # Homogeneous windows get max_enl, whether their variance rounds to
+    # zero, to slightly negative or to a tiny positive value
+    uniform = np.full((20, 20), 0.1)
+    mask = np.ones(uniform.shape, dtype=bool)
+    assert np.all(local_enl(uniform, mask, size=5, max_enl=50.) == 50.)
+    noisy = uniform + 1e-6 * rng.rand(20, 20)
+    assert np.all(local_enl(noisy, mask, size=5, max_enl=50.) == 50.)
+    uniform[:10] = 0.3
+    enl = local_enl(uniform, mask, size=5, max_enl=50.)
+    assert np.all(enl[:8] == 50.) and np.all(enl[12:] == 50.)
+    # and windows of a single valid pixel ENL 1
+    mask = np.zeros(uniform.shape, dtype=bool)
+    mask[10, 10] = True
+    assert local_enl(uniform, mask, size=5, max_enl=50.)[10, 10] == 1.
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+import os
+import sys
+
+import numpy as np
+
+import pytest
+
+myPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, myPath + '/../')
+
+from multiply_forward_operators import sar_observation_operator
+from multiply_forward_operators import wcm_calibration
+from multiply_forward_operators.sar_forward_model import load_parameters
+from multiply_forward_operators.sar_forward_model import save_parameters
+from multiply_forward_operators.wcm_calibration import calibrate_groups
+from multiply_forward_operators.wcm_calibration import calibrate_wcm
+from multiply_forward_operators.wcm_calibration import parameter_tables
+from multiply_forward_operators.wcm_calibration import wcm_backscatter
+
+
+def simulate(parameters, n_obs, seed=0):
+    rng = np.random.RandomState(seed)
+    shape = (len(parameters), n_obs)
+    V = rng.uniform(0.2, 5., shape)
+    SM = rng.uniform(0.1, 0.4, shape)
+    theta = rng.uniform(30., 45., shape)
+    sigma, _ = wcm_backscatter(np.asarray(parameters), V, SM, theta)
+    return 10 * np.log10(sigma), V, SM, theta
+
+
+def test_wcm_jacobian():
+    parameters = np.array([[0.08, 0.06, -14., 16., 0.3],
+                           [0.1, 0.15, -12., 20., 0.]])
+    _, V, SM, theta = simulate(parameters, 5)
+    sigma, jac = wcm_backscatter(parameters, V, SM, theta)
+    for i in range(5):
+        step = np.zeros(5)
+        step[i] = 1e-7 * max(abs(parameters[0, i]), 1.)
+        sigma_i, _ = wcm_backscatter(parameters + step, V, SM, theta)
+        assert np.allclose((sigma_i - sigma) / step[i], jac[..., i],
+                           rtol=1e-4, atol=1e-9)
+    # Same backscatter as the operator
+    sigma_vv, _ = sar_observation_operator(
+        np.array([V[1], SM[1]]), "VV", theta=theta[1],
+        parameters={"VV": parameters[1]})
+    assert np.allclose(sigma_vv, sigma[1])
+
+
+def test_calibrate_wcm():
+    truth = np.array([[0.12, 0.08, -13., 18., 0.],
+                      [0.05, 0.2, -16., 25., 0.],
+                      [0.1, 0.1, -10., 12., 0.]])
+    backscatter, V, SM, theta = simulate(truth, 40)
+    # The last field has fewer (padded) observations
+    backscatter[2, 25:] = np.nan
+    result = calibrate_wcm(backscatter, V, SM, theta,
+                           fixed=[False, False, False, False, True])
+    assert np.all(result.converged)
+    assert not np.any(result.stalled)
+    assert np.allclose(result.parameters, truth, rtol=1e-3, atol=1e-5)
+    assert np.all(result.cost < 1e-8)
+
+
+def test_calibrate_wcm_stalled(monkeypatch):
+    truth = np.array([[0.12, 0.08, -13., 18., 0.],
+                      [0.05, 0.2, -16., 25., 0.]])
+    backscatter, V, SM, theta = simulate(truth, 40)
+    residuals = wcm_calibration._residuals
+    n_calls = [0]
+
+    def no_decrease(parameters, backscatter_fields, *args):
+        # no step lowers the cost of the second field after the first call
+        residual, jac, cost = residuals(parameters, backscatter_fields,
+                                        *args)
+        n_calls[0] += 1
+        if n_calls[0] > 1:
+            cost = np.where(backscatter_fields[:, 0] == backscatter[1, 0],
+                            np.inf, cost)
+        return residual, jac, cost
+
+    monkeypatch.setattr(wcm_calibration, "_residuals", no_decrease)
+    result = calibrate_wcm(backscatter, V, SM, theta,
+                           fixed=[False, False, False, False, True])
+    assert list(result.converged) == [True, False]
+    assert list(result.stalled) == [False, True]
+    assert np.all(result.parameters[1] == wcm_calibration.WCM_PARAMETERS["VV"])
+    assert result.n_iter[1] < 100
+
+
+def test_calibrate_groups_tables(tmpdir):
+    truth = np.array([[0.12, 0.08, -13., 18., 0.],
+                      [0.05, 0.2, -16., 25., 0.]])
+    backscatter, V, SM, theta = simulate(truth, 30)
+    labels = np.repeat(np.array(["wheat", "maize"]), 30)
+    groups, result = calibrate_groups(labels, backscatter.ravel(),
+                                      V.ravel(), SM.ravel(), theta.ravel(),
+                                      fixed=[False] * 4 + [True])
+    assert list(groups) == ["maize", "wheat"]
+    assert np.allclose(result.parameters, truth[::-1], rtol=1e-3, atol=1e-5)
+
+    tables = parameter_tables(groups, result.parameters, "vv")
+    fname = str(tmpdir.join("wcm.json"))
+    save_parameters(fname, tables)
+    assert sorted(load_parameters(fname)) == ["maize", "wheat"]
+    x = np.array([V[0], SM[0]])
+    sigma, _ = sar_observation_operator(x, "VV", theta=theta[0],
+                                        parameters="wheat")
+    assert np.allclose(10 * np.log10(sigma), backscatter[0], atol=1e-4)
+    with pytest.raises(ValueError):
+        sar_observation_operator(x, "VH", theta=theta[0],
+                                 parameters="wheat")
+    with pytest.raises(ValueError):
+        sar_observation_operator(x, "VV", parameters="barley")